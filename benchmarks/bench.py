@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+"""
+These are the benchmarks of czokomaster. They run the very czokomaster from
+this tree end to end - the same way cron or an admin would - against 1 to
+200 simulated jails, so it is known whether a change makes czokomaster any
+faster (or slower). The FreeBSD tools are replaced with the stand-ins (see
+fake_tool.py), thus the benchmarks run on a plain Linux box as well.
+
+Every benchmark is run in a sandbox of its own (a temporary dir holding the
+config file, the bin dir of the stand-ins, the jails, the caches and a local
+package index) and timed from the start of the process till its end. Usage:
+
+  $ python benchmarks/bench.py
+  $ python benchmarks/bench.py --jails 1,50,200 --jobs 8 --latency 0.05
+  $ python benchmarks/bench.py --scenarios ports-diff,cron-helper \\
+        --tool portmaster:latency=0.5 --failure-rate 0.1
+  $ python benchmarks/bench.py --save before.json
+  $ python benchmarks/bench.py --compare before.json --tolerance 0.2
+
+The latter exits with 1 if any of the benchmarks has got slower by more than
+the tolerance (20% here) since before.json was saved.
+
+A benchmark fails if czokomaster exits with anything but 0 in any of its
+runs while none of the tools is set to fail (--failure-rate or failure_rate
+of --tool). With the failures on, czokomaster is expected to exit with 1 -
+it reports the systems it has not got through - so the exit code is only
+shown then. A failed benchmark has got no time (a run that has died early is
+no faster), is counted as a regression by --compare and makes bench.py exit
+with 1.
+
+The scenarios:
+
+  - ports-diff - czokomaster ports diff all (with the diff cache emptied
+                 before every run);
+  - ports-diff-aggregate - czokomaster ports diff all --aggregate (likewise);
+  - ports-diff-cached - czokomaster ports diff all, answered by the diff
+                        cache;
+  - ports-upgrade - czokomaster ports upgrade all;
+  - ports-upgrade-shared - czokomaster ports upgrade all --shared (with the
+                           package cache emptied before every run);
+  - ports-upgrade-parallel - czokomaster ports upgrade all --parallel (the
+                             build scheduler);
+  - pippy-diff - czokomaster pippy diff all;
+  - pippy-upgrade - czokomaster pippy upgrade all (the caches are refreshed
+                    after the upgrade);
+  - cron-helper - PythonUpdateChecker.get_updates(), i.e. the pippy cron
+                  helper.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import optparse
+import tempfile
+import subprocess
+
+## Where czokomaster and the stand-ins are.
+HERE = os.path.dirname(os.path.abspath(__file__))
+TREE = os.path.dirname(HERE)
+
+## The tools replaced with the stand-ins.
+TOOLS = ["jexec", "pkg_version", "portmaster", "portsnap", "ezjail-admin",
+         "yolk", "make", "easy_install", "pip"]
+
+SCENARIOS = ["ports-diff", "ports-diff-aggregate", "ports-diff-cached",
+             "ports-upgrade", "ports-upgrade-shared",
+             "ports-upgrade-parallel", "pippy-diff", "pippy-upgrade",
+             "cron-helper"]
+
+CONFIG = """\
+[czokomaster]
+max_parallel_jails = %(jobs)d
+jails_root = %(root)s/jails
+run_log = %(root)s/runs.log
+run_summary = no
+
+[ports]
+jails = %(jails)s
+show_updates_cmd = pkg_version -vIl "<"
+ports_upgrade_cmd = portmaster -ad --no-confirm
+package_builder = %(builder)s
+build_jobs = %(jobs)d
+package_cachedir = %(root)s/packages
+diff_cachedir = %(root)s/diff
+jail_package_dir = /packages
+
+[pippy]
+jails = %(jails)s
+pippy_cachedir = %(root)s/pippy
+py_upgrade_cmd = easy_install -U
+index_url = %(root)s/index
+site_packages = /usr/local/lib/python2.7/site-packages
+"""
+
+class Sandbox:
+    """
+    The temporary dir a benchmark is run in (see the top of the module).
+    """
+
+    def __init__(self, jails, jobs, settings):
+        self.root = tempfile.mkdtemp(prefix="czokomaster-bench-")
+        self.jails = ["jail%03d" % number for number in range(1, jails + 1)]
+
+        bindir = os.path.join(self.root, "bin")
+        os.makedirs(bindir)
+
+        for tool in TOOLS:
+            path = os.path.join(bindir, tool)
+            f = open(path, "w")
+            f.write("#!/bin/sh\nexec \"%s\" \"%s\" %s \"$@\"\n" % (
+                    sys.executable, os.path.join(HERE, "fake_tool.py"), tool))
+            f.close()
+            os.chmod(path, 0755)
+
+        f = open(os.path.join(self.root, "settings.json"), "w")
+        json.dump(settings, f)
+        f.close()
+
+        f = open(os.path.join(self.root, "czokomaster.conf"), "w")
+        f.write(CONFIG % {"jobs": jobs, "root": self.root,
+                          "jails": ", ".join(self.jails),
+                          "builder": self.jails[0]})
+        f.close()
+
+        # The installed python packages (as seen from the host) and the
+        # package index they are looked up in.
+        for jail in self.jails:
+            site_packages = os.path.join(self.root, "jails", jail, "usr",
+                                         "local", "lib", "python2.7",
+                                         "site-packages")
+            os.makedirs(site_packages)
+
+            for number in range(settings["packages"]):
+                os.mkdir(os.path.join(site_packages,
+                                      "pkg%d-1.0-py2.7.egg-info" % number))
+
+        for number in range(settings["packages"]):
+            directory = os.path.join(self.root, "index", "pkg%d" % number)
+            os.makedirs(directory)
+            open(os.path.join(directory, "pkg%d-1.1.tar.gz" % number),
+                 "w").close()
+
+        self.env = dict(os.environ)
+        self.env.update({
+            "PATH": "%s:%s" % (bindir, os.environ.get("PATH", "")),
+            "PYTHONPATH": TREE,
+            "CZOKOMASTER_CONFIG": os.path.join(self.root, "czokomaster.conf"),
+            "CZOKOMASTER_CACHE_DIR": os.path.join(self.root, "cache"),
+            "FAKE_TOOLS_SETTINGS": os.path.join(self.root, "settings.json"),
+            "FAKE_TOOLS_STATE": os.path.join(self.root, "upgraded"),
+        })
+
+    def czokomaster(self, *params):
+        """
+        Return the command that runs czokomaster with the given params.
+        """
+
+        return [sys.executable, "-B", os.path.join(TREE, "czokomaster.py")] + \
+               list(params)
+
+    def cron_helper(self):
+        """
+        Return the command that runs the pippy cron helper.
+        """
+
+        return [sys.executable, "-B", os.path.join(TREE, "czokomaster",
+                "plugins", "plugin_helpers", "pippy_cron_helper.py")]
+
+    def run(self, command):
+        """
+        Run the command within the sandbox. Return (seconds, returncode,
+        the number of the commands czokomaster has run).
+        """
+
+        log = os.path.join(self.root, "runs.log")
+        logged = self._count_lines(log)
+
+        devnull = open(os.devnull, "w")
+        started = time.time()
+        returncode = subprocess.call(command, env=self.env, stdout=devnull,
+                                     stderr=devnull, cwd=self.root)
+        seconds = time.time() - started
+        devnull.close()
+
+        return seconds, returncode, self._count_lines(log) - logged
+
+    def prepare(self, scenario):
+        """
+        Bring the sandbox to the state the scenario starts from.
+        """
+
+        # Every port is outdated again.
+        shutil.rmtree(os.path.join(self.root, "upgraded"), True)
+
+        # The pippy caches must be there before they are shown/upgraded.
+        if scenario in ("pippy-diff", "pippy-upgrade"):
+            if not os.path.exists(os.path.join(self.root, "pippy",
+                                               self.jails[-1])):
+                self.run(self.cron_helper())
+
+        # The diff is timed either with every jail asked anew or with every
+        # answer in the cache already.
+        if scenario in ("ports-diff", "ports-diff-aggregate"):
+            shutil.rmtree(os.path.join(self.root, "diff"), True)
+
+        if scenario == "ports-diff-cached":
+            self.run(self.czokomaster("ports", "diff", "all", "--refresh"))
+
+        # Every run of the shared upgrade builds the packages anew.
+        if scenario == "ports-upgrade-shared":
+            shutil.rmtree(os.path.join(self.root, "packages"), True)
+
+    def command(self, scenario):
+        """
+        Return the command the scenario is timed by.
+        """
+
+        return {
+            "ports-diff": self.czokomaster("ports", "diff", "all"),
+            "ports-diff-aggregate": self.czokomaster("ports", "diff", "all",
+                                                     "--aggregate"),
+            "ports-diff-cached": self.czokomaster("ports", "diff", "all"),
+            "ports-upgrade": self.czokomaster("ports", "upgrade", "all"),
+            "ports-upgrade-shared": self.czokomaster("ports", "upgrade", "all",
+                                                     "--shared"),
+            "ports-upgrade-parallel": self.czokomaster("ports", "upgrade",
+                                                       "all", "--parallel"),
+            "pippy-diff": self.czokomaster("pippy", "diff", "all"),
+            "pippy-upgrade": self.czokomaster("pippy", "upgrade", "all"),
+            "cron-helper": self.cron_helper(),
+        }[scenario]
+
+    def remove(self):
+        shutil.rmtree(self.root, True)
+
+    def _count_lines(self, path):
+        if not os.path.exists(path):
+            return 0
+
+        f = open(path, "r")
+        count = len(f.readlines())
+        f.close()
+
+        return count
+
+def benchmark(scenarios, jail_counts, jobs, settings, repeat):
+    """
+    Run the benchmarks and return their results, one dict per (scenario,
+    number of jails). The best time of "repeat" runs is taken, unless any of
+    the runs has failed (see the top of the module) - "seconds" is None then
+    and "returncode" is the exit code of the first failed run.
+    """
+
+    results = []
+
+    # The tools failing on purpose make czokomaster exit with 1 anyway.
+    failing = [values for values in settings.values() if \
+               isinstance(values, dict) and values.get("failure_rate")]
+
+    for jails in jail_counts:
+        sandbox = Sandbox(jails, jobs, settings)
+
+        try:
+            for scenario in scenarios:
+                runs = []
+
+                for number in range(repeat):
+                    sandbox.prepare(scenario)
+                    runs.append(sandbox.run(sandbox.command(scenario)))
+
+                failed = [run for run in runs if run[1] != 0 and \
+                          not failing]
+
+                if failed:
+                    seconds, returncode, commands = failed[0]
+                    result = {"scenario": scenario, "jails": jails,
+                              "seconds": None, "returncode": returncode,
+                              "commands": commands}
+
+                    print "%-22s %5d jails    FAILED (exit code %d in %d of " \
+                          "%d run(s))" % (scenario, jails, returncode,
+                                          len(failed), len(runs))
+                else:
+                    seconds, returncode, commands = min(runs)
+                    result = {"scenario": scenario, "jails": jails,
+                              "seconds": round(seconds, 3),
+                              "returncode": returncode, "commands": commands}
+
+                    print "%-22s %5d jails %9.2fs %9.1f jails/s %7d " \
+                          "commands%s" % (scenario, jails, seconds,
+                                          jails / max(seconds, 0.001),
+                                          commands, returncode and \
+                                          " (exit code %d)" % returncode or \
+                                          "")
+
+                results.append(result)
+                sys.stdout.flush()
+        finally:
+            sandbox.remove()
+
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Print the benchmarks that have got slower than in the baseline by more
+    than the tolerance or have failed. Return the number of such benchmarks.
+    """
+
+    before = dict([((result["scenario"], result["jails"]), result) \
+                   for result in baseline["results"]])
+    regressions = 0
+
+    for result in results:
+        old = before.get((result["scenario"], result["jails"]))
+
+        if result["seconds"] is None:
+            regressions += 1
+            print "REGRESSION: %s with %d jails: failed (exit code %d)" % \
+                  (result["scenario"], result["jails"], result["returncode"])
+            continue
+
+        # Nothing to compare with, or the baseline has failed itself.
+        if old is None or old.get("seconds") is None:
+            continue
+
+        change = (result["seconds"] - old["seconds"]) / \
+                 max(old["seconds"], 0.001)
+
+        if change > tolerance:
+            regressions += 1
+            print "REGRESSION: %s with %d jails: %.2fs -> %.2fs (%+.0f%%)" % \
+                  (result["scenario"], result["jails"], old["seconds"],
+                   result["seconds"], change * 100)
+
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--scenarios", default=",".join(SCENARIOS),
+                      help="comma-separated scenarios [%default]")
+    parser.add_option("--jails", default="1,10,50,200",
+                      help="comma-separated numbers of jails [%default]")
+    parser.add_option("--jobs", type="int", default=8,
+                      help="max_parallel_jails [%default]")
+    parser.add_option("--repeat", type="int", default=1,
+                      help="how many times each benchmark is run [%default]")
+    parser.add_option("--latency", type="float", default=0.01,
+                      help="how long each tool takes (seconds) [%default]")
+    parser.add_option("--lines", type="int", default=20,
+                      help="how many lines each tool prints [%default]")
+    parser.add_option("--failure-rate", type="float", default=0.0,
+                      help="how often (0-1) each tool fails [%default]")
+    parser.add_option("--ports", type="int", default=20,
+                      help="outdated ports per jail [%default]")
+    parser.add_option("--packages", type="int", default=20,
+                      help="python packages per jail [%default]")
+    parser.add_option("--tool", action="append", default=[],
+                      help="settings of a single tool, e.g. "
+                           "portmaster:latency=0.5,failure_rate=0.1")
+    parser.add_option("--seed", type="int", default=0,
+                      help="the seed of the failures [%default]")
+    parser.add_option("--save", help="write the results to the given file")
+    parser.add_option("--compare", help="compare with the results saved "
+                                        "before")
+    parser.add_option("--tolerance", type="float", default=0.2,
+                      help="how much slower (0-1) is still fine [%default]")
+    options, args = parser.parse_args()
+
+    scenarios = options.scenarios.split(",")
+
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario: %s" % scenario)
+
+    settings = {"seed": options.seed, "ports": options.ports,
+                "packages": options.packages,
+                "default": {"latency": options.latency,
+                            "lines": options.lines,
+                            "failure_rate": options.failure_rate}}
+
+    for tool in options.tool:
+        name, values = tool.split(":", 1)
+        settings[name] = {}
+
+        for value in values.split(","):
+            key, number = value.split("=", 1)
+            settings[name][key] = float(number)
+
+    results = benchmark(scenarios, [int(jails) for jails in \
+                                    options.jails.split(",")],
+                        options.jobs, settings, max(1, options.repeat))
+
+    if options.save:
+        f = open(options.save, "w")
+        json.dump({"settings": settings, "jobs": options.jobs,
+                   "results": results}, f, indent=1, sort_keys=True)
+        f.close()
+
+    if options.compare:
+        f = open(options.compare, "r")
+        baseline = json.load(f)
+        f.close()
+
+        if compare(results, baseline, options.tolerance):
+            return 1
+
+    if [result for result in results if result["seconds"] is None]:
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
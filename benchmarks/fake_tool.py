@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+This is the stand-in for the FreeBSD tools czokomaster shells out to, so the
+benchmarks (see bench.py) can be run on any box - a plain Linux one as well.
+It is not run by itself: bench.py puts a small wrapper named after every tool
+into the bin dir of the sandbox, e.g. "jexec" runs:
+
+  fake_tool.py jexec <the arguments of jexec>
+
+The tools act just like the real ones as far as czokomaster can tell:
+
+  - jexec <jail> <command> - runs the command (i.e. the stand-in of it, as
+                             the bin dir is first in PATH);
+  - pkg_version - lists the outdated ports (by their origins if given -o);
+  - portmaster - "builds" the ports, with -g it puts the packages into the
+                 $PACKAGES/All dir, with -PP it "installs" them from the
+                 packages;
+  - make -V <variable> - tells SELECTED_OPTIONS or PKGNAME of the port,
+                         make all-depends-list tells what the port
+                         depends on (make build-depends-list
+                         run-depends-list - only the direct dependencies);
+  - portsnap, ezjail-admin - "update" the ports trees;
+  - yolk -l/-U/-V - lists the installed/outdated packages;
+  - easy_install, pip - "upgrade" the python packages.
+
+How fast, how talkative and how reliable the tools are is set in the
+settings file (a JSON document) pointed to by FAKE_TOOLS_SETTINGS:
+
+  {
+   "seed": 0,                      - the seed of the failures;
+   "ports": 20,                    - how many ports are outdated in a jail;
+   "packages": 20,                 - how many python packages are installed
+                                     (and outdated) in a jail;
+   "default": {"latency": 0.01,    - how long (in seconds) a tool takes
+                                     (portmaster takes it per port);
+               "lines": 20,        - how many lines of noise it prints (e.g.
+                                     the build log of portmaster);
+               "failure_rate": 0}, - how often (0-1) it fails;
+   "portmaster": {"latency": 0.5}, - the same, for one tool only;
+   "portmaster-packages": {        - the same, for portmaster -PP only
+     "latency": 0.05}                (installing from packages, which is
+  }                                  much cheaper than building the port).
+
+The ports upgraded by portmaster (built, installed from the packages or
+upgraded by -a) are not outdated anymore - they are written down in the
+$FAKE_TOOLS_STATE dir, a file per jail (jexec tells the jail to the tools
+it runs by $FAKE_JAIL). The benchmarks empty the dir before every run.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+
+## The settings used if there is no settings file.
+DEFAULTS = {"seed": 0, "ports": 20, "packages": 20,
+            "default": {"latency": 0.01, "lines": 20, "failure_rate": 0.0}}
+
+def load_settings():
+    """
+    Return the settings (see the top of the module).
+    """
+
+    settings = dict(DEFAULTS)
+    path = os.environ.get("FAKE_TOOLS_SETTINGS")
+
+    if path:
+        f = open(path, "r")
+        settings.update(json.load(f))
+        f.close()
+
+    return settings
+
+def tool_settings(settings, *tools):
+    """
+    Return the latency, the number of lines and the failure rate of the tool
+    (the settings of the later tools win, e.g. "portmaster-packages" over
+    "portmaster").
+    """
+
+    values = dict(DEFAULTS["default"])
+    values.update(settings.get("default", {}))
+
+    for tool in tools:
+        values.update(settings.get(tool, {}))
+
+    return values["latency"], int(values["lines"]), values["failure_rate"]
+
+def upgraded():
+    """
+    Return the set of the origins upgraded in the jail so far.
+    """
+
+    path = _state_path()
+
+    if not path or not os.path.exists(path):
+        return set()
+
+    f = open(path, "r")
+    origins = set(f.read().split())
+    f.close()
+
+    return origins
+
+def mark_upgraded(origins):
+    """
+    Write the origins down as upgraded in the jail.
+    """
+
+    path = _state_path()
+
+    if not path:
+        return
+
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+    f = open(path, "a")
+    f.write("".join(["%s\n" % origin for origin in origins]))
+    f.close()
+
+def outdated(settings):
+    """
+    Return the list of (origin, old package name, new version) of the ports
+    still outdated in the jail.
+    """
+
+    done = upgraded()
+
+    return [port(number) for number in range(settings["ports"]) \
+            if port(number)[0] not in done]
+
+def _state_path():
+    directory = os.environ.get("FAKE_TOOLS_STATE")
+
+    return directory and os.path.join(directory,
+                                      os.environ.get("FAKE_JAIL", "host"))
+
+def port(number):
+    """
+    Return (origin, old package name, new version) of the outdated port.
+    """
+
+    return ("cat%d/port%d" % (number % 10, number), "port%d-1.0_1" % number,
+            "1.0_2")
+
+def main(tool, args):
+    settings = load_settings()
+    latency, lines, failure_rate = tool_settings(settings, tool, *(
+        tool == "portmaster" and "-PP" in args and ["portmaster-packages"] or \
+        []))
+
+    time.sleep(latency)
+
+    ## "portmaster -a" builds every outdated port, one after another.
+    everything = tool == "portmaster" and [arg for arg in args if \
+                                           arg[:1] == "-" != arg[1:2] and \
+                                           "a" in arg]
+
+    if everything:
+        time.sleep(latency * max(len(outdated(settings)) - 1, 0))
+
+    ## Run the command "within" the jail. Whatever the jail prints comes
+    ## from the command.
+    if tool == "jexec":
+        os.environ["FAKE_JAIL"] = args[0]
+        os.execvp(args[1], args[1:])
+
+    ## The failures are the same on every run, as long as the seed is.
+    if random.Random("%s %s %s" % (settings["seed"], tool,
+                                   " ".join(args))).random() < failure_rate:
+        sys.stderr.write("%s: simulated failure\n" % tool)
+        return 1
+
+    if tool == "pkg_version":
+        origins = [arg for arg in args if arg.startswith("-") and "o" in arg]
+
+        for origin, pkgname, version in outdated(settings):
+            print "%-34s <   needs updating (index has %s)" % \
+                  (origin if origins else pkgname, version)
+
+    elif tool == "make":
+        directory = args[args.index("-C") + 1]
+
+        ## The ports depend on each other like a binary tree: port5 needs
+        ## port2, which needs port0.
+        if "-V" not in args:
+            number = int(directory.rstrip("/").split("port")[-1])
+
+            while number:
+                number = (number - 1) // 2
+                print "/usr/ports/%s" % port(number)[0]
+
+                if "all-depends-list" not in args:
+                    break
+
+            return 0
+
+        variable = args[args.index("-V") + 1]
+
+        if variable == "PKGNAME":
+            print "%s-%s" % (directory.rstrip("/").split("/")[-1],
+                             port(0)[2])
+        elif variable == "SELECTED_OPTIONS":
+            print "DOCS"
+
+    elif tool == "portmaster":
+        for number in range(lines):
+            print "===>  Building (%d/%d) %s" % (number + 1, lines, args[-1])
+
+        ## A package is wanted.
+        if "-g" in args:
+            directory = os.path.join(os.environ["PACKAGES"], "All")
+
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+            f = open(os.path.join(directory, "%s-%s.tbz" % (
+                     args[-1].split("/")[-1], port(0)[2])), "w")
+            f.write("\0" * 1024)
+            f.close()
+
+        mark_upgraded(everything and [origin for origin, pkgname, version \
+                                      in outdated(settings)] or \
+                      [arg for arg in args if not arg.startswith("-")])
+
+    elif tool == "yolk":
+        for number in range(settings["packages"]):
+            if args[0] == "-l":
+                print "pkg%-12d - 1.0          - active" % number
+            elif args[0] == "-U":
+                print " pkg%d 1.0 (1.1)" % number
+
+        if args[0] == "-V":
+            print "%s 1.1" % args[1]
+
+    else:
+        ## portsnap, ezjail-admin, easy_install, pip - just the noise.
+        for number in range(lines):
+            print "%s: %s (%d/%d)" % (tool, " ".join(args), number + 1,
+                                      lines)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
@@ -5,7 +5,16 @@
 
 import sys
 
-from czokomaster.czokomanager import handle_event
+from czokomaster.client import forward
 
 if __name__ == "__main__":
+    # Have the daemon run the command if there is one running (see
+    # czokomaster/daemon.py). Otherwise, run it here.
+    code = forward(sys.argv)
+
+    if code is not None:
+        sys.exit(code)
+
+    from czokomaster.czokomanager import handle_event
+
     handle_event(sys.argv)
@@ -0,0 +1,311 @@
+"""
+These are the execution backends of czokomaster - they run the commands of
+the jails on the hosts the jails live on. A system is given either as:
+
+  - "jail" or "base" - the jail (or the base system) of this host;
+  - "host:jail" or "host:base" - the jail (or the base system) of another
+    host, e.g. "web2.example.com:www".
+
+Both of them might be mixed within the "jails" option and on the command
+line. The commands of this host are run as they always were (through jexec
+for the jails). The commands of another host are handed over to the backend
+set by "remote_backend":
+
+  - ssh - the command is run over ssh, through the control connection of
+    the host (see ControlMaster in ssh_config(5)). The control connection
+    is made the first time a command is run on the host, once, and every
+    command run on the host afterwards goes through it - no new TCP
+    connection, no new key exchange, no new login. It is closed once the
+    run is over (see close_all()) - "ssh_control_persist" only tells ssh
+    when to close it if czokomaster dies before. The sockets are kept in
+    "ssh_control_dir";
+  - fake - the command is run on this host, with CZOKOMASTER_HOST set to
+    the name of the host, and the "connections" are only counted. It is
+    there to try the multi-host setup out (and to test it) with no network
+    and no other hosts.
+
+The jails of all the hosts are worked on in parallel (see
+"max_parallel_jails"), the engine spreading the jobs over the hosts (and
+starting at most "max_jobs_per_host" of them on a single host, see
+engine.py). The files of the jails of another host cannot be read from here
+(see jail_root()), so whatever czokomaster reads straight from the files of
+the jails otherwise (the package database, the site-packages) is asked over
+the backend instead.
+"""
+
+import os
+import time
+import pipes
+import shlex
+import threading
+import subprocess
+
+## For how many seconds a host that could not be connected to is not tried
+## again - the rest of its jails fail straight away rather than each of
+## them waiting for ssh to give up.
+RETRY_AFTER = 60
+
+## The backends made so far, one per host.
+_backends = {}
+_backends_lock = threading.Lock()
+
+class BackendError(Exception):
+    """
+    Raised when the backend cannot reach the host.
+    """
+
+def split_target(target):
+    """
+    Return (host, jail) of the system, host being None for this host.
+    """
+
+    if ":" in target:
+        host, jail = target.split(":", 1)
+        return host, jail
+
+    return None, target
+
+def host_of(target):
+    """
+    Return the host of the system or None for this host.
+    """
+
+    return split_target(target)[0]
+
+def hosts_of(targets):
+    """
+    Return the hosts (other than this one) the systems are on, in the order
+    they come.
+    """
+
+    hosts = []
+
+    for target in targets:
+        host = host_of(target)
+
+        if host is not None and host not in hosts:
+            hosts.append(host)
+
+    return hosts
+
+def get_backend(host):
+    """
+    Return the backend of the host (the one set by "remote_backend"), made
+    once per host. None is returned for this host.
+    """
+
+    if host is None:
+        return None
+
+    from czokomanager import get_config_option
+
+    kind = get_config_option("czokomaster", "remote_backend")
+
+    with _backends_lock:
+        if (kind, host) not in _backends:
+            if kind not in BACKENDS:
+                raise BackendError("unknown remote backend \"%s\", it "
+                                   "should be one of: %s" % \
+                                   (kind, ", ".join(sorted(BACKENDS))))
+
+            _backends[(kind, host)] = BACKENDS[kind](host)
+
+        return _backends[(kind, host)]
+
+def unwrap(command):
+    """
+    Return (host, the command as given to the backend) of a command made by
+    the backend of another host (see jail_command()) or (None, command) if
+    no backend has made it.
+    """
+
+    with _backends_lock:
+        backends = _backends.values()
+
+    for backend in backends:
+        inner = backend.unwrap(command)
+
+        if inner is not None:
+            return backend.host, inner
+
+    return None, command
+
+def close_all():
+    """
+    Close the control connections used by this process, once the run is
+    over (see czokomanager.handle_event() and end_run()). They are left to
+    time out otherwise, see "ssh_control_persist".
+    """
+
+    with _backends_lock:
+        backends = _backends.values()
+        _backends.clear()
+
+    for backend in backends:
+        backend.close()
+
+class SSHBackend(object):
+    """
+    Run the commands over the control connection of the host, see the top
+    of the module.
+    """
+
+    def __init__(self, host):
+        from czokomanager import get_config_option
+
+        self.host = host
+        self.control_dir = get_config_option("czokomaster", "ssh_control_dir")
+        self.persist = get_config_option("czokomaster", "ssh_control_persist")
+        self.options = get_config_option("czokomaster", "ssh_options")
+        self.lock = threading.Lock()
+        self.connected = False
+        self.failed = None
+
+    def command(self, command):
+        """
+        Return the command that runs "command" on the host. The control
+        connection is made first, unless it is there already.
+        """
+
+        self.connect()
+
+        return self._prefix() + pipes.quote(command)
+
+    def unwrap(self, command):
+        """
+        Return the command given to command() or None if it has not made
+        the given one.
+        """
+
+        if not command.startswith(self._prefix()):
+            return None
+
+        return shlex.split(command[len(self._prefix()):])[0]
+
+    def connect(self):
+        """
+        Make the control connection of the host, unless there is one already
+        - made by this run or left open by a previous one. The jobs of the
+        host wait for it, so it is made once, not once per job.
+        """
+
+        with self.lock:
+            if self.connected:
+                return
+
+            if self.failed is not None and \
+               time.time() - self.failed[0] < RETRY_AFTER:
+                raise BackendError(self.failed[1])
+
+            if not os.path.isdir(self.control_dir):
+                os.makedirs(self.control_dir, 0700)
+
+            if _call(self._ssh("check") + [self.host])[0] != 0:
+                code, stderr = _call(self._ssh() + ["-f", "-N", "-o",
+                                                    "ControlMaster=yes",
+                                                    self.host])
+
+                if code != 0:
+                    self.failed = (time.time(), "cannot connect to %s%s" % \
+                                   (self.host, stderr.strip() and \
+                                    ": %s" % stderr.strip() or ""))
+                    raise BackendError(self.failed[1])
+
+            self.connected = True
+            self.failed = None
+
+    def close(self):
+        with self.lock:
+            if self.connected:
+                _call(self._ssh("exit") + [self.host])
+                self.connected = False
+
+    def _prefix(self):
+        """
+        Return the start of the commands made by command().
+        """
+
+        return " ".join([pipes.quote(arg) for arg in \
+                         self._ssh() + [self.host]]) + " "
+
+    def _ssh(self, control=None):
+        """
+        Return the ssh command line (as a list) - the one of the commands or,
+        with "control" given, the one controlling the control connection
+        ("check" or "exit").
+        """
+
+        ssh = ["ssh", "-o", "ControlMaster=auto",
+               "-o", "ControlPath=%s" % os.path.join(self.control_dir,
+                                                     "%r@%h:%p"),
+               "-o", "ControlPersist=%d" % self.persist] + \
+              self.options.split()
+
+        if control is not None:
+            ssh += ["-O", control]
+
+        return ssh
+
+class FakeBackend(object):
+    """
+    Run the commands on this host, as if they were run on another one, see
+    the top of the module.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.connected = False
+        self.connections = 0
+        self.commands = 0
+
+    def command(self, command):
+        self.connect()
+
+        with self.lock:
+            self.commands += 1
+
+        return self._prefix() + pipes.quote(command)
+
+    def unwrap(self, command):
+        if not command.startswith(self._prefix()):
+            return None
+
+        return shlex.split(command[len(self._prefix()):])[0]
+
+    def _prefix(self):
+        return "env CZOKOMASTER_HOST=%s sh -c " % pipes.quote(self.host)
+
+    def connect(self):
+        with self.lock:
+            if not self.connected:
+                self.connected = True
+                self.connections += 1
+
+    def close(self):
+        with self.lock:
+            self.connected = False
+
+## The backends "remote_backend" might be set to.
+BACKENDS = {"ssh": SSHBackend, "fake": FakeBackend}
+
+def _call(command):
+    """
+    Run the command (not a command of a job, so it is not run by
+    run_command()) and return (exit code, stderr). The stdout is thrown
+    away - "ssh -f" leaves the control connection holding it.
+    """
+
+    devnull = open(os.devnull, "r+")
+
+    try:
+        process = subprocess.Popen(command, stdin=devnull, stdout=devnull,
+                                   stderr=subprocess.PIPE, close_fds=True)
+    except OSError, error:
+        return -1, str(error)
+    finally:
+        devnull.close()
+
+    stdout, stderr = process.communicate()
+
+    return process.returncode, stderr
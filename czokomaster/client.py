@@ -0,0 +1,143 @@
+"""
+This is the client of the czokomaster daemon (see daemon.py). czokomaster.py
+hands the command given on the command line over to the daemon, if there is
+one running, and passes on whatever the daemon prints while running it. If
+there is no daemon (or "--no-daemon" is given), the command is run within
+czokomaster.py itself, just like it always was.
+
+The client imports as little as it can - neither configobj nor termcolor nor
+any plugin - as the whole point of asking the daemon is not to wait for
+these to be imported.
+
+The daemon and the client talk over the UNIX domain socket (see
+CZOKOMASTER_SOCKET) by the messages, each being a header line - the kind of
+the message and the length of what follows - and the very payload:
+
+  run 58\\n{"params": ["czokomaster", "ports", "diff", "all"], ...}
+  output 31\\n-> Available updates for www:\\n
+  exit 1\\n0
+
+The client sends "run" (or "control" - "status" or "stop") and the daemon
+answers with any number of "output" messages followed by "exit" with the
+exit code of the command (or "answer" with the answer to "control").
+"""
+
+import os
+import sys
+import json
+import socket
+
+from meta import CZOKOMASTER_SOCKET
+
+def connect(path=None):
+    """
+    Return the socket connected to the daemon or None if no daemon listens
+    on the socket (or the socket cannot be used by the user at all).
+    """
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        connection.connect(path or CZOKOMASTER_SOCKET)
+    except socket.error:
+        connection.close()
+        return None
+
+    return connection
+
+def send_message(connection, kind, payload=""):
+    """
+    Send a single message (see the top of the module).
+    """
+
+    connection.sendall("%s %d\n%s" % (kind, len(payload), payload))
+
+def read_messages(connection):
+    """
+    Yield (kind, payload) of the messages coming from the other side until
+    it closes the connection.
+    """
+
+    stream = connection.makefile("rb", 0)
+
+    try:
+        while True:
+            header = stream.readline()
+
+            if not header.endswith("\n"):
+                return
+
+            kind, length = header.split()
+            payload = stream.read(int(length))
+
+            if len(payload) != int(length):
+                return
+
+            yield kind, payload
+    finally:
+        stream.close()
+
+def forward(params):
+    """
+    Have the daemon run the command given on the command line (params are
+    the same as sys.argv) and print whatever it prints. Return the exit code
+    of the command or None if the command should be run in-process instead,
+    i.e. there is no daemon to ask, "--no-daemon" is given or the command
+    is the "daemon" command itself.
+    """
+
+    if "--no-daemon" in params or params[1:2] == ["daemon"]:
+        return None
+
+    connection = connect()
+
+    if connection is None:
+        return None
+
+    try:
+        send_message(connection, "run", json.dumps({"params": params,
+                                                    "cwd": os.getcwd(),
+                                                    "tty": sys.stdout.isatty()}))
+
+        for kind, payload in read_messages(connection):
+            if kind == "output":
+                sys.stdout.write(payload)
+                sys.stdout.flush()
+            elif kind == "exit":
+                return int(payload)
+    ## The daemon notices the connection is gone and kills the commands it
+    ## runs for us.
+    except KeyboardInterrupt:
+        return 130
+    except socket.error, error:
+        print >> sys.stderr, "Lost the connection to the daemon: %s" % error
+        return 1
+    finally:
+        connection.close()
+
+    ## The command might have been run halfway already, so it must not be
+    ## run once again in-process.
+    print >> sys.stderr, "The daemon has quit before the command was over."
+    return 1
+
+def control(request):
+    """
+    Ask the daemon to do something about itself ("status" or "stop"). Return
+    its answer or None if there is no daemon running.
+    """
+
+    connection = connect()
+
+    if connection is None:
+        return None
+
+    try:
+        send_message(connection, "control", request)
+
+        for kind, payload in read_messages(connection):
+            if kind == "answer":
+                return payload
+    finally:
+        connection.close()
+
+    return None
@@ -11,20 +11,173 @@ params[x].
 """
 
 import os
+import sys
+import errno
+import time
+import Queue
 import shlex
-import configobj
+import signal
+import threading
 import subprocess
 
+from collections import deque, namedtuple
+
+import render
+import runlog
+import backends
+import throttle
+
+from engine import (JobEngine, JobError, job_output, current_job,
+                    cancelled as _cancelled)
+from registry import get_plugins, get_command
+
 from meta import (__projectname__, 
                   __version__,
                   __copyright__,
                   CZOKOMASTER_CONFIG_PATH)
 
+## The options the config file might hold, section by section. Each option
+## is given as (type, default) - the type decides what get_config_option()
+## returns ("string", "list", "bool", "int", "float" or "path"), the default
+## is used when the option is left out of the config file. The options with
+## the REQUIRED default must be put into the config file if their section is
+## there. The sections not listed here (e.g. the ones of new plugins) are
+## read as they are.
+REQUIRED = object()
+
+CONFIG_SCHEMA = {
+    "czokomaster": {
+        "max_parallel_jails": ("int", 1),
+        "output": ("string", "auto"),
+        "command_timeout": ("int", 0),
+        "max_jobs_per_jail": ("int", 1),
+        "jails_root": ("path", "/usr/jails"),
+        "run_log": ("path", "/var/log/czokomaster/runs.log"),
+        "run_summary": ("bool", False),
+        "daemon_refresh_interval": ("int", 24),
+        "rolling_upgrade": ("bool", False),
+        "rolling_canaries": ("list", []),
+        "rolling_batch_size": ("int", 0),
+        "rolling_failure_budget": ("int", 0),
+        "rolling_jail_timeout": ("int", 0),
+        "throttle_max_load": ("float", 0.0),
+        "throttle_min_free_memory": ("int", 0),
+        "throttle_max_io_busy": ("int", 0),
+        "job_nice": ("int", 0),
+        "job_priority_cmd": ("string", ""),
+        "remote_backend": ("string", "ssh"),
+        "ssh_control_dir": ("path", "/var/cache/czokomaster/ssh"),
+        "ssh_control_persist": ("int", 600),
+        "ssh_options": ("string", "-o BatchMode=yes"),
+        "max_jobs_per_host": ("int", 0),
+        "use_inventory": ("bool", False),
+        "inventory_db": ("path", "/var/cache/czokomaster/inventory.sqlite"),
+        "inventory_ttl": ("int", 60),
+        "prefetch_before_upgrade": ("bool", False),
+        "fetch_cachedir": ("path", "/var/cache/czokomaster/fetch"),
+        "fetch_cache_size": ("int", 0),
+        "fetch_jobs": ("int", 4),
+        "fetch_jail_mountpoint": ("path", None),
+        "fetch_mount_cmd": ("string", "mount -t nullfs -o ro {source} "
+                            "{target}"),
+    },
+    "ports": {
+        "jails": ("list", REQUIRED),
+        "show_updates_cmd": ("string", REQUIRED),
+        "ports_upgrade_cmd": ("string", REQUIRED),
+        "use_package_cache": ("bool", False),
+        "package_builder": ("string", "base"),
+        "package_cachedir": ("path", "/var/cache/czokomaster/packages"),
+        "builder_package_dir": ("path", None),
+        "jail_package_dir": ("path", None),
+        "package_cache_size": ("int", 0),
+        "shared_updates_cmd": ("string", 'pkg_version -vIlo "<"'),
+        "port_options_cmd": ("string",
+                             "make -C /usr/ports/{origin} -V SELECTED_OPTIONS"),
+        "port_pkgname_cmd": ("string",
+                             "make -C /usr/ports/{origin} -V PKGNAME"),
+        "package_build_cmd": ("string", "env PACKAGES={package_dir} "
+                              "portmaster -d --no-confirm -g {origin}"),
+        "package_install_cmd": ("string", "portmaster -d --no-confirm -PP "
+                                "--local-packagedir={package_dir}/All "
+                                "{origins}"),
+        "use_build_scheduler": ("bool", False),
+        "build_jobs": ("int", 0),
+        "port_depends_cmd": ("string", "make -C /usr/ports/{origin} "
+                             "all-depends-list"),
+        "port_upgrade_cmd": ("string", "portmaster -d --no-confirm {origin}"),
+        "diff_cache_ttl": ("int", 60),
+        "diff_cachedir": ("path", "/var/cache/czokomaster/ports-diff"),
+        "diff_cache_watch": ("list", ["/var/db/pkg", "/usr/ports"]),
+        "ports_installed_cmd": ("string", "pkg_info -Qoa"),
+        "distfiles_cmd": ("string", "make -C {ports_dir}/{origin} "
+                          "-V DIST_SUBDIR -V ALLFILES"),
+        "distfile_fetch_cmd": ("string", "make -C {ports_dir}/{origin} "
+                               "DISTDIR={distdir} BATCH=yes checksum"),
+    },
+    "pippy": {
+        "jails": ("list", REQUIRED),
+        "pippy_cachedir": ("path", REQUIRED),
+        "cache_max_age": ("int", 48),
+        "update_after_upgrade": ("bool", True),
+        "py_upgrade_cmd": ("string", REQUIRED),
+        "py_batch_upgrade": ("bool", True),
+        "py_installed_cmd": ("string", "yolk -l"),
+        "site_packages": ("list", ["/usr/local/lib/python2.7/site-packages"]),
+        "upstream_ttl": ("int", 24),
+        "index_url": ("string", "https://pypi.python.org/simple/"),
+    },
+}
+
+class ConfigError(Exception):
+    """
+    Raised when the config file cannot be read or holds wrong values.
+    """
+
+## The config file is parsed once per process and kept here. It is parsed
+## again only if the file changes (i.e. its mtime does).
+_config = {"path": None, "mtime": None, "values": None}
+_config_lock = threading.Lock()
+
+## What is known about a command once it is done (see run_command()). The
+## returncode is negative if the command was killed by a signal (e.g. -15
+## once it timed out).
+CommandResult = namedtuple("CommandResult", ["command", "returncode", "stdout",
+                                             "stderr", "timed_out",
+                                             "cancelled"])
+
+## How many of the last lines of stderr of a command are kept, so even a
+## very noisy command does not eat up the memory.
+STDERR_LINES = 1000
+
+## How long (in seconds) a command is given to quit after SIGTERM before it
+## gets SIGKILL.
+KILL_GRACE = 5
+
+## The plugin and the action the current run is for (see _trigger_plugin()).
+## The commands run are tagged with them in the run log (see runlog.py).
+_run = {"plugin": None, "action": None}
+
+## Options supplied on the command line that concern czokomaster itself
+## rather than any particular plugin (e.g. "--jobs 4"). They are picked out
+## of params by _parse_global_options() before the plugin is triggered.
+_options = {}
+
 def handle_event(params):
     """
     Handle events trigerred by the user on the command line.
     """
 
+    ## Pick out the options that belong to czokomaster itself, so the plugins
+    ## get the very same params they always did.
+    params = _parse_global_options(params)
+
+    ## Whatever is printed from here on goes through the renderer (see
+    ## render.py).
+    render.select(_options.get("output"),
+                  plugin=len(params) > 1 and params[1] or None,
+                  action=len(params) > 2 and params[2] or None)
+
     ## First, get the list of registered plugins.
     plugins = _register_plugins()
 
@@ -37,6 +190,8 @@ def handle_event(params):
             _version()
         elif params[1] == "plugins":
             _list_plugins()
+        elif params[1] == "daemon":
+            _daemon(params)
         elif params[1] == "help" or params[1] not in plugins:
             _help()
         ## If the parameter is not "help", "plugins" or empty and it is
@@ -45,10 +200,21 @@ def handle_event(params):
             _trigger_plugin(params)
     except IndexError:
         _help()
+    ## Wrong config file - tell the user what is wrong with it and quit.
+    except ConfigError, error:
+        renderer = render.get()
+        renderer.item("error", renderer.bold("Config error:"), str(error))
+        sys.exit(1)
+    finally:
+        ## The run log is written down (and summed up) while the renderer of
+        ## the run is still there, not at exit.
+        runlog.finish()
+        render.finish()
+        backends.close_all()
 
 def get_config_option(section, option):
     """
-    Load the configuration file and get the particular value out of it.
+    Get the particular value out of the configuration file.
     - First, supply the section within the config file - e.g. 
       get_config_option("foo", ...) to retrieve the section
       named [foo] within the configuration file.
@@ -56,12 +222,50 @@ def get_config_option(section, option):
       get_config_option("foo", "bar") to get the value of "bar"
       variable within the "foo" section.
 
+    The value comes typed as CONFIG_SCHEMA says, e.g. "jails" is always a
+    list (even if just one jail is given) and "update_after_upgrade" is
+    True or False. The list returned is a copy, so it might be changed freely.
+    ConfigError is raised if the option is not there.
+    """
+
+    values = load_config()
+
+    try:
+        value = values[section][option]
+    except KeyError:
+        raise ConfigError("option \"%s\" is missing from the [%s] section "
+                          "of %s" % (option, section, CZOKOMASTER_CONFIG_PATH))
+
+    if isinstance(value, list):
+        return list(value)
+
+    return value
+
+def load_config():
+    """
+    Return the parsed and validated config file as a dict of sections, each
+    being a dict of options. The file is parsed once per process and then
+    only if it has changed since.
+
     configobj is used here instead of ConfigParser as the former one does not
     properly recognise comma-separated values within a variable.
     """
 
-    config = configobj.ConfigObj(CZOKOMASTER_CONFIG_PATH)
-    return config[section][option]
+    with _config_lock:
+        try:
+            mtime = os.stat(CZOKOMASTER_CONFIG_PATH).st_mtime
+        except OSError, error:
+            raise ConfigError("cannot read %s: %s" % (CZOKOMASTER_CONFIG_PATH,
+                                                       error.strerror))
+
+        if _config["values"] is None or \
+           _config["path"] != CZOKOMASTER_CONFIG_PATH or \
+           _config["mtime"] != mtime:
+            _config["values"] = _parse_config(CZOKOMASTER_CONFIG_PATH)
+            _config["path"] = CZOKOMASTER_CONFIG_PATH
+            _config["mtime"] = mtime
+
+        return _config["values"]
 
 def normalize_params(config_section, config_option, params):
     """
@@ -88,8 +292,9 @@ def normalize_params(config_section, config_option, params):
     # from the command line.
     else:
         # Upgrade only the jails specified on the command line. They should
-        # start from the 4th argument of params (params[3:]).
-        jails = params[3:]
+        # start from the 4th argument of params (params[3:]). Anything that
+        # starts with "--" is a flag for the plugin, not a jail.
+        jails = [param for param in params[3:] if not param.startswith("--")]
 
         # If "jails" variable is empty, no argument was supplied on the 
         # command line, print help in such a case.
@@ -98,7 +303,114 @@ def normalize_params(config_section, config_option, params):
 
     return jails
 
-def execute_command(commands=[], func_return=False):
+def jail_command(jail, command):
+    """
+    Return the command that runs "command" within the given jail. The base
+    system needs no jexec, so the command is returned untouched for "base".
+    The commands of the systems of another host ("host:jail", see
+    backends.py) are run there by the backend of the host.
+    """
+
+    host, name = backends.split_target(jail)
+
+    if name != "base":
+        command = "jexec %s %s" % (name, command)
+
+    if host is not None:
+        return backends.get_backend(host).command(command)
+
+    return command
+
+def jail_root(jail):
+    """
+    Return the path to the root directory of the jail as seen from the host
+    (i.e. "/" for the base system) or None if the jail is on another host,
+    so its files cannot be reached from here.
+    """
+
+    host, name = backends.split_target(jail)
+
+    if host is not None:
+        return None
+
+    if name == "base":
+        return os.sep
+
+    return os.path.join(get_config_option("czokomaster", "jails_root"), name)
+
+def describe_jail(jail):
+    """
+    Return the name of the system as it should be shown to the user, i.e.
+    "the base system" for "base" and the name of the jail otherwise ("the
+    base system of host" and "host:jail" for the systems of another host).
+    """
+
+    if jail == "base":
+        return "the base system"
+
+    host, name = backends.split_target(jail)
+
+    if name == "base":
+        return "the base system of %s" % host
+
+    return jail
+
+def get_max_parallel_jails():
+    """
+    Return how many jails may be processed at the same time. "--jobs N"
+    supplied on the command line wins over "max_parallel_jails" from the
+    [czokomaster] section of the config file. If neither is given, the jails
+    are processed one after another, just as they always were.
+    """
+
+    if "jobs" in _options:
+        return _options["jobs"]
+
+    return max(1, get_config_option("czokomaster", "max_parallel_jails"))
+
+def new_engine(jobs=None, max_per_jail=None):
+    """
+    Return a new JobEngine (see czokomaster.engine) the plugins might submit
+    their jobs to. It runs at most "jobs" jobs at the same time
+    (get_max_parallel_jails() is asked if "jobs" is not given) and at most
+    "max_per_jail" ("max_jobs_per_jail" from the config file if it is not
+    given) within a single jail and "max_jobs_per_host" on a single host. A
+    new job of a jail is not started while the host is too busy (see the
+    "throttle_*" options and throttle.py).
+    """
+
+    if jobs is None:
+        jobs = get_max_parallel_jails()
+
+    if max_per_jail is None:
+        max_per_jail = get_config_option("czokomaster", "max_jobs_per_jail")
+
+    return JobEngine(jobs, max_per_jail, throttle.from_config(),
+                     get_config_option("czokomaster", "max_jobs_per_host"))
+
+def run_in_jails(jails, function, jobs=None):
+    """
+    Call function(jail) for every jail on the list, at most "jobs" of them at
+    the same time (get_max_parallel_jails() is asked if "jobs" is not given).
+
+    Whatever a jail prints - either by "print" or through execute_command() -
+    is held back while the jails are processed in parallel and then printed in
+    one piece, in the very order the jails are listed (i.e. the config order).
+    If the function fails for one jail, the error is printed and the rest of
+    the jails are processed anyway.
+
+    Return the list of (jail, result, error) tuples, one per jail, in order.
+    "error" is None if the function went fine for the given jail.
+    """
+
+    engine = new_engine(jobs)
+
+    for jail in jails:
+        engine.submit(function, jail, name=describe_jail(jail), jail=jail)
+
+    return [(job.jail, job.result, job.error) for job in engine.run()]
+
+def execute_command(commands=[], func_return=False, timeout=None):
     """
     Helper responsible for executing commands. Iterate through the list
     of commands and execute each of them.
@@ -114,47 +426,510 @@ def execute_command(commands=[], func_return=False):
     Supply the 'func_return' argument in order to decide whether the function
     should print the output of the process it starts (func_return=False) or
     whether the value should be returned to the function that invokes 
-    execute_command (func_return=True).
+    execute_command (func_return=True). In the latter case, the stdout and
+    the stderr of all the commands are returned - a command that has failed
+    (exited with an error, timed out, ...) with nothing on stderr leaves a
+    line there saying so, so the stderr is empty only if every command has
+    gone fine. Otherwise, the output is printed as it comes and the list of
+    the exit codes of the commands is returned.
+
+    Each command is killed if it runs for longer than "timeout" seconds
+    ("command_timeout" from the [czokomaster] section of the config file is
+    used if "timeout" is not given; 0 means no limit) or once the time limit
+    of the job it is run by is up (see engine.py) - the commands that come
+    after that are not run at all.
     """
 
+    if timeout is None:
+        timeout = get_config_option("czokomaster", "command_timeout")
+
+    results = []
+    renderer = render.get()
+
+    for command in commands:
+        limit = _time_left(timeout)
+
+        if limit is None:
+            current_job().timed_out = True
+            renderer.item("error", "\"%s\" not run, the time limit of %s is "
+                          "up." % (command, current_job().name),
+                          jail=_command_tags(command)["jail"])
+            results.append(CommandResult(command, -signal.SIGTERM, "", "",
+                                         True, False))
+            continue
+
+        if func_return:
+            result = run_command(command, capture=True, timeout=limit)
+        elif job_output.capturing() or not renderer.passes_output:
+            # The jail is processed in parallel with others (see
+            # run_in_jails()) or the output is not to be printed as it is
+            # (see render.py), so the output is passed on line by line and
+            # printed together with the rest of what the jail prints.
+            jail = _command_tags(command)["jail"]
+            result = run_command(command, timeout=limit,
+                                 on_line=lambda line, stream: \
+                                         renderer.output(line, stream,
+                                                         jail=jail))
+        else:
+            result = run_command(command, timeout=limit)
+
+        if result.timed_out:
+            # Killed by the time limit of the job rather than by
+            # "command_timeout" (see rollout.py).
+            job = current_job()
+
+            if job is not None and job.deadline is not None and \
+               time.time() >= job.deadline:
+                job.timed_out = True
+
+            renderer.item("error", "\"%s\" timed out after %d second(s)." % \
+                          (command, round(limit)),
+                          jail=_command_tags(command)["jail"])
+        elif result.cancelled:
+            renderer.item("error", "\"%s\" cancelled." % command,
+                          jail=_command_tags(command)["jail"])
+
+        results.append(result)
+
     if func_return:
-        for command in commands:
-           output = subprocess.Popen(shlex.split(command), \
-                    stdout=subprocess.PIPE)
-           stdout, stderr = output.communicate()
-           return stdout, stderr
+        return "".join([result.stdout for result in results]), \
+               "".join([result.stderr or (result.returncode != 0 and \
+                                          "\"%s\" has failed (exit code "
+                                          "%d).\n" % (result.command,
+                                                      result.returncode) or \
+                                          "") for result in results])
+
+    return [result.returncode for result in results]
+
+def run_command(command, on_line=None, capture=False, timeout=0, cancel=None):
+    """
+    Run a single command and return its CommandResult.
+
+    - on_line - function called with (line, "stdout"|"stderr") for every line
+                of the output as soon as the line comes;
+    - capture - whether stdout should be kept and returned in the result
+                (only the last STDERR_LINES lines of stderr are kept anyway);
+    - timeout - after how many seconds the command is killed (0 - never);
+    - cancel - threading.Event; the command is killed once it is set.
+
+    If neither on_line nor capture is given, the command simply writes to the
+    terminal, just like it would if run by hand.
+
+    Every command leaves a record in the run log (see runlog.py): its wall
+    time, exit code, CPU time and peak memory, tagged with the plugin, the
+    action and the jail it was run for.
+    """
+
+    started = time.time()
+
+    piped = capture or on_line is not None
+
+    # The command gets its own process group, so it can be killed together
+    # with whatever it starts. Without a terminal (e.g. run by cron or by the
+    # daemon), there is no one to send Ctrl-C to whatever the command starts
+    # either, so it gets its own process group as well. Otherwise, it is
+    # left in the foreground, so it can talk to the user.
+    group = piped or not os.isatty(0)
+
+    # The commands might be run with a lower priority, so the services of
+    # the jails do not suffer (see "job_nice" and "job_priority_cmd").
+    args = shlex.split(get_config_option("czokomaster", "job_priority_cmd")) + \
+           shlex.split(command)
+    nice = get_config_option("czokomaster", "job_nice")
+
+    if piped:
+        process = subprocess.Popen(args,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   close_fds=True,
+                                   preexec_fn=lambda: _prepare_child(group,
+                                                                     nice))
     else:
-        for command in commands:
-            output = subprocess.Popen(shlex.split(command))
-            output.communicate()
+        process = subprocess.Popen(args,
+                                   preexec_fn=lambda: _prepare_child(group,
+                                                                     nice))
+
+    stdout = []
+    stderr = deque(maxlen=STDERR_LINES)
+    lines = Queue.Queue()
+    open_pipes = 0
+
+    if piped:
+        for stream, pipe in (("stdout", process.stdout),
+                             ("stderr", process.stderr)):
+            thread = threading.Thread(target=_read_lines,
+                                      args=(pipe, stream, lines))
+            thread.daemon = True
+            thread.start()
+            open_pipes += 1
+
+    deadline = time.time() + timeout if timeout else None
+    timed_out = cancelled = False
+
+    while open_pipes or _wait(process) is None:
+        if not timed_out and deadline is not None and time.time() > deadline:
+            timed_out = True
+            _kill(process, group)
+        elif not cancelled and (_cancelled.is_set() or \
+                                (cancel is not None and cancel.is_set())):
+            cancelled = True
+            _kill(process, group)
+
+        # Whatever the killed command started might still hold the pipes,
+        # do not wait for them.
+        if (timed_out or cancelled) and _wait(process) is not None:
+            break
+
+        if not open_pipes:
+            time.sleep(0.05)
+            continue
+
+        try:
+            stream, line = lines.get(True, 0.1)
+        except Queue.Empty:
+            continue
+
+        if line is None:
+            open_pipes -= 1
+            continue
+
+        if stream == "stderr":
+            stderr.append(line)
+        elif capture:
+            stdout.append(line)
+
+        if on_line is not None:
+            on_line(line, stream)
+
+    returncode = _wait(process, True)
+
+    runlog.record(command, returncode, time.time() - started,
+                  getattr(process, "rusage", None), _command_tags(command),
+                  timed_out, cancelled)
+
+    return CommandResult(command, returncode, "".join(stdout),
+                         "".join(stderr), timed_out, cancelled)
+
+def cancel_commands():
+    """
+    Kill every command that is running and do not let any new one run.
+    """
 
-def _register_plugins():
+    _cancelled.set()
+
+def end_run():
+    """
+    The run is over: write its run log down (see runlog.py), close the
+    control connections to the other hosts (see backends.py) and forget
+    everything it has set up - the options given on the command line, the
+    plugin and the action, the cancelled commands. There is nothing to be
+    done about it when czokomaster quits after a single run, yet the daemon
+    (see daemon.py) goes through many runs within the same process.
+    """
+
+    runlog.finish()
+    render.reset()
+    backends.close_all()
+
+    _options.clear()
+    _run["plugin"] = _run["action"] = None
+    _cancelled.clear()
+
+def _prepare_child(group, nice):
+    """
+    Called within the child process right before the command is started.
+    """
+
+    if group:
+        os.setpgrp()
+
+    if nice:
+        os.nice(nice)
+
+def _time_left(timeout):
+    """
+    Return the timeout of the next command: "timeout", cut down to whatever
+    is left of the time limit of the job the command is run by. None is
+    returned if the time limit is up already.
+    """
+
+    job = current_job()
+
+    if job is None or job.deadline is None:
+        return timeout
+
+    left = job.deadline - time.time()
+
+    if left <= 0:
+        return None
+
+    return min(timeout, left) if timeout else left
+
+def _wait(process, block=False):
+    """
+    Return the exit code of the process or None if it is still running
+    (wait for it to quit if "block" is given). Unlike process.poll(), the
+    process is reaped by os.wait4(), so its resource usage is known - it is
+    kept in process.rusage.
+    """
+
+    while process.returncode is None:
+        try:
+            pid, status, usage = os.wait4(process.pid,
+                                          0 if block else os.WNOHANG)
+        except OSError, error:
+            if error.errno == errno.EINTR:
+                continue
+            ## Reaped by someone else already, so the exit code is lost.
+            process.returncode = 0 if error.errno == errno.ECHILD else -1
+            break
+
+        if pid != process.pid:
+            return None
+
+        process.rusage = usage
+
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+
+    return process.returncode
+
+def _command_tags(command):
+    """
+    Return the tags of the command for the run log: the plugin and the
+    action of the run, the jail the command is run in and the job of the
+    engine (see engine.py) it is run by.
+    """
+
+    job = current_job()
+    jail = job.jail if job is not None else None
+
+    ## The commands run outside of the jobs still name the jail they are run
+    ## in (see jail_command()) - within the command handed over to the
+    ## backend, if the jail is on another host.
+    if jail is None:
+        host, command = backends.unwrap(command)
+        words = command.split()
+        jail = words[1] if len(words) > 1 and words[0] == "jexec" else "base"
+
+        if host is not None:
+            jail = "%s:%s" % (host, jail)
+
+    return {"plugin": _run["plugin"] or \
+                      os.path.basename(sys.argv[0]).rsplit(".", 1)[0],
+            "action": _run["action"],
+            "jail": jail,
+            "job": job.name if job is not None else None}
+
+def _read_lines(pipe, stream, lines):
+    """
+    Put the lines read from the pipe on the "lines" queue as they come.
+    None is put there once the pipe is closed.
+    """
+
+    for line in iter(pipe.readline, ""):
+        lines.put((stream, line))
+
+    pipe.close()
+    lines.put((stream, None))
+
+def _kill(process, group):
+    """
+    Ask the process (or its whole process group) to quit. Kill it if it does
+    not quit within KILL_GRACE seconds.
+    """
+
+    def send(signum):
+        try:
+            if group:
+                os.killpg(process.pid, signum)
+            else:
+                os.kill(process.pid, signum)
+        except OSError:
+            pass
+
+    send(signal.SIGTERM)
+    deadline = time.time() + KILL_GRACE
+
+    while _wait(process) is None and time.time() < deadline:
+        time.sleep(0.05)
+
+    if _wait(process) is None:
+        send(signal.SIGKILL)
+
+def _parse_config(path):
     """
-    Register the plugins by iterating over the plugins dir.
-    Also, the name of the plugin should be the first argument supplied
-    by the user for czokomaster. E.g. czokomaster testplugin help shall
-    show help for the testplugin plugin.
+    Parse the config file and check it against CONFIG_SCHEMA. The unknown
+    options are reported, the missing required options and the values of a
+    wrong type raise ConfigError. Return the dict of the typed values.
     """
 
-    ## Initialize plugins variable to which the available plugins
-    ## will be appended.
-    plugins = []
+    ## configobj is imported only once the config file is needed, so e.g.
+    ## "czokomaster plugins" does not wait for it.
+    import configobj
 
-    ## Iterate over plugins, leave out __init__.py and *pyc files. Also,
-    ## cut off the .py extensions. 
-    for plugin in os.listdir(os.path.join(\
-                  os.path.dirname(os.path.abspath(__file__)), 'plugins')):
-        if plugin != "__init__.py" and plugin.endswith('.py'):
-            plugins.append(plugin[:-3])
+    try:
+        config = configobj.ConfigObj(path, interpolation=False,
+                                     file_error=True)
+    except (IOError, configobj.ConfigObjError), error:
+        raise ConfigError("cannot parse %s: %s" % (path, error))
+
+    values = {}
+    errors = []
+
+    for section in config.sections:
+        schema = CONFIG_SCHEMA.get(section)
+        values[section] = {}
+
+        for option, value in config[section].items():
+            if schema is None:
+                values[section][option] = value
+            elif option not in schema:
+                print >> sys.stderr, "%s: unknown option \"%s\" in the [%s]" \
+                      " section of %s" % (__projectname__, option, section,
+                                          path)
+                values[section][option] = value
+            else:
+                try:
+                    values[section][option] = _convert_option(schema[option][0],
+                                                              value)
+                except ValueError, error:
+                    errors.append("wrong value of \"%s\" in the [%s] section:"
+                                  " %s" % (option, section, error))
+
+        # Fill in the defaults and note the required options that are
+        # missing.
+        for option, (kind, default) in (schema or {}).items():
+            if option in values[section]:
+                continue
+
+            if default is REQUIRED:
+                errors.append("option \"%s\" is missing from the [%s] "
+                              "section" % (option, section))
+            else:
+                values[section][option] = default
+
+    # The sections that are not in the config file at all still get their
+    # defaults, so e.g. [czokomaster] might be left out.
+    for section, schema in CONFIG_SCHEMA.items():
+        if section not in values:
+            values[section] = dict([(option, default) for option, \
+                                    (kind, default) in schema.items() \
+                                    if default is not REQUIRED])
+
+    if errors:
+        raise ConfigError("%s:\n    %s" % (path, "\n    ".join(errors)))
+
+    return values
+
+def _convert_option(kind, value):
+    """
+    Convert the value read from the config file to the given type.
+    """
+
+    if kind == "list":
+        if isinstance(value, list):
+            return value
+        return [value] if value else []
+
+    # Commands might hold commas, which configobj reads as lists.
+    if isinstance(value, list):
+        value = ", ".join(value)
+
+    if kind == "bool":
+        if value.lower() in ("yes", "true", "on", "1"):
+            return True
+        if value.lower() in ("no", "false", "off", "0"):
+            return False
+        raise ValueError("\"%s\" is neither yes nor no" % value)
+
+    if kind == "int":
+        return int(value)
+
+    if kind == "float":
+        return float(value)
+
+    ## An empty path means the thing is not wanted at all (e.g. no run log).
+    if kind == "path":
+        return os.path.normpath(os.path.expanduser(value)) if value else None
+
+    return value
+
+def _parse_global_options(params):
+    """
+    Pick the options that concern czokomaster itself out of params and
+    store them in _options. Return the rest of params untouched. So far:
+
+    - --jobs N (or -j N, --jobs=N) - how many jails may be processed at the
+      same time (see get_max_parallel_jails());
+    - --no-daemon - run the command here even if the daemon is running (see
+      client.py), there is nothing else to be done about it here;
+    - --output NAME (or --output=NAME) - how the run is printed (see
+      render.py), "output" of the config file otherwise.
+    """
+
+    rest = []
+    params = list(params)
+
+    while params:
+        param = params.pop(0)
+
+        if param in ("--jobs", "-j") and params:
+            value = params.pop(0)
+        elif param.startswith("--jobs="):
+            value = param.split("=", 1)[1]
+        elif param == "--no-daemon":
+            continue
+        elif param == "--output" and params:
+            _set_output(params.pop(0))
+            continue
+        elif param.startswith("--output="):
+            _set_output(param.split("=", 1)[1])
+            continue
+        else:
+            rest.append(param)
+            continue
+
+        ## A value that is not a number is simply ignored.
+        try:
+            _options["jobs"] = max(1, int(value))
+        except ValueError:
+            pass
 
-    return plugins
+    return rest
+
+def _set_output(name):
+    """
+    Keep the renderer given on the command line, unless there is no such
+    renderer (it is simply ignored then, just like --jobs that is not a
+    number).
+    """
+
+    if name in render.RENDERERS or name == "auto":
+        _options["output"] = name
+
+def _register_plugins():
+    """
+    Return the names of the registered plugins. The name of the plugin
+    should be the first argument supplied by the user for czokomaster. E.g.
+    czokomaster testplugin help shall show help for the testplugin plugin.
+
+    The plugins are not imported here, they are described by the manifest
+    kept by the registry (see registry.py) - the plugins dir is looked into
+    only if it has changed since the manifest was made.
+    """
+
+    return sorted(get_plugins().keys())
 
 def _version():
     """
     Print simple czokomaster info - name, version, copyright.
     """
 
-    print "%s version %s %s\n" % (__projectname__, __version__, __copyright__)
+    render.get().text("%s version %s %s\n" % (__projectname__, __version__,
+                                              __copyright__))
 
 def _help():
     """
@@ -162,24 +937,63 @@ def _help():
     """
 
     _version()
-    print "Usage: %s <plugin> <option>\n" \
-          "For the list of available plugins type: %s plugins" \
-          % (__projectname__, __projectname__)
+    render.get().text("Usage: %s <plugin> <option>\n"
+                      "For the list of available plugins type: %s plugins\n"
+                      "To keep %s running in the background: %s daemon "
+                      "[start|status|stop]" % \
+                      (__projectname__, __projectname__, __projectname__,
+                       __projectname__))
+
+def _daemon(params):
+    """
+    Run the daemon (see daemon.py) or ask the one that is running how it is
+    doing or to stop.
+    """
+
+    ## Imported only here, so the plugins do not pay for it.
+    import client
+    import daemon
+
+    action = params[2] if len(params) > 2 else "start"
+
+    if action == "start":
+        try:
+            daemon.serve()
+        except daemon.DaemonError, error:
+            renderer = render.get()
+            renderer.item("error", renderer.bold("Daemon error:"), str(error))
+            sys.exit(1)
+    elif action in ("status", "stop"):
+        answer = client.control(action)
+
+        if answer is None:
+            render.get().item("error", "The daemon is not running.")
+            sys.exit(1)
+
+        daemon.print_answer(answer)
+    else:
+        _help()
 
 def _list_plugins():
     """
-    List the available plugins for czokomaster.
+    List the available plugins for czokomaster, together with their versions
+    and commands.
     """
 
     _version()
-    print "Plugins available for %s:" % __projectname__
 
-    ## Get the list of available plugins, iterate and print
-    ## in stdout.
-    plugins = _register_plugins()
+    renderer = render.get()
+    renderer.text("Plugins available for %s:" % __projectname__)
+
+    ## Get the plugins out of the manifest, iterate and print them.
+    plugins = get_plugins()
+
+    for name in sorted(plugins):
+        plugin = plugins[name]
 
-    for plugin in plugins:
-        print "    - %s" % plugin
+        renderer.text("    - %s%s: %s" % (name, plugin["version"] and \
+                                          " (%s)" % plugin["version"] or "",
+                                          ", ".join(plugin["commands"])))
 
 def _trigger_plugin(params):
     """
@@ -187,22 +1001,21 @@ def _trigger_plugin(params):
     the plugin.
     """
 
-    try:
-        ## Import the plugin supplied on the command line.
-        plugin = __import__("czokomaster.plugins.%s" % params[1], globals(),
-                            locals(), ["%s" % params[2]], -1)
-
-        ## Invoke a method (also supplied on the command line) on the
-        ## plugin. Invoking itself is done by "(params)" at the end.
-        getattr(plugin, params[2])(params)
-
-    ## If params[2] is not supplied on the command line, the method of 
-    ## the plugin cannot be invoked. Thus, print help of the plugin. 
-    ## Help is accessed through plugin.help(). In order to do this, the
-    ## module must be imported and "help" must be supplied as an 
-    ## argument.
-    except (IndexError, AttributeError):
-        plugin = __import__("czokomaster.plugins.%s" % params[1], globals(),
-                            locals(), ["help"], -1)
-
-        getattr(plugin, "help")(params)
\ No newline at end of file
+    ## Find the method of the plugin (also supplied on the command line).
+    ## Only then is the plugin imported - and only this one plugin.
+    command = None
+
+    if len(params) > 2:
+        command = get_command(params[1], params[2])
+
+    ## If params[2] is not supplied on the command line or there is no such
+    ## method within the plugin, the method cannot be invoked. Thus, print
+    ## help of the plugin. Help is accessed through plugin.help().
+    if command is None:
+        command = get_command(params[1], "help")
+
+    _run["plugin"] = params[1]
+    _run["action"] = params[2] if len(params) > 2 else "help"
+
+    ## Invoke the method. Invoking itself is done by "(params)" at the end.
+    command(params)
@@ -0,0 +1,431 @@
+"""
+This is the daemon of czokomaster. Every run of czokomaster starts python
+anew - imports configobj and termcolor, parses the config file, looks the
+plugins up, imports the plugin asked for. It does not matter for "ports
+upgrade", it does for "ports diff" and "pippy diff" run every few minutes by
+the monitoring. The daemon does all of this once and keeps it: the config
+file (parsed again only once it changes), the manifest of the plugins and
+the plugins imported so far. It is started with:
+
+  # czokomaster daemon
+
+(in the foreground - daemon(8) or an rc.d script might send it to the
+background) and listens on the UNIX domain socket (see CZOKOMASTER_SOCKET),
+which only root may use, as the daemon runs whatever it is asked as root.
+From then on, czokomaster.py hands every command over to the daemon (see
+client.py) and prints whatever the daemon prints while running it. The
+commands are run one at a time, in the order they come, with the working
+dir of the client and the environment of the daemon.
+
+The daemon also refreshes the pippy caches every "daemon_refresh_interval"
+hours (see the config file), so there is no need for the pippy cron helper
+in crontab anymore.
+
+  # czokomaster daemon status
+  # czokomaster daemon stop
+
+tell how the daemon is doing and stop it (so does SIGTERM). Once czokomaster
+itself is upgraded, the daemon should be restarted, as it keeps running the
+code it has started with.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import threading
+import traceback
+
+from StringIO import StringIO
+
+import render
+
+from meta import __projectname__, CZOKOMASTER_SOCKET
+from client import send_message, read_messages
+from czokomanager import (handle_event, end_run, cancel_commands,
+                          get_config_option, ConfigError)
+
+## How often (in seconds) the daemon checks whether the pippy caches are due
+## for a refresh.
+REFRESH_CHECK = 60
+
+class DaemonError(Exception):
+    """
+    Raised when the daemon cannot be started.
+    """
+
+## Held while a command (or a refresh) is run - they are run one at a time,
+## as each of them has got the whole stdout of the daemon to itself.
+_busy = threading.Lock()
+
+## Set once the daemon is asked to stop.
+_stopping = threading.Event()
+
+## What "czokomaster daemon status" tells.
+_state = {"started": None, "served": 0, "running": None,
+          "last_refresh": None, "next_refresh": None}
+
+## The stderr of the daemon itself, as fd 1 and 2 belong to the command that
+## is run at the moment.
+_console = {"stream": sys.stderr}
+
+def serve(path=None):
+    """
+    Run the daemon until it is asked to stop.
+    """
+
+    path = path or CZOKOMASTER_SOCKET
+    server = _listen(path)
+
+    _console["stream"] = os.fdopen(os.dup(2), "w", 0)
+    _state["started"] = time.time()
+
+    ## The commands must not wait for any input - there is no one to type it.
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: _stopping.set())
+
+    refresher = threading.Thread(target=_refresh_loop)
+    refresher.daemon = True
+    refresher.start()
+
+    _log("listening on %s" % path)
+
+    try:
+        while not _stopping.is_set():
+            try:
+                connection, address = server.accept()
+            except socket.timeout:
+                continue
+            except socket.error, error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            connection.settimeout(None)
+
+            thread = threading.Thread(target=_serve_connection,
+                                      args=(connection,))
+            thread.daemon = True
+            thread.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+        if os.path.exists(path):
+            os.remove(path)
+
+    ## Let the command that is run at the moment finish.
+    with _busy:
+        _log("stopped")
+
+def _listen(path):
+    """
+    Return the server socket bound to the given path. A socket left behind
+    by a daemon that is gone is removed, a daemon that is still there is not
+    disturbed.
+    """
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.remove(path)
+        else:
+            raise DaemonError("the daemon is running already (%s)" % path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    ## Only root may talk to the daemon - from the very moment the socket is
+    ## there.
+    umask = os.umask(0077)
+
+    try:
+        server.bind(path)
+    except socket.error, error:
+        raise DaemonError("cannot listen on %s: %s" % (path, error))
+    finally:
+        os.umask(umask)
+
+    server.listen(16)
+    server.settimeout(1)
+
+    return server
+
+def _serve_connection(connection):
+    """
+    Answer whatever the client asks for.
+    """
+
+    try:
+        for kind, payload in read_messages(connection):
+            if kind == "run":
+                _run(connection, json.loads(payload))
+            elif kind == "control":
+                send_message(connection, "answer", _control(payload))
+
+            break
+    except socket.error:
+        pass
+    except Exception:
+        _log("the request has failed:\n%s" % traceback.format_exc())
+    finally:
+        connection.close()
+
+def _control(request):
+    """
+    Return the answer to "czokomaster daemon status" or "stop" - a JSON
+    document the client prints through its own renderer (see
+    print_answer()).
+    """
+
+    if request == "stop":
+        _stopping.set()
+        return json.dumps({"stopping": True})
+
+    return json.dumps({"pid": os.getpid(), "started": _state["started"],
+                       "served": _state["served"],
+                       "running": _state["running"],
+                       "last_refresh": _state["last_refresh"],
+                       "next_refresh": _state["next_refresh"]})
+
+def print_answer(answer):
+    """
+    Print the answer of the daemon to "status" or "stop" (see _control()).
+    """
+
+    answer = json.loads(answer)
+    renderer = render.get()
+
+    if answer.get("stopping"):
+        renderer.item("ok", "The daemon is stopping.")
+        return
+
+    renderer.item("ok", renderer.bold("The daemon is running:"))
+    renderer.text("    pid: %d, up since %s" % \
+                  (answer["pid"], render.format_time(answer["started"])))
+    renderer.text("    commands served: %d" % answer["served"])
+    renderer.text("    running: %s" % (answer["running"] and \
+                                       " ".join(answer["running"]) or \
+                                       "nothing"))
+    renderer.text("    pippy caches refreshed: %s, next refresh: %s" % \
+                  (render.format_time(answer["last_refresh"]),
+                   render.format_time(answer["next_refresh"])))
+
+def _run(connection, request):
+    """
+    Run the command the client has asked for and send it whatever the
+    command prints, then the exit code of the command.
+    """
+
+    params = request["params"]
+
+    if not _busy.acquire(False):
+        ## The renderer of the run going on is not this client's, so the
+        ## line is rendered by a renderer of its own.
+        waiting = StringIO()
+        render.new(tty=request.get("tty")).item(
+            "warning", "Waiting for \"%s\" to finish..." % \
+            " ".join(_state["running"] or []), to=waiting)
+
+        send_message(connection, "output", waiting.getvalue())
+        _busy.acquire()
+
+    try:
+        _state["running"] = params[1:]
+        code = _redirected(connection, lambda: _execute(params,
+                                                        request.get("cwd"),
+                                                        request.get("tty")))
+        _state["served"] += 1
+    finally:
+        _state["running"] = None
+        _busy.release()
+
+    send_message(connection, "exit", str(code))
+
+def _redirected(connection, function):
+    """
+    Call the function with the stdout and the stderr of the daemon (i.e. fd
+    1 and 2, so the commands it starts are covered as well) sent over the
+    connection. Return whatever the function returns.
+    """
+
+    read_end, write_end = os.pipe()
+    saved = [os.dup(1), os.dup(2)]
+
+    sys.stdout.flush()
+    os.dup2(write_end, 1)
+    os.dup2(write_end, 2)
+    os.close(write_end)
+
+    ## Line by line, so what the daemon prints and what the commands print
+    ## comes in the right order.
+    stdout = sys.stdout
+    sys.stdout = os.fdopen(os.dup(1), "w", 1)
+
+    pump = threading.Thread(target=_pump, args=(read_end, connection))
+    pump.start()
+
+    try:
+        return function()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+        ## The pipe is closed once the commands started are gone as well.
+        pump.join()
+
+def _pump(read_end, connection):
+    """
+    Send whatever comes through the pipe to the client. If the client goes
+    away (e.g. the user hits Ctrl-C), the commands are killed - yet the pipe
+    is still read till its end, so no command is left hanging on it.
+    """
+
+    gone = False
+
+    while True:
+        readable = select.select([read_end] + (not gone and [connection] or \
+                                               []), [], [])[0]
+
+        if connection in readable:
+            try:
+                data = connection.recv(4096)
+            except socket.error:
+                data = ""
+
+            if not data:
+                gone = True
+                cancel_commands()
+
+        if read_end not in readable:
+            continue
+
+        data = os.read(read_end, 65536)
+
+        if not data:
+            break
+
+        if not gone:
+            try:
+                send_message(connection, "output", data)
+            except socket.error:
+                gone = True
+                cancel_commands()
+
+    os.close(read_end)
+
+def _execute(params, cwd=None, tty=None):
+    """
+    Run the command just like czokomaster.py would. Return its exit code.
+    "tty" tells whether the client prints to a terminal - stdout of the
+    daemon is never one (see render.py).
+    """
+
+    code = 0
+    saved_cwd = os.getcwd()
+
+    try:
+        if cwd and os.path.isdir(cwd):
+            os.chdir(cwd)
+
+        render.assume_tty(tty)
+
+        handle_event(params)
+    except SystemExit, error:
+        if isinstance(error.code, (int, long)) or error.code is None:
+            code = error.code or 0
+        else:
+            print >> sys.stderr, error.code
+            code = 1
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    finally:
+        ## Nothing the command has set up is left for the next one - the
+        ## working directory of the client included.
+        end_run()
+        os.chdir(saved_cwd)
+
+    return code
+
+def _refresh_loop():
+    """
+    Refresh the pippy caches whenever they are due, see _refresh().
+    """
+
+    while True:
+        try:
+            _refresh()
+        except Exception:
+            _log("the refresh has failed:\n%s" % traceback.format_exc())
+
+        if _stopping.wait(REFRESH_CHECK):
+            return
+
+def _refresh():
+    """
+    Refresh the pippy caches (just like the pippy cron helper does), provided
+    the last refresh - by the daemon, the cron helper or "pippy upgrade" -
+    took place more than "daemon_refresh_interval" hours ago.
+    """
+
+    try:
+        interval = get_config_option("czokomaster",
+                                     "daemon_refresh_interval") * 3600
+        inventory = os.path.join(get_config_option("pippy", "pippy_cachedir"),
+                                 ".inventory")
+    ## No pippy in the config file, nothing to refresh.
+    except ConfigError:
+        _state["next_refresh"] = None
+        return
+
+    if interval <= 0:
+        _state["next_refresh"] = None
+        return
+
+    last = max(os.path.exists(inventory) and os.path.getmtime(inventory) or 0,
+               _state["last_refresh"] or 0)
+    _state["next_refresh"] = last + interval
+
+    if time.time() < last + interval:
+        return
+
+    ## Imported here, as the plugins are imported only once needed.
+    from czokomaster.plugins.plugin_helpers.pippy_cron_helper import \
+         PythonUpdateChecker
+
+    with _busy:
+        _state["running"] = ["pippy", "refresh"]
+        _state["last_refresh"] = time.time()
+        _state["next_refresh"] = _state["last_refresh"] + interval
+        _log("refreshing the pippy caches")
+
+        try:
+            PythonUpdateChecker().get_updates()
+        finally:
+            _state["running"] = None
+            end_run()
+
+        _log("the pippy caches refreshed in %.1f second(s)" % \
+             (time.time() - _state["last_refresh"]))
+
+def _log(message):
+    print >> _console["stream"], "%s [%s] %s" % \
+          (__projectname__, render.format_time(time.time()), message)
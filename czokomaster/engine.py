@@ -0,0 +1,402 @@
+"""
+This is the job engine of czokomaster. The plugins submit the steps of their
+work (e.g. "update the ports tree" or "show the updates of jail db") to the
+engine as jobs, each together with the jobs it has to wait for. The engine
+then runs the jobs that do not depend on each other at the same time - yet
+never more than max_jobs of them at once, never more than max_per_jail of
+them within a single jail and never more than max_per_host of them on a
+single host (see backends.py) - nor while this host is too busy for another
+one (see throttle.py). The jobs are spread over the hosts, so the jails of
+every host are worked on at the same time.
+
+Whatever a job prints - either by "print" or through execute_command() - is
+held back and printed in one piece, in the very order the jobs have been
+submitted. Thus, the output looks just like the jobs were run one after
+another.
+
+asyncio is not there for python 2, hence the jobs are run in threads. They
+spend all their time waiting for the commands they start anyway.
+"""
+
+import sys
+import time
+import Queue
+import threading
+import traceback
+
+from StringIO import StringIO
+
+import render
+
+from backends import host_of, BackendError
+
+## Once set, every running command is killed and every new one is cancelled
+## right away (see czokomanager.cancel_commands()).
+cancelled = threading.Event()
+
+## The job each thread is running at the moment (see current_job()).
+_current = threading.local()
+
+class JobError(Exception):
+    """
+    Raised by a job that cannot go on for a reason it knows of, e.g. the
+    command it has asked something has failed. It is no bug of czokomaster,
+    so no traceback is printed for it.
+    """
+
+def current_job():
+    """
+    Return the Job the calling thread is running or None if it is not
+    running any (e.g. the main thread before the engine is run).
+    """
+
+    return getattr(_current, "job", None)
+
+class Job(object):
+    """
+    A single step submitted to the engine.
+
+    - state - "pending", "running", "done", "failed" or "skipped" (the latter
+              if any of the jobs it waits for has not gone fine);
+    - result - whatever the function has returned;
+    - error - the exception the function has raised, if any;
+    - deadline - when the time limit of the job is up (unix time), if it has
+                 got one - the commands it runs are killed then;
+    - timed_out - whether any of its commands has been killed (or not run at
+                  all) because the time limit was up.
+    """
+
+    def __init__(self, function, args, name, jail, after, time_limit=None):
+        self.function = function
+        self.args = args
+        self.name = name
+        self.jail = jail
+        self.after = after
+        self.time_limit = time_limit
+        self.deadline = None
+        self.timed_out = False
+        self.state = "pending"
+        self.result = None
+        self.error = None
+        self.output = ""
+        self.finished = False
+
+class JobEngine(object):
+    """
+    Run the submitted jobs, see the top of the module.
+    """
+
+    def __init__(self, max_jobs=1, max_per_jail=1, throttle=None,
+                 max_per_host=0):
+        self.max_jobs = max(1, max_jobs)
+        self.max_per_jail = max(1, max_per_jail)
+        self.max_per_host = max(0, max_per_host)
+        self.throttle = throttle
+        self.jobs = []
+        self.in_order = True
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Submit function(*args) as a job and return the Job. Keyword arguments:
+
+        - name - how the job is called in the messages;
+        - jail - the jail the job works on (None if on none in particular);
+        - after - the list of the jobs that must be done before this one;
+        - time_limit - for how many seconds the job may run (see
+                       czokomanager.execute_command()).
+        """
+
+        job = Job(function, args, kwargs.get("name", function.__name__),
+                  kwargs.get("jail"), list(kwargs.get("after", [])),
+                  kwargs.get("time_limit"))
+        self.jobs.append(job)
+
+        return job
+
+    def run(self):
+        """
+        Run all the jobs submitted so far and return them once they are all
+        finished. A job that fails does not stop the jobs that do not depend
+        on it.
+        """
+
+        self.in_order = self.max_jobs == 1 or len(self.jobs) == 1
+
+        if self.in_order:
+            self._run_in_order()
+        else:
+            self._run_in_parallel()
+
+        return self.jobs
+
+    def _run_in_order(self):
+        """
+        Run the jobs one by one, printing whatever they print straight away.
+        """
+
+        while True:
+            job = self._next_job({}, 0)
+
+            if job is None:
+                break
+
+            self._run_job(job)
+
+    def _run_in_parallel(self):
+        """
+        Run the jobs in the worker threads and print their output in order.
+        """
+
+        done = Queue.Queue()
+        running = {}
+        count = 0
+
+        def worker(job):
+            job_output.capture()
+            try:
+                self._run_job(job)
+            finally:
+                job.output = job_output.release()
+                done.put(job)
+
+        ## Replace sys.stdout, so whatever the jobs print goes to their own
+        ## buffers rather than straight to the terminal. If the engine is run
+        ## from within a job of another engine, sys.stdout is replaced already
+        ## and the output goes to the buffer of that job.
+        stdout = sys.stdout
+
+        if stdout is not job_output:
+            job_output.stream = stdout
+            sys.stdout = job_output
+
+        printed = 0
+
+        try:
+            while True:
+                ## Start as many jobs as the limits allow.
+                while count < self.max_jobs:
+                    job = self._next_job(running, count)
+
+                    if job is None:
+                        break
+
+                    ## The host might be too busy for yet another job of a
+                    ## jail (see throttle.py). It waits then, yet a single
+                    ## job is always let run. The jobs of the other hosts
+                    ## do not load this one.
+                    if count and job.jail is not None and \
+                       host_of(job.jail) is None and \
+                       self.throttle is not None and \
+                       self.throttle.hold(job, stdout):
+                        break
+
+                    job.state = "running"
+                    running[job.jail] = running.get(job.jail, 0) + 1
+                    count += 1
+
+                    thread = threading.Thread(target=worker, args=(job,))
+                    thread.daemon = True
+                    thread.start()
+
+                if not count:
+                    break
+
+                try:
+                    job = done.get(True, 1)
+                except Queue.Empty:
+                    continue
+                except KeyboardInterrupt:
+                    ## Do not leave the commands of the jobs running.
+                    cancelled.set()
+                    raise
+
+                running[job.jail] -= 1
+                count -= 1
+                job.finished = True
+
+                ## Print the jobs in order. A job is printed as soon as it and
+                ## all the jobs submitted before it are finished.
+                printed = self._print_finished(stdout, printed)
+        finally:
+            sys.stdout = stdout
+
+        self._print_finished(stdout, printed)
+
+    def _print_finished(self, stream, printed):
+        """
+        Print the output of the finished jobs that have not been printed yet,
+        as long as all the jobs before them are finished. Return the number
+        of the jobs printed so far.
+        """
+
+        while printed < len(self.jobs) and self.jobs[printed].finished:
+            stream.write(self.jobs[printed].output)
+            stream.flush()
+            printed += 1
+
+        return printed
+
+    def _next_job(self, running, count):
+        """
+        Return the pending job that may be started now or None. The jobs
+        whose dependencies have not gone fine are skipped on the way. Of the
+        jobs that may be started, the first one of the host with the fewest
+        jobs running is returned (i.e. simply the first one, as long as all
+        the jails are on this host).
+        """
+
+        per_host = {}
+
+        for jail, jobs in running.items():
+            host = host_of(jail) if jail is not None else None
+            per_host[host] = per_host.get(host, 0) + jobs
+
+        chosen = None
+
+        for job in self.jobs:
+            if job.state != "pending":
+                continue
+
+            failed = [dependency for dependency in job.after \
+                      if dependency.state in ("failed", "skipped")]
+
+            if failed:
+                self._skip(job, failed[0])
+                continue
+
+            if [dependency for dependency in job.after \
+                if dependency.state != "done"]:
+                continue
+
+            if job.jail is not None and \
+               running.get(job.jail, 0) >= self.max_per_jail:
+                continue
+
+            host = host_of(job.jail) if job.jail is not None else None
+
+            if self.max_per_host and \
+               per_host.get(host, 0) >= self.max_per_host:
+                continue
+
+            if chosen is None or per_host.get(host, 0) < \
+               per_host.get(host_of(chosen.jail) if chosen.jail is not None \
+                            else None, 0):
+                chosen = job
+
+        return chosen
+
+    def _run_job(self, job):
+        """
+        Call the function of the job and note how it went.
+        """
+
+        job.state = "running"
+
+        ## The jobs run in order share the main thread, the nested engines
+        ## run their jobs within a job of another engine.
+        outer = current_job()
+        _current.job = job
+
+        ## The time limit starts once the job does. The jobs of a nested
+        ## engine are bound by the time limit of the job they run within.
+        if job.time_limit:
+            job.deadline = time.time() + job.time_limit
+        elif outer is not None:
+            job.deadline = outer.deadline
+
+        try:
+            job.result = job.function(*job.args)
+            job.state = "done"
+        except Exception, error:
+            job.error = error
+            job.state = "failed"
+
+            renderer = render.get()
+            renderer.item("error", renderer.bold("Failed on %s:" % job.name),
+                          str(error), jail=job.jail)
+
+            ## A host that cannot be reached is no bug of czokomaster.
+            if not isinstance(error, (BackendError, JobError)):
+                renderer.text(traceback.format_exc().rstrip("\n"),
+                              jail=job.jail)
+
+            renderer.blank()
+        finally:
+            _current.job = outer
+
+            ## The time limit of a nested job is the one of the job it runs
+            ## within, so it is up for both of them.
+            if job.timed_out and outer is not None and \
+               outer.deadline == job.deadline:
+                outer.timed_out = True
+
+    def _skip(self, job, dependency):
+        """
+        Mark the job as skipped, because the job it waits for has failed.
+        """
+
+        job.state = "skipped"
+        job.finished = True
+        output = StringIO()
+        render.get().item("error", "Skipped %s, because %s has not gone "
+                          "fine." % (job.name, dependency.name),
+                          jail=job.jail, to=output)
+        job.output = output.getvalue()
+
+        ## Run in order, the jobs print straight away.
+        if self.in_order:
+            sys.stdout.write(job.output)
+
+class JobOutput(object):
+    """
+    Stand-in for sys.stdout used while the jobs are run in parallel. Every
+    worker thread that called capture() writes to its own buffer, the rest
+    of the threads write to the real stream.
+    """
+
+    def __init__(self):
+        self.stream = sys.stdout
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = StringIO()
+        self.local.softspace = 0
+
+    def release(self):
+        output = self.local.buffer.getvalue()
+        self.local.buffer = None
+
+        return output
+
+    def capturing(self):
+        return getattr(self.local, "buffer", None) is not None
+
+    def write(self, data):
+        if self.capturing():
+            self.local.buffer.write(data)
+        else:
+            self.stream.write(data)
+
+    def flush(self):
+        if not self.capturing():
+            self.stream.flush()
+
+    ## "print" keeps track of the spaces it puts between the items in the
+    ## "softspace" attribute of the file. Each thread must have its own.
+    def _get_softspace(self):
+        if self.capturing():
+            return self.local.softspace
+        return getattr(self.stream, "softspace", 0)
+
+    def _set_softspace(self, value):
+        if self.capturing():
+            self.local.softspace = value
+        else:
+            self.stream.softspace = value
+
+    softspace = property(_get_softspace, _set_softspace)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+job_output = JobOutput()
@@ -0,0 +1,350 @@
+"""
+This is the fetch cache of czokomaster and its prefetch stage. Left to
+themselves, portmaster and easy_install of every jail download whatever they
+need on their own - the very same distfile of perl or sdist of Django once
+per jail. The prefetch stage goes first instead:
+
+  1) the union of what the given jails need is found out, every artifact
+     once (e.g. the distfiles of lang/perl5.12 at 5.12.4_4, no matter how
+     many jails it is outdated in);
+  2) whatever is not in the fetch cache yet is fetched into it, once, many
+     artifacts at the same time ("fetch_jobs" of them);
+  3) the cache is kept within "fetch_cache_size" megabytes - the artifacts
+     used the longest time ago go first, the ones wanted by the current run
+     are never removed.
+
+The fetch cache is the directory "fetch_cachedir" on the host:
+
+  - distfiles/ - the distfiles of the ports, laid out just like DISTDIR;
+  - sdists/ - the source distributions of the python packages, together
+    with the index.html linking them all (a "find links" page).
+
+With "fetch_jail_mountpoint" set, the cache is mounted read-only (with
+"fetch_mount_cmd", nullfs by default) at the given path in every jail of
+this host, so the jails take the artifacts from there rather than from the
+network. In order to make them do so, point the ports of the jails at it
+(e.g. MASTER_SITE_OVERRIDE?= file:///var/cache/czokomaster/fetch/distfiles/
+${DIST_SUBDIR}/ in make.conf of the jail) and easy_install at the sdists
+(e.g. "py_upgrade_cmd = easy_install -f /var/cache/czokomaster/fetch/sdists
+-U"). Whatever is missing from the cache is still fetched from the network
+by the jail itself.
+
+The cache is on this host, so the jails of the other hosts (see
+backends.py) are left out.
+"""
+
+import os
+import cgi
+import json
+import time
+import urllib
+import threading
+
+import files
+import render
+
+from backends import host_of
+from czokomanager import (get_config_option, execute_command, jail_root,
+                          describe_jail, new_engine)
+
+class FetchCache(object):
+    """
+    The artifacts fetched so far, see the top of the module. Every file is
+    known by its path within the cache, e.g. "distfiles/perl-5.12.4.tar.bz2"
+    or "sdists/Django-1.4.1.tar.gz".
+    """
+
+    def __init__(self, cachedir, max_size=0):
+        """
+        Load the index of the cache. "max_size" is the size (in megabytes)
+        the cache may grow up to before the least recently used artifacts
+        are evicted. 0 means there is no limit.
+        """
+
+        self.cachedir = cachedir
+        self.index_path = os.path.join(cachedir, "index.json")
+        self.max_size = max_size * 1024 * 1024
+        self.lock = threading.Lock()
+
+        # The hits, misses and bytes fetched of the current run.
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+
+        self.index = {"files": {}}
+
+        for directory in ("distfiles", "sdists"):
+            if not os.path.isdir(self.path(directory)):
+                os.makedirs(self.path(directory), 0755)
+
+        if os.path.exists(self.index_path):
+            f = open(self.index_path, "r")
+            self.index.update(json.load(f))
+            f.close()
+
+    def path(self, name):
+        """
+        Return the path on the host to the artifact (or the directory) of the
+        cache.
+        """
+
+        return os.path.join(self.cachedir, name)
+
+    def has(self, name):
+        """
+        Whether the artifact is in the cache. An artifact put into the cache
+        by hand (e.g. a distfile fetched by "make fetch" with DISTDIR set to
+        the cache) is taken into the index.
+        """
+
+        with self.lock:
+            if not os.path.exists(self.path(name)):
+                self.index["files"].pop(name, None)
+                return False
+
+            if name not in self.index["files"]:
+                self._add(name)
+
+            return True
+
+    def hit(self, name):
+        """
+        Count one more use of the artifact.
+        """
+
+        with self.lock:
+            entry = self.index["files"][name]
+            entry["hits"] += 1
+            entry["last_used"] = time.time()
+            self.hits += 1
+
+    def add(self, name):
+        """
+        Put the artifact that has just been fetched into the index.
+        """
+
+        with self.lock:
+            self._add(name)
+            self.misses += 1
+            self.fetched += self.index["files"][name]["size"]
+
+    def size(self):
+        """
+        Return the size (in bytes) of all the artifacts in the cache.
+        """
+
+        return sum([entry["size"] for entry in self.index["files"].values()])
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used artifacts until the cache fits in
+        max_size again. The artifacts listed in "keep" are never removed -
+        these are the ones the current run relies on. Return the list of
+        the removed artifacts.
+        """
+
+        evicted = []
+
+        if not self.max_size:
+            return evicted
+
+        size = self.size()
+
+        for name, entry in sorted(self.index["files"].items(),
+                                  key=lambda item: item[1]["last_used"]):
+            if size <= self.max_size:
+                break
+
+            if name in keep:
+                continue
+
+            if os.path.exists(self.path(name)):
+                os.remove(self.path(name))
+
+            size -= entry["size"]
+            del self.index["files"][name]
+            evicted.append(name)
+
+        return evicted
+
+    def write_links(self, directory):
+        """
+        Write the index.html linking every artifact of the directory (e.g.
+        "sdists"), so the directory might be handed over to easy_install -f
+        or pip --find-links as a URL as well.
+        """
+
+        names = sorted([os.path.basename(name) for name in \
+                        self.index["files"] if \
+                        os.path.dirname(name) == directory])
+
+        files.write_atomically(os.path.join(self.path(directory),
+                                            "index.html"),
+                               "<html><body>\n%s</body></html>\n" % \
+                               "".join(["<a href=\"%s\">%s</a><br/>\n" % \
+                                        (urllib.quote(name), cgi.escape(name)) \
+                                        for name in names]))
+
+    def save(self):
+        """
+        Write the index down. The temporary file is renamed over the old
+        index, so the index is never left half-written.
+        """
+
+        files.write_atomically(self.index_path, json.dumps(self.index,
+                                                           indent=1,
+                                                           sort_keys=True))
+
+    def _add(self, name):
+        self.index["files"][name] = {"size": os.path.getsize(self.path(name)),
+                                     "added": time.time(),
+                                     "last_used": time.time(),
+                                     "hits": 0}
+
+def from_config():
+    """
+    Return the FetchCache set up as the config file says.
+    """
+
+    return FetchCache(get_config_option("czokomaster", "fetch_cachedir"),
+                      get_config_option("czokomaster", "fetch_cache_size"))
+
+def is_wanted(params):
+    """
+    Whether the upgrade should prefetch first, i.e. "--prefetch" is given or
+    "prefetch_before_upgrade" is set in the config file.
+    """
+
+    return "--prefetch" in params or \
+           get_config_option("czokomaster", "prefetch_before_upgrade")
+
+def local_jails(jails):
+    """
+    Return the systems the cache serves, i.e. the ones of this host.
+    """
+
+    return [jail for jail in jails if host_of(jail) is None]
+
+def prefetch(cache, artifacts, files_of, fetch, jobs=None):
+    """
+    Fetch the artifacts that are not in the cache yet (see the top of the
+    module). "artifacts" is the list of (the name of the artifact, e.g.
+    "lang/perl5.12", whatever the functions below need to know about it):
+
+      - files_of(artifact) returns the files (the paths within the cache)
+        the artifact is made of or None if it cannot be told;
+      - fetch(artifact, files) fetches the files into the cache and returns
+        True if it has gone fine.
+
+    At most "jobs" ("fetch_jobs" if not given) artifacts are fetched at the
+    same time. Return the dict: name -> "cached", "fetched", "failed" or
+    "unknown" (if files_of() could not tell).
+    """
+
+    jobs = jobs or get_config_option("czokomaster", "fetch_jobs")
+    wanted = []
+
+    def get(name, artifact):
+        files = files_of(artifact)
+
+        if not files:
+            return "unknown"
+
+        with cache.lock:
+            wanted.extend(files)
+
+        if not [path for path in files if not cache.has(path)]:
+            for path in files:
+                cache.hit(path)
+
+            return "cached"
+
+        if not fetch(artifact, files) or \
+           [path for path in files if not os.path.exists(cache.path(path))]:
+            return "failed"
+
+        # The files that have been there already (e.g. shared with another
+        # artifact) are in the index, the rest of them have just been
+        # fetched.
+        for path in files:
+            if path in cache.index["files"]:
+                cache.hit(path)
+            else:
+                cache.add(path)
+
+        return "fetched"
+
+    # The fetches are all done from the host, so they are not bound by
+    # "max_jobs_per_jail".
+    engine = new_engine(jobs, jobs)
+
+    for name, artifact in artifacts:
+        engine.submit(get, name, artifact, name=name)
+
+    results = {}
+
+    for job in engine.run():
+        results[job.args[0]] = job.result if job.state == "done" else "failed"
+
+    missed = ["%s (%s)" % (name, results[name] == "unknown" and \
+                           "nothing to fetch found" or "failed") \
+              for name, artifact in artifacts \
+              if results[name] not in ("cached", "fetched")]
+
+    renderer = render.get()
+
+    if missed:
+        renderer.item("warning", "Not fetched:", ", ".join(missed) + ".")
+
+    evicted = cache.evict(keep=wanted)
+    cache.write_links("sdists")
+    cache.save()
+
+    renderer.item([result for result in results.values() \
+                   if result in ("failed", "unknown")] and "warning" or "info",
+                  renderer.bold("Fetch cache:"),
+                  "%d artifact(s) wanted, %d in the cache already, %d fetched "
+                  "(%.1f MB), %d not fetched, %d file(s) evicted, %.1f MB in "
+                  "use" % (len(results), results.values().count("cached"),
+                           results.values().count("fetched"),
+                           cache.fetched / 1024.0 / 1024.0,
+                           len(results) - results.values().count("cached") - \
+                           results.values().count("fetched"), len(evicted),
+                           cache.size() / 1024.0 / 1024.0))
+
+    return results
+
+def expose(jails):
+    """
+    Mount the cache read-only in the given jails of this host at
+    "fetch_jail_mountpoint", unless it is mounted there already (or the
+    option is not set). The base system is the host itself, so it needs no
+    mount.
+    """
+
+    mountpoint = get_config_option("czokomaster", "fetch_jail_mountpoint")
+
+    if not mountpoint:
+        return
+
+    cachedir = get_config_option("czokomaster", "fetch_cachedir")
+    mount_cmd = get_config_option("czokomaster", "fetch_mount_cmd")
+
+    for jail in local_jails(jails):
+        if jail == "base":
+            continue
+
+        target = os.path.join(jail_root(jail), mountpoint.lstrip(os.sep))
+
+        if os.path.ismount(target):
+            continue
+
+        if not os.path.isdir(target):
+            os.makedirs(target, 0755)
+
+        renderer = render.get()
+        renderer.item("info", "Mounting the fetch cache in",
+                      renderer.highlight(describe_jail(jail)),
+                      "at %s." % mountpoint, jail=jail)
+
+        execute_command([mount_cmd.format(source=cachedir, target=target)])
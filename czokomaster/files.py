@@ -0,0 +1,69 @@
+"""
+These are the helpers of czokomaster for the files it looks at and writes on
+the host.
+
+The caches (the diff cache of the ports plugin, the inventory of the pippy
+cron helper, the inventory of czokomaster) are only good for as long as the
+package databases and the ports trees of the jails stay the same. Rather than
+reading all of them again, they look at their fingerprint - the mtimes of
+the given paths and of whatever is right within them (a package installed,
+removed or upgraded touches its dir in /var/db/pkg or in site-packages). If
+the fingerprint has not changed, neither has the cache.
+
+Whatever czokomaster writes down (the caches, the journals, the plans, ...)
+might be read at the very same time by another run, so it is written to a
+temporary file next to it first and renamed over it (see write_atomically()).
+"""
+
+import os
+import hashlib
+import tempfile
+
+def fingerprint(paths, entry_re=None):
+    """
+    Return the fingerprint of the paths (see the top of the module). Only the
+    entries matching "entry_re" (if given) count within the dirs. The paths
+    that are missing count as well - as missing.
+    """
+
+    digest = hashlib.md5()
+
+    for path in paths:
+        try:
+            digest.update("%s %s\n" % (path, os.stat(path).st_mtime))
+        except OSError:
+            digest.update("%s -\n" % path)
+            continue
+
+        if not os.path.isdir(path):
+            continue
+
+        for entry in sorted(os.listdir(path)):
+            if entry_re is not None and not entry_re.match(entry):
+                continue
+
+            try:
+                digest.update("%s %s\n" % (entry, os.lstat(
+                    os.path.join(path, entry)).st_mtime))
+            except OSError:
+                pass
+
+    return digest.hexdigest()
+
+def write_atomically(path, data, mode=0644):
+    """
+    Write the data to a temporary file next to the given path and rename it
+    over the path, so the file is never seen half-written. "mode" is what
+    the file is left readable by (mkstemp() creates it readable by the owner
+    only).
+    """
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(
+                                             os.path.abspath(path)),
+                                         prefix=".%s." % os.path.basename(path))
+    f = os.fdopen(handle, "w")
+    f.write(data)
+    f.close()
+
+    os.chmod(temp_path, mode)
+    os.rename(temp_path, path)
@@ -0,0 +1,701 @@
+"""
+This is the inventory of czokomaster - the picture of what is installed
+where, for the whole fleet at once. Without it, every "ports diff" asks
+every jail over jexec what it has got, although the answer changes only
+once a package is installed or the ports tree is updated.
+
+The inventory is an SQLite database (see "inventory_db"). It holds the
+latest snapshot of every jail, one per kind of packages - "ports" and
+"python":
+
+  snapshots - jail, kind, when the snapshot was taken, its fingerprint,
+              where it comes from ("files" or the command the jail has been
+              asked), where the available versions come from and how many
+              packages have been added, removed and changed by it;
+  packages  - jail, kind, name, origin (of the ports), the installed
+              version, the available version and whether the package is
+              outdated, indexed by the name (lowercased, with the
+              underscores taken for dashes) and by the outdated flag;
+  changes   - what every snapshot has changed, package by package.
+
+A snapshot is taken straight from the files of the jail as seen from the
+host (see jail_root()), with no process started at all:
+
+  - ports - the package database (/var/db/pkg, either the one of pkg or
+    the one of pkg_install) and the INDEX file of the ports tree, which
+    gives the available versions just like "pkg_version -I" would;
+  - python - the site-packages directories (see "site_packages") and the
+    version index of pippy (see pippy_version_index).
+
+A snapshot is taken again only once the fingerprint of these files changes
+(so taking the snapshots of 50 jails nothing has happened to costs a few
+stats per jail) and it is put into the database as the difference from the
+previous one. Only the jails whose files cannot be reached from the host
+are asked over jexec ("ports_installed_cmd" and "py_installed_cmd") - at
+most once per "inventory_ttl" minutes, and without the available versions.
+
+With "use_inventory = yes", "ports diff", "pippy diff", "pippy outdated"
+and the planning of the upgrades read the outdated packages out of the
+inventory. "czokomaster inventory" (see plugins/inventory.py) refreshes it
+and answers questions like "which jails have Django below 1.4".
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+
+from pkg_resources import parse_version
+
+import files
+
+from czokomanager import (get_config_option, execute_command, jail_command,
+                          jail_root, run_in_jails)
+
+## The kinds of packages the inventory knows of.
+KINDS = ("ports", "python")
+
+## Where the package database and the ports tree are within a system.
+PKG_DB = "/var/db/pkg"
+PORTS_DIR = "/usr/ports"
+
+## The tables and the indexes. Bump SCHEMA_VERSION whenever they change, so
+## the databases made by the older versions are made anew.
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    jail TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    taken REAL NOT NULL,
+    duration REAL NOT NULL,
+    fingerprint TEXT,
+    source TEXT NOT NULL,
+    available_from TEXT,
+    added INTEGER NOT NULL,
+    removed INTEGER NOT NULL,
+    changed INTEGER NOT NULL,
+    PRIMARY KEY (jail, kind)
+);
+CREATE TABLE IF NOT EXISTS packages (
+    jail TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    origin TEXT,
+    installed TEXT NOT NULL,
+    available TEXT,
+    outdated INTEGER NOT NULL,
+    PRIMARY KEY (jail, kind, name)
+);
+CREATE INDEX IF NOT EXISTS packages_by_key ON packages (kind, key);
+CREATE INDEX IF NOT EXISTS packages_outdated ON packages (kind, outdated);
+CREATE TABLE IF NOT EXISTS changes (
+    jail TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    taken REAL NOT NULL,
+    name TEXT NOT NULL,
+    old TEXT,
+    new TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_by_jail ON changes (jail, kind, taken);
+"""
+
+## The INDEX files parsed so far: real path -> (mtime, origin -> version).
+## The jails of ezjail share the ports tree of the basejail, so it is parsed
+## once for all of them.
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+class InventoryError(Exception):
+    """
+    Raised when the snapshot of a jail cannot be taken.
+    """
+
+class Inventory(object):
+    """
+    The inventory database, see the top of the module. A connection must not
+    be shared by the threads, so every thread opens the inventory on its own.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_config_option("czokomaster", "inventory_db")
+
+        directory = os.path.dirname(self.path)
+
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, 0700)
+
+        ## Many jails are refreshed at the same time, each of them waits for
+        ## the others to write their snapshots down.
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.text_factory = str
+
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != \
+           SCHEMA_VERSION:
+            self._create()
+
+    def _create(self):
+        """
+        Make the tables anew. Many jails (or runs) might open the inventory
+        at the same time, so the tables are made within an exclusive
+        transaction, by whoever comes first - the rest find them made.
+        sqlite3 commits on its own before the CREATE statements, unless it is
+        told to leave the transactions alone.
+        """
+
+        self.db.isolation_level = None
+
+        try:
+            self.db.execute("BEGIN EXCLUSIVE")
+
+            try:
+                if self.db.execute("PRAGMA user_version").fetchone()[0] != \
+                   SCHEMA_VERSION:
+                    for table in ("snapshots", "packages", "changes"):
+                        self.db.execute("DROP TABLE IF EXISTS %s" % table)
+
+                    for statement in SCHEMA.split(";"):
+                        if statement.strip():
+                            self.db.execute(statement)
+
+                    self.db.execute("PRAGMA user_version = %d" % \
+                                    SCHEMA_VERSION)
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+            self.db.execute("COMMIT")
+        finally:
+            self.db.isolation_level = ""
+
+    def close(self):
+        self.db.close()
+
+    def snapshot(self, jail, kind):
+        """
+        Return the latest snapshot of the jail (as a dict) or None if there
+        is none.
+        """
+
+        row = self.db.execute("SELECT * FROM snapshots WHERE jail = ? AND "
+                              "kind = ?", (jail, kind)).fetchone()
+
+        return dict(row) if row is not None else None
+
+    def snapshots(self):
+        """
+        Return all the snapshots, jail by jail.
+        """
+
+        return [dict(row) for row in self.db.execute(
+                "SELECT * FROM snapshots ORDER BY jail, kind")]
+
+    def record(self, jail, kind, packages, fingerprint, source,
+               available_from, duration):
+        """
+        Put the new snapshot of the jail into the database. "packages" is the
+        dict: name -> (origin, installed version, available version). Only
+        what differs from the previous snapshot is written. Return the tuple
+        (added, removed, changed) - the numbers of the packages.
+        """
+
+        taken = time.time()
+        known = dict([(row["name"], (row["origin"], row["installed"],
+                                     row["available"])) \
+                      for row in self.db.execute(
+                      "SELECT name, origin, installed, available FROM "
+                      "packages WHERE jail = ? AND kind = ?", (jail, kind))])
+
+        added = [name for name in packages if name not in known]
+        removed = [name for name in known if name not in packages]
+        changed = [name for name in packages if name in known and \
+                   packages[name] != known[name]]
+
+        with self.db:
+            self.db.executemany("DELETE FROM packages WHERE jail = ? AND "
+                                "kind = ? AND name = ?",
+                                [(jail, kind, name) for name in removed])
+            self.db.executemany("INSERT OR REPLACE INTO packages VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(jail, kind, name, package_key(name)) + \
+                                 packages[name] + \
+                                 (int(is_outdated(kind, packages[name][1],
+                                                  packages[name][2])),) \
+                                 for name in added + changed])
+
+            ## The changes of the installed versions are kept, the changes
+            ## of the available ones are not worth it.
+            self.db.executemany("INSERT INTO changes VALUES (?, ?, ?, ?, ?, "
+                                "?)", [(jail, kind, taken, name, old, new) \
+                                       for name, old, new in \
+                                       [(name, None, packages[name][1]) \
+                                        for name in added] + \
+                                       [(name, known[name][1], None) \
+                                        for name in removed] + \
+                                       [(name, known[name][1],
+                                         packages[name][1]) \
+                                        for name in changed] \
+                                       if old != new])
+
+            self.db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, "
+                            "?, ?, ?, ?, ?, ?, ?)",
+                            (jail, kind, taken, duration, fingerprint, source,
+                             available_from, len(added), len(removed),
+                             len(changed)))
+
+        return len(added), len(removed), len(changed)
+
+    def forget(self, jails, kind=None):
+        """
+        Make the next refresh of the given jails take their snapshots anew,
+        whatever their fingerprints say.
+        """
+
+        with self.db:
+            for jail in jails:
+                self.db.execute("UPDATE snapshots SET fingerprint = NULL, "
+                                "taken = 0 WHERE jail = ? AND kind LIKE ?",
+                                (jail, kind or "%"))
+
+    def outdated(self, jail, kind):
+        """
+        Return the list of the outdated packages of the jail as dicts:
+        name, origin, installed, available.
+        """
+
+        return [dict(row) for row in self.db.execute(
+                "SELECT name, origin, installed, available FROM packages "
+                "WHERE kind = ? AND outdated = 1 AND jail = ? ORDER BY "
+                "lower(name)", (kind, jail))]
+
+    def where(self, kind, name):
+        """
+        Return the list of (jail, installed version, available version) of
+        the package, jail by jail. The name is matched case-insensitively
+        and with the underscores taken for dashes (see package_key()).
+        """
+
+        return [(row["jail"], row["installed"], row["available"]) \
+                for row in self.db.execute(
+                "SELECT jail, installed, available FROM packages WHERE "
+                "kind = ? AND key = ? ORDER BY jail", (kind,
+                                                     package_key(name)))]
+
+    def below(self, kind, name, version):
+        """
+        Return the list of (jail, installed version) of the jails the package
+        is installed in at a version lower than the given one.
+        """
+
+        return [(jail, installed) for jail, installed, available in \
+                self.where(kind, name) if compare_versions(kind, installed,
+                                                           version) < 0]
+
+    def changes(self, jail, kind=None, limit=20):
+        """
+        Return the latest changes of the jail as dicts: kind, taken, name,
+        old (version), new (version), the latest first.
+        """
+
+        return [dict(row) for row in self.db.execute(
+                "SELECT kind, taken, name, old, new FROM changes WHERE "
+                "jail = ? AND kind LIKE ? ORDER BY taken DESC, name LIMIT ?",
+                (jail, kind or "%", limit))]
+
+    def count(self, jail, kind):
+        """
+        Return (packages, outdated packages) of the jail.
+        """
+
+        return tuple(self.db.execute("SELECT count(*), coalesce(sum(outdated),"
+                                     " 0) FROM packages WHERE jail = ? AND "
+                                     "kind = ?", (jail, kind)).fetchone())
+
+def package_key(name):
+    """
+    Return the name the package is looked up by, e.g. "django-tagging" for
+    "Django_Tagging".
+    """
+
+    return name.lower().replace("_", "-")
+
+def is_used():
+    """
+    Whether the plugins should read the outdated packages out of the
+    inventory (see "use_inventory").
+    """
+
+    return get_config_option("czokomaster", "use_inventory")
+
+def refresh(jail, kind, force=False, inventory=None):
+    """
+    Take the snapshot of the jail, unless the snapshot in the inventory is
+    still good (see the top of the module) and "force" is not given. Return
+    (snapshot, changes) - the snapshot in the inventory and the tuple
+    (added, removed, changed) or None if the snapshot has not been taken.
+    """
+
+    own = inventory is None
+    inventory = inventory or Inventory()
+
+    try:
+        known = inventory.snapshot(jail, kind)
+        paths = _watched_paths(jail, kind)
+        current = files.fingerprint(paths) if paths is not None else None
+
+        if not force and known is not None:
+            if current is not None and known["fingerprint"] == current:
+                return known, None
+
+            ttl = get_config_option("czokomaster", "inventory_ttl") * 60
+
+            if current is None and known["source"] != "files" and \
+               0 <= time.time() - known["taken"] < ttl:
+                return known, None
+
+        started = time.time()
+
+        if current is not None:
+            packages, available_from = _COLLECTORS[kind](jail)
+            source = "files"
+        else:
+            packages, source = _ask(jail, kind)
+            available_from = None
+
+        changes = inventory.record(jail, kind, packages, current, source,
+                                   available_from, time.time() - started)
+
+        return inventory.snapshot(jail, kind), changes
+    finally:
+        if own:
+            inventory.close()
+
+def refresh_all(jails, kinds=KINDS, force=False):
+    """
+    Take the snapshots of all the jails - as many of them at the same time
+    as "max_parallel_jails" allows. Return the list of (jail, kind,
+    snapshot, changes, error), see refresh().
+    """
+
+    def refresh_jail(jail):
+        results = []
+        inventory = Inventory()
+
+        try:
+            for kind in kinds:
+                try:
+                    results.append((kind,) + refresh(jail, kind, force,
+                                                     inventory) + (None,))
+                except Exception, error:
+                    results.append((kind, None, None, error))
+        finally:
+            inventory.close()
+
+        return results
+
+    results = []
+
+    for jail, kind_results, error in run_in_jails(jails, refresh_jail):
+        for result in kind_results or [(kind, None, None, error) \
+                                       for kind in kinds]:
+            results.append((jail,) + result)
+
+    return results
+
+def outdated(jail, kind, force=False):
+    """
+    Refresh the snapshot of the jail and return the list of its outdated
+    packages (see Inventory.outdated()) together with the snapshot - or
+    (None, None) if the inventory cannot tell the outdated packages of the
+    jail, i.e. the files of the jail cannot be reached from the host. The
+    jail is not asked then, whoever wants to know asks it their own way.
+    """
+
+    if _watched_paths(jail, kind) is None:
+        return None, None
+
+    inventory = Inventory()
+
+    try:
+        snapshot, changes = refresh(jail, kind, force, inventory)
+
+        return inventory.outdated(jail, kind), snapshot
+    finally:
+        inventory.close()
+
+def forget(jails, kind=None):
+    """
+    See Inventory.forget(). Does nothing unless the inventory is used.
+    """
+
+    if not is_used():
+        return
+
+    inventory = Inventory()
+
+    try:
+        inventory.forget(jails, kind)
+    finally:
+        inventory.close()
+
+def compare_versions(kind, first, second):
+    """
+    Compare the two versions of a package the way cmp() does. The versions
+    of the ports are made of the version, the revision and the epoch (e.g.
+    5.12.4_3,1), the latter ones win over the version.
+    """
+
+    if kind == "ports":
+        return cmp(_port_version_key(first), _port_version_key(second))
+
+    return cmp(parse_version(first), parse_version(second))
+
+def is_outdated(kind, installed, available):
+    return available is not None and \
+           compare_versions(kind, installed, available) < 0
+
+def _port_version_key(version):
+    version, comma, epoch = version.partition(",")
+    version, underscore, revision = version.partition("_")
+
+    return (int(epoch) if epoch.isdigit() else 0, parse_version(version),
+            int(revision) if revision.isdigit() else 0)
+
+def _watched_paths(jail, kind):
+    """
+    Return the list of the paths the snapshot of the jail is taken from (as
+    seen from the host) or None if they cannot be reached, i.e. the jail has
+    to be asked.
+    """
+
+    root = jail_root(jail)
+
+    # The jail is on another host.
+    if root is None:
+        return None
+
+    if kind == "ports":
+        pkg_db = os.path.join(root, PKG_DB.lstrip(os.sep))
+        index = _index_path(jail)
+
+        if not os.path.isdir(pkg_db) or index is None:
+            return None
+
+        return [pkg_db, index]
+
+    directories = [os.path.join(root, path.lstrip(os.sep)) \
+                   for path in get_config_option("pippy", "site_packages")]
+    directories = [path for path in directories if os.path.isdir(path)]
+
+    if not directories:
+        return None
+
+    return directories + [_versions_path()]
+
+def _collect_ports(jail):
+    """
+    Return (packages, available_from) of the ports installed in the jail,
+    see Inventory.record().
+    """
+
+    index_path = _index_path(jail)
+    index = _load_index(index_path)
+    packages = {}
+
+    for name, version, origin in _installed_ports(jail):
+        packages[name] = (origin, version, index.get(origin))
+
+    return packages, index_path
+
+def _installed_ports(jail):
+    """
+    Return the list of (name, version, origin) of the packages in the
+    package database of the jail - the SQLite one of pkg or the directories
+    of pkg_install, with "@comment ORIGIN:" in their +CONTENTS.
+    """
+
+    pkg_db = os.path.join(jail_root(jail), PKG_DB.lstrip(os.sep))
+    local = os.path.join(pkg_db, "local.sqlite")
+
+    if os.path.exists(local):
+        db = sqlite3.connect(local)
+        db.text_factory = str
+
+        try:
+            return [tuple(row) for row in db.execute(
+                    "SELECT name, version, origin FROM packages")]
+        finally:
+            db.close()
+
+    ports = []
+
+    for entry in os.listdir(pkg_db):
+        contents = os.path.join(pkg_db, entry, "+CONTENTS")
+
+        if "-" not in entry or not os.path.isfile(contents):
+            continue
+
+        name, version = entry.rsplit("-", 1)
+        origin = None
+
+        f = open(contents, "r")
+
+        for line in f:
+            if line.startswith("@comment ORIGIN:"):
+                origin = line.split(":", 1)[1].strip()
+                break
+
+        f.close()
+
+        ports.append((name, version, origin))
+
+    return ports
+
+def _index_path(jail):
+    """
+    Return the path to the INDEX file of the ports tree of the jail (the
+    newest one, if there are a few of them, e.g. INDEX-8 and INDEX-9) or
+    None if there is none.
+    """
+
+    ports_dir = os.path.join(jail_root(jail), PORTS_DIR.lstrip(os.sep))
+
+    try:
+        indexes = [os.path.join(ports_dir, entry) for entry in \
+                   os.listdir(ports_dir) if entry.startswith("INDEX")]
+    except OSError:
+        return None
+
+    if not indexes:
+        return None
+
+    return max(indexes, key=os.path.getmtime)
+
+def _load_index(path):
+    """
+    Return the dict: origin -> version of the INDEX file. The INDEX lines
+    go like "perl-5.12.4_4|/usr/ports/lang/perl5.12|...".
+    """
+
+    real_path = os.path.realpath(path)
+    mtime = os.path.getmtime(real_path)
+
+    with _indexes_lock:
+        if real_path in _indexes and _indexes[real_path][0] == mtime:
+            return _indexes[real_path][1]
+
+    index = {}
+
+    f = open(real_path, "r")
+
+    for line in f:
+        fields = line.split("|", 2)
+
+        if len(fields) < 2 or "-" not in fields[0]:
+            continue
+
+        origin = "/".join(fields[1].rstrip("/").split("/")[-2:])
+        index[origin] = fields[0].rsplit("-", 1)[1]
+
+    f.close()
+
+    with _indexes_lock:
+        _indexes[real_path] = (mtime, index)
+
+    return index
+
+def _collect_python(jail):
+    """
+    Return (packages, available_from) of the python packages installed in
+    the jail, see Inventory.record(). The available versions are the ones
+    known to the version index of pippy - it is not asked anything new.
+    """
+
+    ## Imported here, as the plugins (and their helpers) are imported only
+    ## once needed.
+    from czokomaster.plugins.plugin_helpers.pippy_cron_helper import \
+         DISTRIBUTION_RE
+    from czokomaster.plugins.plugin_helpers.pippy_version_index import \
+         normalize_name
+
+    versions = _load_versions()
+    packages = {}
+
+    for directory in _watched_paths(jail, "python")[:-1]:
+        for entry in os.listdir(directory):
+            match = DISTRIBUTION_RE.match(entry)
+
+            if match:
+                name = match.group(1).replace("_", "-")
+                packages[name] = (None, match.group(2), versions.get(
+                                  normalize_name(name), {}).get("version"))
+
+    return packages, _versions_path()
+
+def _versions_path():
+    return os.path.join(get_config_option("pippy", "pippy_cachedir"),
+                        ".versions")
+
+def _load_versions():
+    """
+    Return the store of the version index of pippy (see VersionIndex) or
+    an empty dict if there is none yet.
+    """
+
+    try:
+        f = open(_versions_path(), "r")
+    except IOError:
+        return {}
+
+    try:
+        return json.load(f)
+    except ValueError:
+        return {}
+    finally:
+        f.close()
+
+def _ask(jail, kind):
+    """
+    Return (packages, source) of the jail whose files cannot be reached from
+    the host - by asking the jail. The available versions are not known
+    then.
+    """
+
+    if kind == "ports":
+        command = get_config_option("ports", "ports_installed_cmd")
+    else:
+        command = get_config_option("pippy", "py_installed_cmd")
+
+    stdout, stderr = execute_command([jail_command(jail, command)],
+                                     func_return=True)
+
+    ## Nothing is better than an empty snapshot, which would make every
+    ## package of the jail look removed.
+    if not (stdout or "").strip():
+        raise InventoryError("%s has given nothing%s" % (command, stderr and \
+                             ": %s" % stderr.strip() or ""))
+
+    packages = {}
+
+    for line in (stdout or "").splitlines():
+        if kind == "ports":
+            # pkg_info -Qoa gives e.g. "perl-5.12.4_3:lang/perl5.12".
+            match = re.match(r"^(\S+)-([^-\s:]+):(\S+)$", line)
+
+            if match:
+                packages[match.group(1)] = (match.group(3), match.group(2),
+                                            None)
+        else:
+            # yolk -l gives e.g. "Django          - 1.4          - active".
+            match = re.match(r"\s*(\S+)\s+-\s+(\S+)", line)
+
+            if match:
+                packages[match.group(1)] = (None, match.group(2), None)
+
+    return packages, command
+
+## How the snapshots are taken from the files of each kind of packages.
+_COLLECTORS = {"ports": _collect_ports, "python": _collect_python}
@@ -0,0 +1,165 @@
+"""
+This is the run journal of czokomaster. An upgrade of many jails takes
+hours, and it might die halfway - a build fails, the SSH connection drops,
+the box is rebooted. The journal notes every step of the upgrade as soon as
+it is done (e.g. "the Django package of jail www is upgraded" or "the ports
+of jail db are upgraded"), so the next run started with "--resume" skips
+whatever has been done and goes on from where the previous one stopped.
+With "--dry-run", the journal is only shown: what has been done and what is
+left.
+
+There is one journal per plugin action (e.g. "ports upgrade"), kept in the
+"journal" subdirectory of CZOKOMASTER_CACHE_DIR. It is started anew by every
+run without "--resume" and removed once a run finishes all of its steps.
+"""
+
+import os
+import json
+import time
+import threading
+
+import files
+import render
+
+from meta import CZOKOMASTER_CACHE_DIR
+
+class Journal(object):
+    """
+    The steps done so far by an action of a plugin, jail by jail.
+    """
+
+    def __init__(self, plugin, action):
+        """
+        Load the journal left by the previous run, if there is one.
+        """
+
+        self.plugin = plugin
+        self.action = action
+        self.path = os.path.join(CZOKOMASTER_CACHE_DIR, "journal",
+                                 "%s-%s.json" % (plugin, action))
+        self.lock = threading.Lock()
+        self.data = {"started": None, "updated": None, "jails": {}}
+
+        if os.path.exists(self.path):
+            f = open(self.path, "r")
+            self.data.update(json.load(f))
+            f.close()
+
+    def start(self, resume=False):
+        """
+        Start the run. Unless the run resumes the previous one, whatever the
+        previous run has done is forgotten. The journal is written down
+        straight away, so the run is known even if it dies before its first
+        step is done.
+        """
+
+        with self.lock:
+            if not resume or self.data["started"] is None:
+                self.data = {"started": time.time(), "updated": None,
+                             "jails": {}}
+                self._save()
+
+    def is_done(self, jail, step):
+        """
+        Whether the step has been done in the given system.
+        """
+
+        with self.lock:
+            return step in self.data["jails"].get(jail, [])
+
+    def completed(self, jail):
+        """
+        Return the list of the steps done in the given system.
+        """
+
+        with self.lock:
+            return list(self.data["jails"].get(jail, []))
+
+    def complete(self, jail, step):
+        """
+        Note the step as done in the given system. The journal is written
+        down straight away, so the step is known even if czokomaster is
+        killed the very next moment.
+        """
+
+        with self.lock:
+            steps = self.data["jails"].setdefault(jail, [])
+
+            if step not in steps:
+                steps.append(step)
+
+            self.data["updated"] = time.time()
+            self._save()
+
+    def finish(self):
+        """
+        The run has done all of its steps, so there is nothing to resume.
+        """
+
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def wrap_up(self, left):
+        """
+        Finish the journal if no system is "left" unfinished. Otherwise, tell
+        how to go on.
+        """
+
+        if not left:
+            self.finish()
+            return
+
+        renderer = render.get()
+        renderer.item("warning", renderer.bold("Not finished:"),
+                      ", ".join(left) + ". Run the same command with --resume "
+                      "to go on from here or with --dry-run to see what is "
+                      "left.")
+
+    def print_left(self, plan):
+        """
+        Print what has been done and what is left, system by system. "plan"
+        is the list of (jail, the steps the jail needs).
+        """
+
+        renderer = render.get()
+
+        if self.data["started"] is None:
+            renderer.item("info", renderer.bold("No run of \"%s %s\" to "
+                                                "resume, everything is left:" % \
+                                                (self.plugin, self.action)))
+        else:
+            renderer.item("info", renderer.bold("Run of \"%s %s\" started %s, "
+                                                "last step done %s:" % \
+                                                (self.plugin, self.action,
+                                                 render.format_time(
+                                                     self.data["started"]),
+                                                 render.format_time(
+                                                     self.data["updated"]))))
+
+        for jail, steps in plan:
+            done = self.completed(jail)
+            left = [step for step in steps if step not in done]
+
+            if not left:
+                renderer.text("   ", renderer.highlight(jail) + ":",
+                              renderer.paint("done", "green"), jail=jail)
+            else:
+                renderer.text("   ", renderer.highlight(jail) + ":",
+                              "%d step(s) done," % len(done),
+                              renderer.paint("left:", "yellow"),
+                              ", ".join(left), jail=jail)
+
+    def _save(self):
+        """
+        Write the journal down. The temporary file is renamed over the old
+        journal, so it is never left half-written.
+        """
+
+        directory = os.path.dirname(self.path)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0700)
+
+        files.write_atomically(self.path, json.dumps(self.data, indent=1,
+                                                     sort_keys=True), 0600)
@@ -8,6 +8,21 @@ __version__ = "1.1"
 __copyright__ = "Copyright (c) 2012 Mikolaj Romel"
 __license__ = "New-style BSD"
 
-# Where the config file for czokomaster can be found.
-CZOKOMASTER_CONFIG_PATH = "/usr/local/etc/czokomaster.conf"
+import os
 
+# Where the config file for czokomaster can be found. It might be pointed
+# elsewhere with the CZOKOMASTER_CONFIG environment variable (e.g. by the
+# benchmarks, see benchmarks/bench.py).
+CZOKOMASTER_CONFIG_PATH = os.environ.get("CZOKOMASTER_CONFIG",
+                                         "/usr/local/etc/czokomaster.conf")
+
+# Where czokomaster keeps what it has worked out once and does not want to
+# work out on every run (e.g. the manifest of the plugins, see registry.py).
+# Likewise, CZOKOMASTER_CACHE_DIR in the environment wins.
+CZOKOMASTER_CACHE_DIR = os.environ.get("CZOKOMASTER_CACHE_DIR",
+                                       "/var/cache/czokomaster")
+
+# Where the daemon listens and the client looks for it (see daemon.py and
+# client.py). CZOKOMASTER_SOCKET in the environment wins.
+CZOKOMASTER_SOCKET = os.environ.get("CZOKOMASTER_SOCKET",
+                                    "/var/run/czokomaster.sock")
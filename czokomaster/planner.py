@@ -0,0 +1,571 @@
+"""
+This is the upgrade planner of czokomaster. "ports upgrade" and "pippy
+upgrade" find out what is to be done while doing it - jail by jail, command
+by command - so the whole of the work is never known: neither how much of it
+there is, nor what of it is done twice, nor how long it is going to take.
+The planner finds it all out first and writes it down as a plan, e.g.:
+
+    # czokomaster ports plan all --shared --save /root/tuesday.json
+    # czokomaster ports apply /root/tuesday.json
+
+The plan is the list of the steps to be done. Every step says:
+
+  - id - what the step is known by, e.g. "build:lang/perl5.12" or
+         "upgrade:www". A step planned twice (e.g. the same package wanted
+         by two jails) is a single step;
+  - kind - what the step does: "command" (the step runs "command" in
+           "jail") or another kind known to the plugin that has made the
+           plan (e.g. "build" - build the package and put it into the
+           package cache);
+  - jail - the system the step works on;
+  - description - what the step does, in words;
+  - packages - the packages the step works on, if known;
+  - after - the steps that must be done first;
+  - estimate - how many seconds the step is expected to take or null if
+               it is not known.
+
+The estimates come from the run log (see runlog.py): the median of the
+latest runs of the very same command in the very same system or, if it has
+never been run there, of the commands that have worked on the same
+packages (the same system first, any other then). Thus, the plan tells how
+long the whole of it is going to take - the work all in all and, as the
+steps that do not depend on each other are done at the same time, the
+length of the longest chain of dependent steps (the critical path) - before
+anything is touched.
+
+The plan is saved as a JSON document, so it might be looked at, checked in
+or handed over to whoever carries it out. "apply" does the steps through the
+job engine (see engine.py), every step once its dependencies are done - as
+many at the same time as "max_parallel_jails" (or "--jobs") allows, one at
+a time within a single system. A step whose dependency has failed is not
+done at all. Every step done is noted in the run journal of the plan (see
+journal.py), so an apply that has died halfway goes on with "--resume".
+"""
+
+import os
+import json
+import time
+import pipes
+
+import files
+import render
+
+from meta import CZOKOMASTER_CACHE_DIR
+from journal import Journal
+from backends import split_target
+from runlog import read_log
+from czokomanager import (get_config_option, execute_command, jail_command,
+                          new_engine, get_max_parallel_jails, ConfigError)
+
+## Bump it whenever the format of the plans changes, so the plans made by
+## the older versions are not applied.
+PLAN_VERSION = 1
+
+## How many of the latest records of the run log the estimates are made of.
+HISTORY_LENGTH = 20000
+
+## How many of the latest runs of a command (or a package) an estimate is
+## the median of.
+SAMPLES = 5
+
+class PlanError(Exception):
+    """
+    Raised when the plan cannot be read or does not fit the plugin.
+    """
+
+class Plan(object):
+    """
+    The steps to be done by a plugin, see the top of the module.
+    """
+
+    def __init__(self, plugin, action="upgrade", steps=None, created=None,
+                 id=None, jobs=None):
+        """
+        "jobs" is how many steps may be done at the same time (e.g. the
+        builds of the ports of many systems), if the plan says so.
+        Otherwise, it is up to "max_parallel_jails". The steps of a single
+        system are done one at a time either way.
+        """
+
+        self.plugin = plugin
+        self.action = action
+        self.jobs = jobs
+        self.steps = steps or []
+        self.created = created or time.time()
+        self.id = id or "%d-%d" % (self.created, os.getpid())
+        self.index = dict([(step["id"], step) for step in self.steps])
+
+    def add(self, id, kind, jail, description, command=None, args=None,
+            packages=None, after=()):
+        """
+        Add the step to the plan and return its id. The steps it depends on
+        must be in the plan already - so the steps are always in an order
+        they might be done in. A step that is in the plan already is not
+        added again, it only waits for the given steps as well.
+        """
+
+        for dependency in after:
+            if dependency not in self.index:
+                raise PlanError("%s depends on %s, which is not planned" % \
+                                (id, dependency))
+
+        if id in self.index:
+            step = self.index[id]
+            step["after"] += [dependency for dependency in after if \
+                              dependency not in step["after"]]
+            return id
+
+        step = {"id": id, "kind": kind, "jail": jail,
+                "description": description, "command": command,
+                "args": args or {}, "packages": list(packages or []),
+                "after": list(after), "estimate": None}
+
+        self.steps.append(step)
+        self.index[id] = step
+
+        return id
+
+    def has(self, id):
+        return id in self.index
+
+    def jails(self):
+        """
+        Return the systems the plan works on, in the order they come.
+        """
+
+        jails = []
+
+        for step in self.steps:
+            if step["jail"] is not None and step["jail"] not in jails:
+                jails.append(step["jail"])
+
+        return jails
+
+    def estimate(self, timings=None):
+        """
+        Estimate every step out of the run log (see the top of the module).
+        """
+
+        timings = timings or Timings.from_log()
+
+        for step in self.steps:
+            step["estimate"] = timings.estimate(step)
+
+    def schedule(self, jobs):
+        """
+        Return (the work all in all, the critical path, the shortest time
+        the plan might take with "jobs" steps at the same time) in seconds
+        and the ids of the steps on the critical path. The steps not
+        estimated count as done straight away.
+        """
+
+        finish = {}
+        previous = {}
+
+        for step in self.steps:
+            start = 0
+
+            for dependency in step["after"]:
+                if finish[dependency] >= start:
+                    start = finish[dependency]
+                    previous[step["id"]] = dependency
+
+            finish[step["id"]] = start + (step["estimate"] or 0)
+
+        work = sum([step["estimate"] or 0 for step in self.steps])
+        critical = max(finish.values() or [0])
+
+        ## The last step of the critical path is the one to finish last.
+        path = []
+        last = [step["id"] for step in self.steps \
+                if finish[step["id"]] == critical]
+
+        if last and critical:
+            id = last[0]
+
+            while id is not None:
+                path.insert(0, id)
+                id = previous.get(id)
+
+        return work, critical, max(critical, work / max(1, jobs)), path
+
+    def show(self, jobs=None, stream=None):
+        """
+        Print the plan step by step, then the estimates of the whole of it.
+        """
+
+        renderer = render.get()
+        jobs = jobs or self.jobs or get_max_parallel_jails()
+
+        renderer.heading("Plan of \"%s %s\": %d step(s) in %d system(s)" % \
+                         (self.plugin, self.action, len(self.steps),
+                          len(self.jails())), to=stream)
+
+        if not self.steps:
+            renderer.item("ok", renderer.bold("Nothing to do."), to=stream)
+            return
+
+        for number, step in enumerate(self.steps, 1):
+            renderer.text(renderer.paint("%4d." % number, "blue"),
+                          step["description"],
+                          renderer.highlight("[%s]" % step["id"]),
+                          "~" + format_duration(step["estimate"]) + \
+                          (step["after"] and ", after %s" % \
+                           ", ".join(step["after"]) or ""),
+                          jail=step["jail"], step=step["id"], to=stream)
+
+        work, critical, window, path = self.schedule(jobs)
+        unknown = len([step for step in self.steps \
+                       if step["estimate"] is None])
+
+        renderer.item("info", renderer.bold("Estimated:"),
+                      "%s of work, at least %s with %d job(s) at a time" % \
+                      (format_duration(work), format_duration(window), jobs) + \
+                      (path and " (critical path: %s, %d step(s) ending with "
+                       "%s)" % (format_duration(critical), len(path),
+                                path[-1]) or "") + ".", to=stream)
+
+        if unknown:
+            renderer.item("warning", "%d step(s) have never been run before, "
+                          "so they are not estimated." % unknown, to=stream)
+
+    def to_dict(self):
+        return {"version": PLAN_VERSION, "id": self.id,
+                "plugin": self.plugin, "action": self.action,
+                "created": self.created, "jobs": self.jobs,
+                "steps": self.steps}
+
+    def save(self, path=None):
+        """
+        Write the plan down (to the default plan of the plugin, if no path
+        is given) and return the path. The temporary file is renamed over
+        the old plan, so it is never left half-written.
+        """
+
+        path = path or default_path(self.plugin)
+        directory = os.path.dirname(os.path.abspath(path))
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0755)
+
+        files.write_atomically(path, json.dumps(self.to_dict(), indent=1,
+                                                sort_keys=True))
+
+        return path
+
+    @classmethod
+    def load(cls, path, plugin):
+        """
+        Read the plan made by the given plugin.
+        """
+
+        try:
+            f = open(path, "r")
+        except IOError, error:
+            raise PlanError("cannot read the plan %s: %s" % (path,
+                                                             error.strerror))
+
+        try:
+            data = json.load(f)
+        except ValueError:
+            raise PlanError("%s is not a plan" % path)
+        finally:
+            f.close()
+
+        if not isinstance(data, dict) or \
+           data.get("version") != PLAN_VERSION:
+            raise PlanError("%s is not a plan of this version of "
+                            "czokomaster" % path)
+
+        if data.get("plugin") != plugin:
+            raise PlanError("%s is a plan of the %s plugin, not of the %s "
+                            "plugin" % (path, data.get("plugin"), plugin))
+
+        plan = cls(plugin, data.get("action", "upgrade"), [], data["created"],
+                   data["id"], data.get("jobs"))
+
+        for step in data["steps"]:
+            plan.add(step["id"], step["kind"], step["jail"],
+                     step["description"], step.get("command"),
+                     step.get("args"), step.get("packages"),
+                     step.get("after", []))
+            plan.index[step["id"]]["estimate"] = step.get("estimate")
+
+        return plan
+
+class Timings(object):
+    """
+    How long the commands have taken so far, out of the run log, by command
+    and by package. Only the commands that have gone fine count.
+    """
+
+    def __init__(self, records):
+        self.commands = {}
+        self.packages = {}
+
+        for record in records:
+            if record.get("returncode") != 0 or record.get("timed_out") or \
+               record.get("cancelled") or record.get("wall") is None:
+                continue
+
+            self.commands.setdefault(record["command"], []).append(
+                (record.get("jail"), record["wall"]))
+
+            ## A single command might have worked on many packages (e.g.
+            ## "easy_install -U Django South"), each of them gets its share.
+            packages = (record.get("package") or "").split()
+
+            for package in packages:
+                self.packages.setdefault(package, []).append(
+                    (record.get("jail"), record["wall"] / len(packages)))
+
+    @classmethod
+    def from_log(cls):
+        """
+        Return the timings out of the run log set in the config file.
+        """
+
+        try:
+            path = get_config_option("czokomaster", "run_log")
+        except ConfigError:
+            path = None
+
+        return cls(read_log(path, HISTORY_LENGTH) if path else [])
+
+    def estimate(self, step):
+        """
+        Return how many seconds the step is expected to take or None if it
+        is not known (see the top of the module).
+        """
+
+        if step["command"] and step["jail"] is not None:
+            walls = self._of_command(step["jail"], step["command"])
+
+            if walls:
+                return _median(walls)
+
+        known = [wall for wall in [self._of_package(step["jail"], package) \
+                                   for package in step["packages"]] \
+                 if wall is not None]
+
+        if known:
+            ## The packages that have never been worked on are expected to
+            ## take as long as the rest of them.
+            return sum(known) * len(step["packages"]) / len(known)
+
+        return None
+
+    def _of_command(self, jail, command):
+        """
+        Return the latest timings of the command in the system. The commands
+        of the systems of another host are noted as run through the backend
+        (e.g. "ssh ... host 'jexec www portmaster -ad'"), so they are looked
+        for by the command run on the host.
+        """
+
+        host, name = split_target(jail)
+        inner = jail_command(name, command)
+
+        if host is None:
+            return [wall for run_in, wall in self.commands.get(inner, []) \
+                    if run_in == jail][-SAMPLES:]
+
+        walls = []
+
+        for recorded in self.commands:
+            if recorded.endswith(" " + pipes.quote(inner)):
+                walls += [wall for run_in, wall in self.commands[recorded] \
+                          if run_in == jail]
+
+        return walls[-SAMPLES:]
+
+    def _of_package(self, jail, package):
+        """
+        Return the estimate of the work on the package - out of the runs in
+        the system itself, if it has got any.
+        """
+
+        runs = self.packages.get(package, [])
+        walls = [wall for run_in, wall in runs if run_in == jail] or \
+                [wall for run_in, wall in runs]
+
+        return _median(walls[-SAMPLES:]) if walls else None
+
+def apply_plan(plan, kinds, resume=False):
+    """
+    Do the steps of the plan (see the top of the module). "kinds" is the
+    dict: kind of steps -> the function that does such a step - function(step,
+    journal) - and returns True if it has gone fine. The steps of the kind
+    "command" are done here. Return the dict: step id -> "done", "failed" or
+    "skipped".
+    """
+
+    journal = Journal(plan.plugin, "apply-%s" % plan.id)
+    journal.start(resume)
+
+    kinds = dict(kinds)
+    kinds.setdefault("command", _run_command)
+
+    for step in plan.steps:
+        if step["kind"] not in kinds:
+            raise PlanError("%s is a step of an unknown kind: %s" % \
+                            (step["id"], step["kind"]))
+
+    renderer = render.get()
+    renderer.heading("Applying the plan of \"%s %s\" made %s" % \
+                     (plan.plugin, plan.action,
+                      render.format_time(plan.created)),
+                     note="%d step(s) in %d system(s)." % (len(plan.steps),
+                                                          len(plan.jails())))
+
+    # The steps of a single system are done one at a time - they work on the
+    # same package database (see ports_build_scheduler).
+    engine = new_engine(plan.jobs, 1)
+    jobs = {}
+    outcome = {}
+
+    for step in plan.steps:
+        if journal.is_done(_journal_jail(step), step["id"]):
+            outcome[step["id"]] = "done"
+            continue
+
+        after = [jobs[dependency] for dependency in step["after"] \
+                 if dependency in jobs]
+        jobs[step["id"]] = engine.submit(_do_step, step, kinds, journal,
+                                         after, name=step["description"],
+                                         jail=step["jail"], after=after)
+
+    for job in engine.run():
+        step = job.args[0]
+
+        if job.state == "done" and job.result:
+            outcome[step["id"]] = "done"
+        elif job.state == "done" and job.result is None:
+            outcome[step["id"]] = "skipped"
+        else:
+            outcome[step["id"]] = job.state == "skipped" and "skipped" or \
+                                  "failed"
+
+    left = [step["id"] for step in plan.steps \
+            if outcome[step["id"]] != "done"]
+
+    renderer.blank()
+    renderer.item(left and "warning" or "ok", renderer.bold("Plan applied:"),
+                  "%d step(s) done, %d failed, %d skipped." % \
+                  (len(plan.steps) - len(left),
+                   len([id for id in left if outcome[id] == "failed"]),
+                   len([id for id in left if outcome[id] == "skipped"])))
+
+    journal.wrap_up(left)
+
+    return outcome
+
+def print_left(plan):
+    """
+    Print what an apply of the plan has done so far and what is left.
+    """
+
+    journal = Journal(plan.plugin, "apply-%s" % plan.id)
+    left = []
+
+    for step in plan.steps:
+        jail = _journal_jail(step)
+
+        for entry in left:
+            if entry[0] == jail:
+                entry[1].append(step["id"])
+                break
+        else:
+            left.append((jail, [step["id"]]))
+
+    journal.print_left(left)
+
+def default_path(plugin):
+    """
+    Return where the plan of the plugin is kept, unless told otherwise.
+    """
+
+    return os.path.join(CZOKOMASTER_CACHE_DIR, "plans", "%s.json" % plugin)
+
+def option_value(flag, params):
+    """
+    Return (the value given to the flag on the command line or None, the
+    params without the flag and its value), e.g. ("/root/plan.json", ...)
+    for "--save /root/plan.json".
+    """
+
+    if flag not in params:
+        return None, params
+
+    position = params.index(flag)
+
+    if position + 1 >= len(params) or params[position + 1].startswith("--"):
+        return None, params[:position] + params[position + 1:]
+
+    return params[position + 1], params[:position] + params[position + 2:]
+
+def format_duration(seconds):
+    """
+    Return the duration in words, e.g. "1h 02m", "3m 20s" or "?" if it is
+    not known.
+    """
+
+    if seconds is None:
+        return "?"
+
+    if seconds >= 3600:
+        return "%dh %02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+    if seconds >= 60:
+        return "%dm %02ds" % (seconds // 60, seconds % 60)
+
+    return "%.1fs" % seconds if seconds < 10 else "%ds" % round(seconds)
+
+def _do_step(step, kinds, journal, dependencies):
+    """
+    Do the step, unless any of the steps it depends on has failed. Note it
+    in the journal once it has gone fine. Return True if it has gone fine,
+    None if it has not been done at all.
+    """
+
+    failed = [job.name for job in dependencies if not job.result]
+
+    if failed:
+        render.get().item("error", "Not going to %s, as %s has not gone "
+                          "fine." % (step["description"], ", ".join(failed)),
+                          jail=step["jail"], step=step["id"])
+        return None
+
+    if not kinds[step["kind"]](step, journal):
+        return False
+
+    journal.complete(_journal_jail(step), step["id"])
+
+    return True
+
+def _run_command(step, journal):
+    """
+    Do a step of the kind "command", i.e. run the command in the system.
+    """
+
+    renderer = render.get()
+    renderer.blank()
+    renderer.heading(step["description"][:1].upper() + \
+                     step["description"][1:], jail=step["jail"],
+                     step=step["id"])
+    renderer.blank()
+
+    return execute_command([jail_command(step["jail"],
+                                         step["command"])]) == [0]
+
+def _journal_jail(step):
+    return step["jail"] or "-"
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
@@ -0,0 +1,275 @@
+"""
+This plugin keeps the inventory of the fleet - what ports and python packages
+are installed in which system, at which version (see czokomaster.inventory).
+"""
+
+__pluginname__ = "inventory"
+__author__ = "Mikolaj Romel"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2012 Mikolaj Romel"
+__license__ = "New-style BSD"
+
+import sys
+import time
+
+from czokomaster import inventory, render
+from czokomaster.meta import __projectname__
+from czokomaster.planner import option_value
+from czokomaster.czokomanager import (get_config_option, describe_jail,
+                                      ConfigError)
+
+## The plugins whose jails the inventory is taken of, by kind of packages.
+SECTIONS = {"ports": "ports", "python": "pippy"}
+
+def version(params):
+    """
+    Print plugin version.
+    """
+
+    render.get().text(
+        "%s plugin version %s %s\n" % (__pluginname__, __version__,
+                                       __copyright__))
+
+def help(params):
+    """
+    Print plugin help.
+    """
+
+    version(params)
+    render.get().text(
+        "This plugin keeps the inventory of the ports and the python",
+        "packages installed in every system. Usage:\n\n   ",
+        "# %s %s refresh [all|base|jail1|jail2|...]\n" %
+        (__projectname__, __pluginname__),
+        "(only the systems that have changed are read again, --force",
+        "reads all of them) or, to see how the inventory is doing:\n\n   ",
+        "# %s %s status\n" % (__projectname__, __pluginname__),
+        "or, to see which systems have the package below the given",
+        "version:\n\n   ",
+        "# %s %s query Django --below 1.4\n" % (__projectname__,
+                                                 __pluginname__),
+        "or, to see what has changed in a system lately:\n\n   ",
+        "# %s %s changes jail1\n" % (__projectname__, __pluginname__),
+        "Add --ports or --python to deal with just one kind of packages,",
+        "--json to get the answer of \"query\" as a JSON document.")
+
+    sys.exit(1)
+
+def refresh(params):
+    """
+    Take the snapshots of the given systems (the ones of the ports plugin
+    and/or the pippy plugin with "all"), e.g.:
+
+        # czokomaster inventory refresh all
+        # czokomaster inventory refresh www --python --force
+
+    A system is read again only if it has changed since its last snapshot,
+    unless "--force" is given.
+    """
+
+    force = "--force" in params
+    renderer = render.get()
+
+    for kind, jails in _jails_by_kind(params):
+        started = time.time()
+
+        renderer.heading("Taking the %s inventory of %d system(s)" % \
+                         (kind, len(jails)))
+
+        for jail, kind, snapshot, changes, error in \
+            inventory.refresh_all(jails, [kind], force):
+            if error is not None:
+                renderer.item("error",
+                              renderer.highlight(describe_jail(jail)) + ":",
+                              str(error), jail=jail)
+                continue
+
+            renderer.item(changes and "warning" or "ok",
+                          renderer.highlight(describe_jail(jail)) + ":",
+                          changes and "+%d -%d ~%d" % changes or "unchanged",
+                          "(%s)" % _describe_source(snapshot), jail=jail)
+
+        renderer.item("ok", "Done in %.2f second(s)." % (time.time() - started))
+        renderer.blank()
+
+def status(params):
+    """
+    Show the snapshots kept in the inventory.
+    """
+
+    store = inventory.Inventory()
+    renderer = render.get()
+
+    try:
+        snapshots = store.snapshots()
+
+        if not snapshots:
+            renderer.item("warning", "The inventory is empty, see \"%s %s "
+                          "refresh all\"." % (__projectname__, __pluginname__))
+
+        for snapshot in snapshots:
+            count, outdated = store.count(snapshot["jail"], snapshot["kind"])
+
+            renderer.item(outdated and "outdated" or "ok",
+                          renderer.highlight(describe_jail(snapshot["jail"])),
+                          "(%s):" % snapshot["kind"],
+                          "%d package(s), %s," % \
+                          (count, snapshot["available_from"] and \
+                           "%d outdated" % outdated or "outdated not known"),
+                          snapshot["taken"] and "taken %s (%s)" % \
+                          (render.format_time(snapshot["taken"]),
+                           _describe_source(snapshot)) or "to be taken anew",
+                          jail=snapshot["jail"])
+    finally:
+        store.close()
+
+def query(params):
+    """
+    Show the systems the package is installed in (the ones having it below
+    the given version only, with "--below"), e.g.:
+
+        # czokomaster inventory query Django --below 1.4
+        # czokomaster inventory query perl --ports --json
+
+    The inventory is not refreshed, see "refresh".
+    """
+
+    below, params = option_value("--below", params)
+    words = _arguments(params)
+
+    if not words:
+        help(params)
+
+    name = words[0]
+    answer = {}
+    store = inventory.Inventory()
+
+    try:
+        for kind in _kinds(params):
+            if below is not None:
+                answer[kind] = [{"jail": jail, "installed": installed} \
+                                for jail, installed in \
+                                store.below(kind, name, below)]
+            else:
+                answer[kind] = [{"jail": jail, "installed": installed,
+                                 "available": available} \
+                                for jail, installed, available in \
+                                store.where(kind, name)]
+    finally:
+        store.close()
+
+    renderer = render.get()
+
+    if "--json" in params:
+        renderer.document("query", answer)
+        return
+
+    for kind in sorted(answer):
+        renderer.heading("%s (%s)%s" % (name, kind, below and " below %s" % \
+                                        below or ""))
+
+        if not answer[kind]:
+            renderer.item("ok", renderer.bold("None"))
+
+        for found in answer[kind]:
+            renderer.item(below and "outdated" or "ok",
+                          renderer.highlight(describe_jail(found["jail"])) + \
+                          ":", found["installed"] + \
+                          (found.get("available") and \
+                           found["available"] != found["installed"] and \
+                           " (%s)" % found["available"] or ""),
+                          jail=found["jail"], package=name)
+
+def changes(params):
+    """
+    Show what the latest snapshots of the given systems have changed, e.g.:
+
+        # czokomaster inventory changes www
+    """
+
+    jails = _arguments(params)
+
+    if not jails:
+        help(params)
+
+    kinds = _kinds(params)
+    store = inventory.Inventory()
+    renderer = render.get()
+
+    try:
+        for jail in jails:
+            renderer.heading("Changes in %s" % describe_jail(jail), jail=jail)
+
+            found = [change for change in store.changes(jail) \
+                     if change["kind"] in kinds]
+
+            if not found:
+                renderer.item("ok", renderer.bold("None"), jail=jail)
+
+            for change in found:
+                renderer.item("warning",
+                              render.format_time(change["taken"]) + ":",
+                              "%s (%s)" % (change["name"], change["kind"]),
+                              "%s -> %s" % (change["old"] or "not installed",
+                                            change["new"] or "removed"),
+                              jail=jail, package=change["name"])
+    finally:
+        store.close()
+
+def _kinds(params):
+    """
+    Return the kinds of packages asked for, i.e. --ports and/or --python
+    (both of them if none is given).
+    """
+
+    kinds = [kind for kind in inventory.KINDS if "--%s" % kind in params]
+
+    return kinds or list(inventory.KINDS)
+
+def _jails_by_kind(params):
+    """
+    Return the list of (kind, jails) to take the snapshots of. With "all",
+    the jails of the ports plugin are the ones of the ports inventory and
+    the jails of the pippy plugin are the ones of the python inventory (a
+    plugin that is not set up in the config file is left out).
+    """
+
+    if "all" not in params:
+        jails = _arguments(params)
+
+        if not jails:
+            help(params)
+
+        return [(kind, jails) for kind in _kinds(params)]
+
+    jails_by_kind = []
+
+    for kind in _kinds(params):
+        try:
+            jails_by_kind.append((kind, get_config_option(SECTIONS[kind],
+                                                          "jails")))
+        except ConfigError:
+            pass
+
+    return jails_by_kind
+
+def _arguments(params):
+    """
+    Return the arguments of the command, i.e. what is neither a flag nor the
+    value of one.
+    """
+
+    arguments = []
+
+    for param in params[3:]:
+        if not param.startswith("--"):
+            arguments.append(param)
+
+    return arguments
+
+def _describe_source(snapshot):
+    if snapshot["source"] == "files":
+        return "read from the files in %.2f second(s)" % snapshot["duration"]
+
+    return "asked \"%s\" in %.2f second(s)" % (snapshot["source"],
+                                               snapshot["duration"])
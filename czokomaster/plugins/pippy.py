@@ -9,21 +9,33 @@ __copyright__ = "Copyright (c) 2012 Mikolaj Romel"
 __license__ = "New-style BSD"
 
 import os
+import re
 import sys
 
-from termcolor import colored
+from czokomaster import inventory, fetchcache, render
 from czokomaster.meta import __projectname__
+from czokomaster.journal import Journal
+from czokomaster.rollout import is_rolling, roll_out
+from czokomaster.planner import (Plan, PlanError, apply_plan, print_left,
+                                 default_path, option_value)
 from czokomaster.czokomanager import (get_config_option, 
                                       normalize_params,
-                                      execute_command)
+                                      execute_command,
+                                      jail_command,
+                                      describe_jail,
+                                      new_engine)
+from czokomaster.plugins.plugin_helpers.pippy_cache import (load_cache,
+                                                            outdated_where,
+                                                            cache_age)
 
 def version(params):
     """
     Print plugin version.
     """
 
-    print "%s plugin version %s %s\n" % (__pluginname__, __version__,
-                                         __copyright__)
+    render.get().text(
+        "%s plugin version %s %s\n" % (__pluginname__, __version__,
+                                       __copyright__))
 
 def help(params):
     """
@@ -31,13 +43,35 @@ def help(params):
     """
 
     version(params)
-    print "This plugin upgrades the python packages installed through", \
-          "pip/easy_install.", \
-          "Usage:\n\n    # %s %s upgrade [all|base|jail1|jail2|...]\n" % \
-          (__projectname__, __pluginname__), \
-          "or, to see what is to be upgraded:\n\n   ", \
-          "# %s %s diff [all|base|jail1|jail2|...]\n" % \
-          (__projectname__, __pluginname__)
+    render.get().text(
+        "This plugin upgrades the python packages installed through",
+        "pip/easy_install.",
+        "Usage:\n\n    # %s %s upgrade [all|base|jail1|jail2|...]\n" %
+        (__projectname__, __pluginname__),
+        "or, to see what is to be upgraded:\n\n   ",
+        "# %s %s diff [all|base|jail1|jail2|...]\n" %
+        (__projectname__, __pluginname__),
+        "or, to see each outdated package once with the jails it is",
+        "outdated in:\n\n   ",
+        "# %s %s outdated [all|base|jail1|jail2|...]\n" %
+        (__projectname__, __pluginname__),
+        "An upgrade that has died halfway goes on from where it has",
+        "stopped with --resume (--dry-run shows what it has left):\n\n   ",
+        "# %s %s upgrade all --resume\n" % (__projectname__,
+                                             __pluginname__),
+        "or, to upgrade the canary jails first and then the rest of them",
+        "batch by batch, stopping once a batch fails:\n\n   ",
+        "# %s %s upgrade all --rolling\n" % (__projectname__,
+                                              __pluginname__),
+        "or, to plan the upgrade first (together with how long every",
+        "step is expected to take) and carry the plan out later:\n\n   ",
+        "# %s %s plan all --save plan.json\n   " % (__projectname__,
+                                                   __pluginname__),
+        "# %s %s apply plan.json\n" % (__projectname__, __pluginname__),
+        "or, to fetch the sdists all the systems need once, into the",
+        "fetch cache shared by the jails (add --prefetch to \"upgrade\"",
+        "to do it right before the upgrade):\n\n   ",
+        "# %s %s prefetch all\n" % (__projectname__, __pluginname__))
 
     sys.exit(1)
 
@@ -56,28 +90,174 @@ def upgrade(params):
     the config file:
     
         # czokomaster pippy upgrade all
+
+    Every package upgraded is noted in the run journal (see
+    czokomaster.journal), so an upgrade that has died halfway might be
+    resumed with "--resume". "--dry-run" shows what such an upgrade has left.
+    With "--rolling", the systems are upgraded canaries first, then batch by
+    batch (see czokomaster.rollout). With "--prefetch", the sdists are
+    fetched into the fetch cache first (see prefetch()).
     """
 
     # Get the list of jails that need to be upgraded.
     jails = normalize_params(__pluginname__, "jails", params)
+    update_after_upgrade = get_config_option(__pluginname__,
+                                             "update_after_upgrade")
+    steps = ["upgrade"] + (["refresh"] if update_after_upgrade else [])
+
+    journal = Journal(__pluginname__, "upgrade")
+
+    if "--dry-run" in params:
+        pippy_cachedir = get_config_option(__pluginname__, "pippy_cachedir")
+        journal.print_left([(jail, [update["name"] for update in \
+                                    _load_updates(pippy_cachedir,
+                                                  jail)["updates"]] + steps) \
+                            for jail in jails])
+        return
+
+    # Leave the systems upgraded by the previous run alone, if resuming it.
+    journal.start("--resume" in params)
+    left = [jail for jail in jails if \
+            [step for step in steps if not journal.is_done(jail, step)]]
+
+    # Fetch the sdists all the systems need first, every one of them once,
+    # if asked to.
+    if fetchcache.is_wanted(params) and left:
+        _prefetch(left)
+
+    # Upgrade the specified systems - as many of them at the same time as
+    # "max_parallel_jails" (or "--jobs") allows. In order to upgrade the base
+    # system's python packages as well, add "base" to the "jails" option
+    # within the config file. The cache of a system is refreshed right after
+    # its upgrade, while the rest of the systems are still being upgraded.
+    if is_rolling(params):
+        # The upgrade and the refresh of a system are a single step of the
+        # rolling upgrade.
+        roll_out(left, lambda jail: _upgrade_and_refresh(jail, journal,
+                                                         update_after_upgrade))
+    else:
+        engine = new_engine()
+
+        for jail in left:
+            upgrade = engine.submit(_upgrade_system, jail, journal,
+                                    name=describe_jail(jail), jail=jail)
+
+            if update_after_upgrade:
+                engine.submit(lambda jail, upgrade: \
+                              _postupgrade_update(jail, upgrade.result,
+                                                  journal),
+                              jail, upgrade,
+                              name="the cache refresh of %s" % \
+                                   describe_jail(jail),
+                              jail=jail, after=[upgrade])
+
+        engine.run()
+
+    journal.wrap_up([jail for jail in jails if \
+                     [step for step in steps if not journal.is_done(jail,
+                                                                    step)]])
+
+def prefetch(params):
+    """
+    Fetch the sdists of the packages to be upgraded in the given systems
+    into the fetch cache and mount the cache in the jails (see
+    czokomaster.fetchcache), e.g.:
+
+        # czokomaster pippy prefetch all
+
+    Every sdist is fetched once, no matter how many systems need it.
+    "upgrade --prefetch" does the same before the upgrade.
+    """
+
+    _prefetch(normalize_params(__pluginname__, "jails", params))
+
+def plan(params):
+    """
+    Plan the upgrade of the given systems rather than do it, e.g.:
+
+        # czokomaster pippy plan all
+        # czokomaster pippy plan base jail1 --save /root/plan.json
 
-    # If the base system's python packages are to be upgraded as well, do it 
-    # now. In order to upgrade the base system's python packages, add "base" to 
-    # the "jails" option within the config file.
-    if "base" in jails:
-        _print_upgrade_messages("the base system")
-        _upgrade("base")
+    The plan (see czokomaster.planner) is made of what "diff" says, so the
+    systems with nothing to upgrade are left out. The plan is printed
+    together with the estimates of its steps and saved (to the default plan
+    of the plugin, unless "--save" is given) for "apply". "--json" prints
+    the plan as a JSON document instead.
+    """
 
-        # Drop "base" from the list, so it does not interfere with the loop 
-        # below. Print a new line as well.
-        jails.remove("base")
-        print ""
+    path, params = option_value("--save", params)
+    jails = normalize_params(__pluginname__, "jails", params)
+    pippy_cachedir = get_config_option(__pluginname__, "pippy_cachedir")
+    update_after_upgrade = get_config_option(__pluginname__,
+                                             "update_after_upgrade")
+
+    upgrade_plan = Plan(__pluginname__)
 
-    # Upgrade specified jails.
     for jail in jails:
-        _print_upgrade_messages(jail)
-        _upgrade(jail)
-        print ""
+        updates = _load_updates(pippy_cachedir, jail)["updates"]
+
+        if not updates:
+            continue
+
+        upgrade = upgrade_plan.add("upgrade:%s" % jail, "upgrade", jail,
+                                   "upgrade the python packages of %s" % \
+                                   describe_jail(jail),
+                                   args={"updates": updates},
+                                   packages=[update["name"] for update in \
+                                             updates])
+
+        # The cache of the system is refreshed right after its upgrade,
+        # while the rest of the systems are still being upgraded.
+        if update_after_upgrade:
+            upgrade_plan.add("refresh:%s" % jail, "refresh", jail,
+                             "refresh the cache of %s" % describe_jail(jail),
+                             after=[upgrade])
+
+    upgrade_plan.estimate()
+    path = upgrade_plan.save(path)
+
+    renderer = render.get()
+
+    if "--json" in params:
+        renderer.document("plan", upgrade_plan.to_dict())
+        return
+
+    upgrade_plan.show()
+
+    renderer.item("info", "Saved to %s. Carry it out with:" % path)
+    renderer.blank()
+    renderer.text("    # %s %s apply %s" % (__projectname__, __pluginname__,
+                                            path))
+    renderer.blank()
+
+def apply(params):
+    """
+    Carry out the plan made by "plan" (the default plan of the plugin, if no
+    path is given), e.g.:
+
+        # czokomaster pippy apply /root/plan.json
+
+    An apply that has died halfway is resumed with "--resume" (the packages
+    upgraded by then are not upgraded again), "--dry-run" shows what it has
+    left.
+    """
+
+    paths = [param for param in params[3:] if not param.startswith("--")]
+
+    try:
+        upgrade_plan = Plan.load(paths and paths[0] or \
+                                 default_path(__pluginname__), __pluginname__)
+    except PlanError, error:
+        render.get().item("error", "%s." % str(error).capitalize())
+        sys.exit(1)
+
+    if "--dry-run" in params:
+        print_left(upgrade_plan)
+        return
+
+    apply_plan(upgrade_plan, {"upgrade": _apply_upgrade,
+                              "refresh": _apply_refresh},
+               "--resume" in params)
 
 def diff(params):
     """
@@ -90,63 +270,200 @@ def diff(params):
     jails = normalize_params(__pluginname__, "jails", params)
     pippy_cachedir = get_config_option(__pluginname__, "pippy_cachedir")
 
-    if "base" in jails:
-        # Print the packages that need to be updated.
-        _print_updates(pippy_cachedir + os.sep + "base", "the base system")
+    for jail in jails:
+        _print_updates(pippy_cachedir, jail)
 
-        # Remove "base", so it does not interfere with the loop below.
-        jails.remove("base")
+def outdated(params):
+    """
+    Show each outdated package once, together with the jails it is outdated
+    in and the versions installed there, e.g.:
 
-    for jail in jails:
-        _print_updates(pippy_cachedir + os.sep + jail, jail)
+        # czokomaster pippy outdated all
+    """
+
+    jails = normalize_params(__pluginname__, "jails", params)
+    pippy_cachedir = get_config_option(__pluginname__, "pippy_cachedir")
+
+    outdated = outdated_where(pippy_cachedir, jails, _load_updates)
+    renderer = render.get()
 
+    if not outdated:
+        renderer.item("ok", renderer.bold("None"))
+        renderer.blank()
 
-def _get_updates(filename):
+    for name in sorted(outdated, key=lambda name: name.lower()):
+        renderer.item("outdated", renderer.bold(name), package=name)
+
+        for jail, installed, available in outdated[name]:
+            renderer.text("   ", renderer.highlight(describe_jail(jail)) + ":",
+                          installed, "(%s)" % available, jail=jail,
+                          package=name)
+
+def _prefetch(jails):
     """
-    Get the list of the udpates.
+    Fetch the sdists of the packages to be upgraded in the given systems of
+    this host into the fetch cache - every version of a package once. The
+    sdists are looked up in the index of "index_url" (see
+    pippy_version_index), then the cache is mounted in the jails.
     """
 
-    f = open(filename, "r")
-    updates = f.readlines()
-    f.close()
+    from czokomaster.plugins.plugin_helpers.pippy_version_index import \
+         VersionIndex, download, normalize_name
+
+    pippy_cachedir = get_config_option(__pluginname__, "pippy_cachedir")
+    jails = fetchcache.local_jails(jails)
+    cache = fetchcache.from_config()
+    index = VersionIndex(get_config_option(__pluginname__, "index_url"),
+                         os.path.join(pippy_cachedir, ".versions"),
+                         get_config_option(__pluginname__, "upstream_ttl"))
+
+    renderer = render.get()
+    renderer.heading("[Python] Prefetching the sdists of the packages to "
+                     "upgrade")
+
+    # The union of the updates of all the systems.
+    artifacts = []
+    seen = set()
+
+    for jail in jails:
+        for update in _load_updates(pippy_cachedir, jail)["updates"]:
+            key = (normalize_name(update["name"]), update["available"])
+
+            if key not in seen:
+                seen.add(key)
+                artifacts.append(("%s %s" % (update["name"],
+                                             update["available"]),
+                                  (update["name"], update["available"])))
+
+    # Where each sdist is downloaded from.
+    urls = {}
+
+    def files_of(artifact):
+        found = index.sdist(*artifact)
+
+        if found is None:
+            return None
+
+        filename, url = found
+        urls[os.path.join("sdists", filename)] = url
+
+        return [os.path.join("sdists", filename)]
 
-    return updates
+    def fetch(artifact, files):
+        renderer.item("info", "Downloading %s." % urls[files[0]])
 
-def _print_updates(filename, system_name):
+        return download(urls[files[0]], cache.path(files[0]))
+
+    fetchcache.prefetch(cache, artifacts, files_of, fetch)
+    fetchcache.expose(jails)
+
+def _print_updates(pippy_cachedir, jail):
     """
     Check whether there are any updates and return them if so. Also, print some
     info.
     """
 
-    print colored("[Python]", "yellow", attrs=["bold"]), \
-          "Available updates for", colored(system_name, "cyan") + ":"
+    renderer = render.get()
+    renderer.text(renderer.paint("[Python]", "yellow", ["bold"]),
+                  "Available updates for",
+                  renderer.highlight(describe_jail(jail)) + ":", jail=jail)
 
     # Get the list of the udpates.
-    updates = _get_updates(filename)
+    cache = _load_updates(pippy_cachedir, jail)
+    _warn_if_stale(cache)
 
     # If not empty, show packages that need updating. Else, print "None".
-    if updates:
-        for update in updates:
-            print colored("->", "red"), update.replace("\n", "")
-        # Print a new line.
-        print ""
-
+    if cache["updates"]:
+        for update in cache["updates"]:
+            renderer.item("outdated", "%s %s (%s)" % (update["name"],
+                          update["installed"], update["available"]),
+                          jail=jail, package=update["name"])
     else:
-        print colored("->", "green"), colored("None\n", attrs=["bold"])
+        renderer.item("ok", renderer.bold("None"), jail=jail)
+
+    # Print a new line.
+    renderer.blank()
+
+def _load_updates(pippy_cachedir, jail):
+    """
+    Return the cache of the system (see pippy_cache). With "use_inventory =
+    yes", the updates are found out of the inventory instead (see
+    czokomaster.inventory) - it is refreshed on the way, so the packages
+    installed since the last refresh of the cache are seen straight away.
+    "refreshed" is when the latest versions were looked up then.
+    """
+
+    if inventory.is_used():
+        packages, snapshot = inventory.outdated(jail, "python")
+
+        if packages is not None:
+            try:
+                refreshed = os.path.getmtime(snapshot["available_from"])
+            except OSError:
+                refreshed = None
+
+            return {"jail": jail, "refreshed": refreshed,
+                    "duration": snapshot["duration"], "source": "inventory",
+                    "updates": [{"name": package["name"],
+                                 "installed": package["installed"],
+                                 "available": package["available"]} \
+                                for package in packages]}
+
+    return load_cache(pippy_cachedir, jail)
+
+def _warn_if_stale(cache):
+    """
+    Warn if the cache has not been refreshed for longer than "cache_max_age"
+    hours (or has never been refreshed at all).
+    """
+
+    max_age = get_config_option(__pluginname__, "cache_max_age")
+    age = cache_age(cache)
+
+    if age is None:
+        render.get().item("warning", "The cache has never been refreshed.",
+                          jail=cache.get("jail"))
+    elif max_age and age > max_age:
+        render.get().item("warning", "The cache is %d hours old." % age,
+                          jail=cache.get("jail"))
 
 def _print_upgrade_messages(system_name):
     """
     Print information concerning the upgrade process.
     """
 
-    print colored("==>", "green"), \
-          colored("[Python]", "red", attrs=["bold"]), \
-          colored("Upgrading py-packages in", attrs=["bold"]), \
-          colored(system_name, "cyan") + colored(":", attrs=["bold"])
+    render.get().heading("[Python] Upgrading py-packages in",
+                         describe_jail(system_name), jail=system_name)
 
-def _upgrade(system_name):
+def _upgrade_system(system_name, journal):
     """
-    Do the actual upgrade.
+    Print the upgrade messages and upgrade a single system.
+    """
+
+    _print_upgrade_messages(system_name)
+    results = _upgrade(system_name, journal)
+    render.get().blank()
+
+    return results
+
+def _upgrade_and_refresh(system_name, journal, update_after_upgrade):
+    """
+    Upgrade a single system and refresh its cache right after, if asked to.
+    Return True if none of the packages has failed.
+    """
+
+    results = _upgrade_system(system_name, journal)
+
+    if update_after_upgrade:
+        _postupgrade_update(system_name, results, journal)
+
+    return "failed" not in results.values()
+
+def _upgrade(system_name, journal):
+    """
+    Do the actual upgrade. The packages upgraded by the run being resumed
+    are left out, the ones upgraded now are noted in the journal. So is the
+    system, once none of its packages has failed.
     """
 
     # Get the path to the cache files which contain the information on what
@@ -156,43 +473,213 @@ def _upgrade(system_name):
     py_upgrade_cmd = get_config_option(__pluginname__, "py_upgrade_cmd")
 
     # Get the list of packages that need to be upgraded.
-    updates = _get_updates(pippy_cachedir + os.sep + system_name)
- 
-    # Do the actual upgrade.
+    updates = [update for update in _load_updates(pippy_cachedir,
+                                                  system_name)["updates"] \
+               if not journal.is_done(system_name, update["name"])]
+
     if updates:
-        if system_name == "base":
-            for update in updates:
-                HERE
-                execute_command(["%s %s" % (py_upgrade_cmd, update.split()[0])])
-        else:
-            # It means we operate on jails now.
-            for update in updates:
-                execute_command(["jexec %s %s %s" % \
-                                (system_name, py_upgrade_cmd, \
-                                 update.split()[0])])
-
-        # Do postupgrade update if specified in the config.
-        _postupgrade_update(system_name)
+        results = _upgrade_updates(system_name, py_upgrade_cmd, updates,
+                                   journal)
+
+        if "failed" not in results.values():
+            journal.complete(system_name, "upgrade")
+
+        return results
+    else:
+        renderer = render.get()
+        renderer.item("ok", renderer.bold("Nothing to upgrade."),
+                      jail=system_name)
+        journal.complete(system_name, "upgrade")
+
+        return {}
+
+def _upgrade_updates(system_name, py_upgrade_cmd, updates, journal):
+    """
+    Upgrade the given packages of the system and note every package that
+    has not failed in the journal. Return the results (see
+    _upgrade_batch()).
+    """
+
+    packages = [update["name"] for update in updates]
+
+    # Do the actual upgrade. Either all the packages at once (and then only
+    # the ones that failed, one by one) or each package on its own.
+    if get_config_option(__pluginname__, "py_batch_upgrade"):
+        results = _upgrade_batch(system_name, py_upgrade_cmd, updates)
+
+        for package in packages:
+            if results[package] != "failed":
+                journal.complete(system_name, package)
     else:
-        print colored("->", "green"), \
-              colored("Nothing to upgrade.", attrs=["bold"])
+        results = {}
+
+        for package in packages:
+            results[package] = _upgrade_package(system_name, py_upgrade_cmd,
+                                                package)
+
+            if results[package] != "failed":
+                journal.complete(system_name, package)
+
+    _print_upgrade_results(system_name, packages, results)
+
+    return results
+
+def _apply_upgrade(step, journal):
+    """
+    Do an "upgrade" step of the plan, i.e. upgrade the packages planned
+    (the ones upgraded by the apply being resumed are left out). Return True
+    if none of them has failed.
+    """
+
+    system_name = step["jail"]
+    py_upgrade_cmd = get_config_option(__pluginname__, "py_upgrade_cmd")
+    updates = [update for update in step["args"]["updates"] \
+               if not journal.is_done(system_name, update["name"])]
+
+    _print_upgrade_messages(system_name)
+
+    renderer = render.get()
+
+    if not updates:
+        renderer.item("ok", renderer.bold("Nothing to upgrade."),
+                      jail=system_name)
+        renderer.blank()
+        return True
+
+    results = _upgrade_updates(system_name, py_upgrade_cmd, updates, journal)
+    renderer.blank()
+
+    return "failed" not in results.values()
+
+def _apply_refresh(step, journal):
+    """
+    Do a "refresh" step of the plan, i.e. refresh the cache of the system.
+    """
 
-def _postupgrade_update(system_name):
+    _refresh_cache(step["jail"])
+
+    return True
+
+def _upgrade_package(system_name, py_upgrade_cmd, package):
+    """
+    Upgrade a single package. Return "upgraded" or "failed".
+    """
+
+    returncodes = execute_command([jail_command(system_name, "%s %s" % \
+                                  (py_upgrade_cmd, package))])
+
+    return "upgraded" if returncodes == [0] else "failed"
+
+def _upgrade_batch(system_name, py_upgrade_cmd, updates):
+    """
+    Upgrade all the packages with a single py_upgrade_cmd call, so the
+    interpreter is started and the index is asked once rather than once per
+    package. If the call fails, find out which packages are still at their
+    old versions and try to upgrade each of them on its own.
+
+    Return the dict of the results: package name -> "upgraded", "retried"
+    (i.e. upgraded on its own after the batch failed) or "failed".
+    """
+
+    old_versions = dict([(update["name"], update["installed"]) \
+                         for update in updates])
+    packages = [update["name"] for update in updates]
+
+    returncodes = execute_command([jail_command(system_name, "%s %s" % \
+                                  (py_upgrade_cmd, " ".join(packages)))])
+
+    if returncodes == [0]:
+        return dict([(package, "upgraded") for package in packages])
+
+    # Some of the packages failed - see which ones are still at the old
+    # version (or are not there at all).
+    installed = _get_installed(system_name)
+    results = {}
+
+    for package in packages:
+        version = installed.get(package.lower())
+
+        if version is not None and version != old_versions.get(package):
+            results[package] = "upgraded"
+        else:
+            renderer = render.get()
+            renderer.item("warning", "Retrying", renderer.bold(package),
+                          "on its own.", jail=system_name, package=package)
+
+            if _upgrade_package(system_name, py_upgrade_cmd,
+                                package) == "upgraded":
+                results[package] = "retried"
+            else:
+                results[package] = "failed"
+
+    return results
+
+def _get_installed(system_name):
+    """
+    Return the dict of the python packages installed in the given system:
+    lowercased package name -> version. The output of "yolk -l" looks like
+    "Django          - 1.4          - active".
+    """
+
+    py_installed_cmd = get_config_option(__pluginname__, "py_installed_cmd")
+    stdout, stderr = execute_command([jail_command(system_name,
+                                     py_installed_cmd)], func_return=True)
+
+    installed = {}
+
+    for line in (stdout or "").splitlines():
+        match = re.match(r"\s*(\S+)\s+-\s+(\S+)", line)
+
+        if match:
+            installed[match.group(1).lower()] = match.group(2)
+
+    return installed
+
+def _print_upgrade_results(system_name, packages, results):
+    """
+    Print how the upgrade went for each package.
+    """
+
+    renderer = render.get()
+    statuses = {"upgraded": "ok", "retried": "warning", "failed": "error"}
+
+    for package in packages:
+        status = statuses[results[package]]
+        renderer.item(status, package + ":",
+                      renderer.paint(results[package],
+                                     render.STATUS_COLORS[status], ["bold"]),
+                      jail=system_name, package=package)
+
+def _postupgrade_update(system_name, results, journal):
     """
     If update_after_upgrade is set to "yes", update the py packages list
-    that need upgrading after the upgrade is complete.
+    that need upgrading after the upgrade is complete. "results" are the
+    results of the upgrade - nothing is done if there was nothing to upgrade
+    (now or in the run being resumed).
     """
 
-    config = get_config_option(__pluginname__, "update_after_upgrade")
+    upgraded = [step for step in journal.completed(system_name) \
+                if step not in ("upgrade", "refresh")]
+
+    if results or upgraded:
+        _refresh_cache(system_name)
+
+    journal.complete(system_name, "refresh")
+
+def _refresh_cache(system_name):
+    """
+    Find out anew what is to be upgraded in the system and write it down
+    into its cache.
+    """
 
-    if config.lower() == "yes":
-        from czokomaster.plugins.plugin_helpers.pippy_cron_helper import \
-             PythonUpdateChecker
+    from czokomaster.plugins.plugin_helpers.pippy_cron_helper import \
+         PythonUpdateChecker
 
-        print colored("->", "blue"), \
-              colored("Updating the cache file...", attrs=["bold"])
+    renderer = render.get()
+    renderer.item("info", renderer.bold("Updating the cache file..."),
+                  jail=system_name)
 
-        update = PythonUpdateChecker()
-        update.get_updates([system_name])
-        print colored("->", "green"), colored("Done.", attrs=["bold"])
-        print ""
\ No newline at end of file
+    update = PythonUpdateChecker()
+    update.get_updates([system_name])
+    renderer.item("ok", renderer.bold("Done."), jail=system_name)
+    renderer.blank()
@@ -0,0 +1,140 @@
+"""
+This is the cache of the python packages that need to be updated, one file
+per jail in the pippy cache dir (named after the jail). The file is written
+by the pippy-cron-helper and read by "czokomaster pippy diff/upgrade". It is
+a JSON document:
+
+  {
+   "jail": "www",
+   "refreshed": 1334300000.0,     - when the cache was refreshed (unix time);
+   "duration": 1.2,               - how long the refresh took (in seconds);
+   "source": "site-packages",     - how the updates were found, i.e. the
+                                    "site-packages" inventory or the command
+                                    run in the jail (e.g. "yolk -U");
+   "updates": [
+    {"name": "Django", "installed": "1.3.1", "available": "1.4"},
+    ...
+   ]
+  }
+
+The files written by the older versions of czokomaster (the plain output of
+"yolk -U") are still read, until the helper replaces them.
+"""
+
+__helpername__ = "pippy-cache"
+__author__ = "Mikolaj Romel"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2012 Mikolaj Romel"
+__license__ = "New-style BSD"
+
+import os
+import re
+import json
+import time
+import threading
+
+from czokomaster import files
+
+# The lines of "yolk -U", e.g. "Django 1.3.1 (1.4)".
+YOLK_LINE_RE = re.compile(r"^\s*(\S+)\s+(\S+)\s+\((\S+)\)")
+
+# The caches loaded so far: path -> (mtime, cache). A cache file is loaded
+# once per process, unless it changes.
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+def load_cache(cachedir, jail):
+    """
+    Return the cache of the jail (see the top of the module). A jail without
+    a cache file gets an empty list of updates and "refreshed" set to None.
+    """
+
+    path = os.path.join(cachedir, jail)
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return {"jail": jail, "refreshed": None, "duration": None,
+                "source": None, "updates": []}
+
+    with _loaded_lock:
+        if path in _loaded and _loaded[path][0] == mtime:
+            return _loaded[path][1]
+
+    f = open(path, "r")
+    data = f.read()
+    f.close()
+
+    try:
+        cache = json.loads(data)
+    except ValueError:
+        # The old plain "yolk -U" output.
+        cache = {"jail": jail, "refreshed": mtime, "duration": None,
+                 "source": "yolk -U", "updates": parse_yolk(data)}
+
+    with _loaded_lock:
+        _loaded[path] = (mtime, cache)
+
+    return cache
+
+def save_cache(cachedir, jail, updates, source, duration=None):
+    """
+    Write the cache of the jail down. "updates" is the list of the dicts with
+    "name", "installed" and "available" keys. The file is written atomically,
+    so the readers never see it half-written.
+    """
+
+    files.write_atomically(os.path.join(cachedir, jail), json.dumps({
+        "jail": jail,
+        "refreshed": time.time(),
+        "duration": duration,
+        "source": source,
+        "updates": updates,
+    }, indent=1, sort_keys=True))
+
+def parse_yolk(output):
+    """
+    Return the list of the updates (see save_cache()) out of the output of
+    "yolk -U".
+    """
+
+    updates = []
+
+    for line in output.splitlines():
+        match = YOLK_LINE_RE.match(line)
+
+        if match:
+            name, installed, available = match.groups()
+            updates.append({"name": name, "installed": installed,
+                            "available": available})
+
+    return updates
+
+def outdated_where(cachedir, jails, load=load_cache):
+    """
+    Answer "what is outdated where" for the given jails at once. Return the
+    dict: package name -> list of (jail, installed, available), the jails in
+    the given order. The caches are loaded by load(cachedir, jail), which
+    might give them out of somewhere else than the cache files (see
+    "use_inventory").
+    """
+
+    outdated = {}
+
+    for jail in jails:
+        for update in load(cachedir, jail)["updates"]:
+            outdated.setdefault(update["name"], []).append(
+                (jail, update["installed"], update["available"]))
+
+    return outdated
+
+def cache_age(cache):
+    """
+    Return how old (in hours) the cache is or None if it has never been
+    refreshed.
+    """
+
+    if cache["refreshed"] is None:
+        return None
+
+    return (time.time() - cache["refreshed"]) / 3600.0
@@ -1,31 +1,65 @@
 #!/usr/bin/env python
 """
 This is a standalone scripy to be run from cron. It gathers the information
-about the python packages that need to be updated. Why here, not in in 
+about the python packages that need to be updated. Why here, not in in
 czokomaster itself? Because, yolk -U takes approximately 1,5 minute for one jail
 (not heavily populated with python packages anyway), to show the respective
 updates. This is far too long. Thus, this script should gather, possibly daily,
-information about new versions of python packages available on pip. This 
-information is then written to the respective files. Then, when the following 
+information about new versions of python packages available on pip. This
+information is then written to the respective files. Then, when the following
 command is issued:
 
   # czokomaster pippy diff all
 
 the possible updates will be shown for all of the jails (+ the base system) in
 no time rather than 10 minutes.
+
+Nowadays, the script does not run "yolk -U" in every jail, though. It reads
+the installed distributions straight from the site-packages directories of
+the jails (as seen from the host) and keeps them in the inventory file
+(".inventory" within the cache dir), together with the fingerprint of these
+directories. A jail is read again only if its fingerprint changes. The latest
+versions come from the version index shared by all the jails (see
+pippy_version_index) - a package is looked up there once per package name,
+and only if it has not been looked up within "upstream_ttl" hours. The cache
+files of all the jails are derived from that single index. The jails whose
+site-packages cannot be reached are still asked "yolk -U".
+
+The jails are refreshed in parallel (see "max_parallel_jails"), so a full
+refresh takes about as long as the slowest jail does. The cache files (see
+pippy_cache for their format) are replaced atomically and note when each
+jail was refreshed and how long it took.
 """
 
 __helpername__ = "pippy-cron-helper"
 __author__ = "Mikolaj Romel"
-__version__ = "1.0"
+__version__ = "1.1"
 __copyright__ = "Copyright (c) 2012 Mikolaj Romel"
 __license__ = "New-style BSD"
 
 import os
+import re
+import time
+import json
+import fcntl
 import os.path
 
+from pkg_resources import parse_version
+
+from czokomaster import files
 from czokomaster.meta import CZOKOMASTER_CONFIG_PATH
-from czokomaster.czokomanager import get_config_option, execute_command
+from czokomaster.czokomanager import (get_config_option, execute_command,
+                                      jail_command, jail_root, run_in_jails,
+                                      get_max_parallel_jails, JobError)
+from czokomaster.plugins.plugin_helpers.pippy_version_index import \
+     VersionIndex
+from czokomaster.plugins.plugin_helpers.pippy_cache import (save_cache,
+                                                            parse_yolk)
+
+# The site-packages entries the installed distributions are recognised by,
+# e.g. Django-1.4-py2.7.egg-info, yolk-0.4.3-py2.7.egg or foo-1.0.dist-info.
+DISTRIBUTION_RE = re.compile(r"^([^-]+)-([^-]+?)(-py\d.*)?"
+                             r"\.(egg-info|dist-info|egg)$")
 
 class PythonUpdateChecker:
     """
@@ -44,10 +78,24 @@ class PythonUpdateChecker:
         if not os.path.exists(self.pippy_cachedir):
             os.makedirs(self.pippy_cachedir, 0700)
 
+        # Load what is known from the previous runs.
+        self.inventory_path = os.path.join(self.pippy_cachedir, ".inventory")
+        self.inventory = {"jails": {}}
+
+        # How long the refresh of each jail took.
+        self.durations = {}
+
+        if os.path.exists(self.inventory_path):
+            f = open(self.inventory_path, "r")
+            self.inventory.update(json.load(f))
+            f.close()
+
     def get_updates(self, system_name=None):
         """
-        Get the information which python packages need to be updated. Use 
-        "yolk -U" to get this info.
+        Get the information which python packages need to be updated. The
+        installed distributions are read from the site-packages directories,
+        the latest versions are looked up in the version index. "yolk -U"
+        is used for the jails whose site-packages cannot be read.
 
         Attributes:
 
@@ -63,37 +111,146 @@ class PythonUpdateChecker:
             # Get the names of the jails. Afterwards, list and save the update list.
             self.jails = get_config_option("pippy", "jails")
 
-        # Show updates for the base system.
-        if "base" in self.jails:
-            update, error = execute_command(["yolk -U"], func_return=True)
-            self._save_updates("base", update)
+        # First, take the inventory of every jail - as many jails at the
+        # same time as "max_parallel_jails" allows.
+        installed = {}
+
+        for jail, packages, error in run_in_jails(self.jails,
+                                                  self._refresh_jail):
+            if packages is not None:
+                installed[jail] = packages
+
+        # Then, look the latest version of each package up once, no matter
+        # how many jails it is installed in.
+        names = set()
+
+        for packages in installed.values():
+            names.update(packages.keys())
 
-            # Remove "base" from the list, so it is not invoked in the loop
-            # below.
-            self.jails.remove("base")
+        index = VersionIndex(get_config_option("pippy", "index_url"),
+                             os.path.join(self.pippy_cachedir, ".versions"),
+                             get_config_option("pippy", "upstream_ttl"))
+        latest = index.latest(names, jobs=get_max_parallel_jails())
+        index.save()
 
-        for jail in self.jails:
-            update, error = execute_command(["jexec %s yolk -U" % \
-                                            jail], func_return=True)
+        # Finally, compare what is installed with what is available.
+        for jail, packages in installed.items():
+            updates = []
 
-            self._save_updates(jail, update)
+            for name in sorted(packages, key=lambda name: name.lower()):
+                version = packages[name]
 
-    def _save_updates(self, filename, update_list):
+                if latest.get(name) and \
+                   parse_version(latest[name]) > parse_version(version):
+                    updates.append({"name": name, "installed": version,
+                                    "available": latest[name]})
+
+            save_cache(self.pippy_cachedir, jail, updates, "site-packages",
+                       self.durations[jail])
+
+        self._save_inventory()
+
+    def _refresh_jail(self, jail):
         """
-        Helper function - save the output of "yolk -U" to the respective
-        files named after the jails.
+        Take the inventory of a single jail and note how long it took. Return
+        the dict of the installed distributions or None if the jail had to be
+        asked "yolk -U" (its cache is written straight away then). If "yolk
+        -U" fails, the cache of the jail is left as it is and JobError is
+        raised.
         """
 
-        self.filename = filename
-        # Process the list, so there are no whitespaces at the beginning of 
-        # each verse.
-        self.update_list = update_list.strip().replace("\n ", "\n")
-        jail_cachefile = self.pippy_cachedir + os.sep + self.filename
+        started = time.time()
+        packages = self._get_installed(jail)
+
+        if packages is None:
+            # The site-packages of the jail cannot be reached from here,
+            # so ask yolk within the jail.
+            update, error = execute_command([jail_command(jail, "yolk -U")],
+                                            func_return=True)
+
+            # The last answer of the jail is better than none - "no updates"
+            # would be believed until the next refresh.
+            if error.strip():
+                raise JobError("yolk -U has failed: %s" % error.strip())
+
+            save_cache(self.pippy_cachedir, jail, parse_yolk(update),
+                       "yolk -U", time.time() - started)
+
+        self.durations[jail] = time.time() - started
+
+        return packages
+
+    def _get_installed(self, jail):
+        """
+        Return the dict of the distributions installed in the jail (name ->
+        version) or None if the site-packages of the jail cannot be reached.
+        The directories are read again only if their fingerprint has
+        changed since the last run.
+        """
+
+        root = jail_root(jail)
+
+        # The jail is on another host.
+        if root is None:
+            return None
+
+        directories = [os.path.join(root, path.lstrip(os.sep)) \
+                       for path in get_config_option("pippy",
+                                                     "site_packages")]
+        directories = [path for path in directories if os.path.isdir(path)]
+
+        if not directories:
+            return None
+
+        fingerprint = files.fingerprint(directories, DISTRIBUTION_RE)
+        known = self.inventory["jails"].get(jail)
+
+        if known and known["fingerprint"] == fingerprint:
+            return known["packages"]
+
+        packages = {}
+
+        for directory in directories:
+            for entry in os.listdir(directory):
+                match = DISTRIBUTION_RE.match(entry)
+
+                if match:
+                    # The dashes in the names are kept as underscores.
+                    packages[match.group(1).replace("_", "-")] = \
+                        match.group(2)
+
+        self.inventory["jails"][jail] = {"fingerprint": fingerprint,
+                                         "packages": packages}
+
+        return packages
+
+    def _save_inventory(self):
+        """
+        Write the inventory down for the next run. Other refreshes (e.g. the
+        ones after "pippy upgrade" of other jails) might be writing it at the
+        same time, so only the jails refreshed now are put over whatever is
+        in the file at the moment.
+        """
+
+        lock = open(self.inventory_path + ".lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            inventory = {"jails": {}}
+
+            if os.path.exists(self.inventory_path):
+                f = open(self.inventory_path, "r")
+                inventory.update(json.load(f))
+                f.close()
+
+            for jail in self.jails:
+                if jail in self.inventory["jails"]:
+                    inventory["jails"][jail] = self.inventory["jails"][jail]
 
-        f = open(jail_cachefile, "w")
-        f.write(self.update_list)
-        f.close()
+            files.write_atomically(self.inventory_path, json.dumps(inventory))
+        finally:
+            lock.close()
 
 if __name__ == "__main__":
     update = PythonUpdateChecker()
-    update.get_updates()
\ No newline at end of file
+    update.get_updates()
@@ -0,0 +1,320 @@
+"""
+This is the host-side index of the latest versions of the python packages,
+shared by all the jails. The latest version of a package is looked up once
+per package name - no matter how many jails the package is installed in - and
+kept in the store file for "upstream_ttl" hours.
+
+The versions are looked up in a "simple" package index, i.e. the one that
+lists the files of a package under <index>/<package name>/. It might be
+PyPI itself (https://pypi.python.org/simple/), a local mirror, a file:// URL
+or simply a local directory holding a subdirectory of files per package -
+the latter is handy when there is no network at hand (e.g. when testing).
+"""
+
+__helpername__ = "pippy-version-index"
+__author__ = "Mikolaj Romel"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2012 Mikolaj Romel"
+__license__ = "New-style BSD"
+
+import os
+import re
+import time
+import json
+import fcntl
+import urllib
+import hashlib
+import tempfile
+import urllib2
+import urlparse
+
+from pkg_resources import parse_version
+
+from czokomaster import files
+from czokomaster.engine import JobEngine, JobError
+
+# The extensions of the files a package is distributed in.
+EXTENSIONS = (".tar.gz", ".tar.bz2", ".tgz", ".zip", ".egg", ".whl", ".exe")
+
+# The extensions of the source distributions, the preferred ones first.
+SDIST_EXTENSIONS = (".tar.gz", ".tar.bz2", ".tgz", ".zip")
+
+# The versions that are not to be upgraded to, e.g. 1.4b1, 1.4rc1, 1.4.dev2.
+PRERELEASE_RE = re.compile(r"(a|b|c|rc|alpha|beta|pre|preview|dev)\d*$")
+
+# The links found on the index pages.
+HREF_RE = re.compile(r"""href=["']([^"']+)["']""", re.I)
+
+def normalize_name(name):
+    """
+    Return the name of the package the way the index knows it, e.g.
+    "Django_Tagging" becomes "django-tagging".
+    """
+
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def download(url, path):
+    """
+    Download the file (a local path or a file:// URL will do as well) to
+    the given path. The file is written under a temporary name and renamed
+    once it is complete (and matches the "#md5=" of the URL, if it has
+    got one), so a half-downloaded file is never left behind. Return True
+    if the file has been downloaded.
+    """
+
+    scheme, netloc, path_of_url, params, query, fragment = \
+            urlparse.urlparse(url)
+
+    try:
+        if scheme in ("", "file"):
+            source = open(urllib.url2pathname(path_of_url), "rb")
+        else:
+            source = urllib2.urlopen(url.split("#")[0], timeout=60)
+    except IOError:
+        return False
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         prefix=".download.")
+    target = os.fdopen(handle, "wb")
+    digest = hashlib.md5()
+
+    try:
+        while True:
+            data = source.read(65536)
+
+            if not data:
+                break
+
+            digest.update(data)
+            target.write(data)
+    except IOError:
+        target.close()
+        os.remove(temp_path)
+        return False
+    finally:
+        source.close()
+
+    target.close()
+
+    if fragment.startswith("md5=") and fragment[4:] != digest.hexdigest():
+        os.remove(temp_path)
+        return False
+
+    os.chmod(temp_path, 0644)
+    os.rename(temp_path, path)
+
+    return True
+
+class VersionIndex:
+    """
+    Look up the latest versions of the python packages.
+    """
+
+    def __init__(self, index_url, store_path, ttl):
+        """
+        Load the versions looked up so far. "ttl" is the number of hours a
+        version is trusted for before it is looked up again.
+        """
+
+        self.index_url = index_url
+        self.store_path = store_path
+        self.ttl = ttl * 3600
+        self.store = {}
+
+        if os.path.exists(self.store_path):
+            f = open(self.store_path, "r")
+            self.store = json.load(f)
+            f.close()
+
+    def latest(self, names, jobs=1):
+        """
+        Return the dict of the latest versions of the given packages (name ->
+        version or None if the package is not in the index). Only the
+        packages not known yet or known for longer than the TTL are looked
+        up in the index - "jobs" of them at the same time. A lookup that has
+        failed (e.g. the index cannot be reached) is not kept, so the package
+        is looked up again by the next run - the version known before (if
+        any) is returned meanwhile.
+        """
+
+        stale = [name for name in set(names) if self._is_stale(name)]
+
+        # Look the stale packages up.
+        engine = JobEngine(jobs)
+
+        for name in stale:
+            engine.submit(self.lookup, name, name=name)
+
+        for job in engine.run():
+            if job.state == "done":
+                self.store[normalize_name(job.args[0])] = {
+                    "version": job.result, "checked": time.time()}
+
+        latest = {}
+
+        for name in set(names):
+            known = self.store.get(normalize_name(name))
+            latest[name] = known["version"] if known else None
+
+        return latest
+
+    def lookup(self, name):
+        """
+        Look the latest version of the package up in the index. The
+        pre-releases are left out.
+        """
+
+        versions = []
+
+        for filename in self._list_files(name):
+            version = self._parse_version(name, filename)
+
+            if version and not PRERELEASE_RE.search(version.lower()):
+                versions.append(version)
+
+        if not versions:
+            return None
+
+        return max(versions, key=parse_version)
+
+    def _is_stale(self, name):
+        """
+        Whether the package should be looked up in the index again.
+        """
+
+        known = self.store.get(normalize_name(name))
+
+        return not known or time.time() - known["checked"] > self.ttl
+
+    def save(self):
+        """
+        Write the store down. The temporary file is renamed over the old
+        store, so it is never left half-written. Whatever has been written
+        in the meantime by others is kept, unless looked up earlier than
+        here.
+        """
+
+        lock = open(self.store_path + ".lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            if os.path.exists(self.store_path):
+                f = open(self.store_path, "r")
+                store = json.load(f)
+                f.close()
+
+                for key, known in store.items():
+                    if key not in self.store or \
+                       known["checked"] > self.store[key]["checked"]:
+                        self.store[key] = known
+
+            files.write_atomically(self.store_path, json.dumps(self.store),
+                                   0600)
+        finally:
+            lock.close()
+
+    def sdist(self, name, version):
+        """
+        Return (file name, URL) of the source distribution of the given
+        version of the package or None if the index has got none. The URL
+        might be a local path as well (see the top of the module).
+        """
+
+        found = {}
+
+        for filename, url in self._list_links(name):
+            if self._parse_version(name, filename) == version:
+                for extension in SDIST_EXTENSIONS:
+                    if filename.lower().endswith(extension):
+                        found.setdefault(extension, (filename, url))
+
+        for extension in SDIST_EXTENSIONS:
+            if extension in found:
+                return found[extension]
+
+        return None
+
+    def _list_files(self, name):
+        """
+        Return the names of the files of the package listed in the index.
+        """
+
+        return [filename for filename, url in self._list_links(name)]
+
+    def _list_links(self, name):
+        """
+        Return (file name, URL) of the files of the package listed in the
+        index - none if the package is not there. JobError is raised if the
+        index cannot be read, as it is not known whether the package is
+        there.
+        """
+
+        scheme, netloc, path = urlparse.urlparse(self.index_url)[:3]
+
+        # A local directory (or a file:// URL pointing at one).
+        if scheme in ("", "file"):
+            if not os.path.isdir(urllib.url2pathname(path)):
+                raise JobError("cannot read the index %s" % self.index_url)
+
+            directory = os.path.join(urllib.url2pathname(path),
+                                     normalize_name(name))
+
+            if not os.path.isdir(directory):
+                directory = os.path.join(urllib.url2pathname(path), name)
+
+            if not os.path.isdir(directory):
+                return []
+
+            if not os.path.exists(os.path.join(directory, "index.html")):
+                return [(filename, os.path.join(directory, filename)) \
+                        for filename in os.listdir(directory)]
+
+            f = open(os.path.join(directory, "index.html"), "r")
+            page = f.read()
+            f.close()
+
+            page_url = "file://" + urllib.pathname2url(directory) + "/"
+        else:
+            page_url = "%s/%s/" % (self.index_url.rstrip("/"),
+                                   normalize_name(name))
+
+            try:
+                response = urllib2.urlopen(page_url, timeout=60)
+                page = response.read()
+                response.close()
+            except urllib2.HTTPError, error:
+                if error.code == 404:
+                    return []
+
+                raise JobError("cannot read %s: %s" % (page_url, error))
+            except IOError, error:
+                raise JobError("cannot read %s: %s" % (page_url, error))
+
+        # The links look like "../../packages/.../Django-1.4.tar.gz#md5=...".
+        return [(urllib.unquote(link.split("#")[0].split("?")[0] \
+                 .rstrip("/").split("/")[-1]), urlparse.urljoin(page_url,
+                                                                link)) \
+                for link in HREF_RE.findall(page)]
+
+    def _parse_version(self, name, filename):
+        """
+        Return the version the file is of, e.g. "1.4" for Django-1.4.tar.gz
+        or for Django-1.4-py2.7.egg. None if the file is not of the package.
+        """
+
+        for extension in EXTENSIONS:
+            if filename.lower().endswith(extension):
+                filename = filename[:-len(extension)]
+                break
+        else:
+            return None
+
+        # The name might be spelled a little differently in the file name.
+        parts = filename.split("-")
+
+        for number in range(1, len(parts)):
+            if normalize_name("-".join(parts[:number])) == \
+               normalize_name(name):
+                return parts[number]
+
+        return None
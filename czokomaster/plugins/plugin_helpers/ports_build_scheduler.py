@@ -0,0 +1,207 @@
+"""
+This is the build scheduler of the ports plugin. "portmaster -ad" upgrades
+the outdated ports of a jail as a whole - it either gets through all of them
+or leaves the jail halfway with no notion of what has been done. The
+scheduler upgrades them port by port instead (so an upgrade that has died is
+resumed at the port it has stopped at, see czokomaster.journal) - every port
+only once its outdated dependencies are built, so a port is never built
+against the old version of a library it needs.
+
+The dependencies are asked for with "port_depends_cmd" (see the config
+file) - all of them, not only the direct ones ("make all-depends-list"), as
+"portmaster <origin>" rebuilds whatever outdated port it finds anywhere below
+the port. Port A needing port B (up to date) which needs port C (outdated)
+must wait for C just as well, or A and C would both rebuild C. Only the
+dependencies that are outdated themselves matter - the rest of them are
+installed and up to date already. A dependency shared by many outdated ports
+is a single build, done before any of these ports is started.
+
+The ports that do not depend on each other are built at the same time -
+"build_jobs" of them, within a single jail just like in many jails, so a
+single builder keeps all of its cores busy. The dependencies are what keeps
+the builds in order: two ports built at the same time share no outdated
+dependency (it would be an edge of the graph of both), so no port is ever
+rebuilt by two builds at once. The builds are jobs of new_engine(), so the
+throttle (see czokomaster.throttle) and "max_jobs_per_host" hold them back
+just like any other job.
+"""
+
+__helpername__ = "ports-build-scheduler"
+__author__ = "Mikolaj Romel"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2012 Mikolaj Romel"
+__license__ = "New-style BSD"
+
+import multiprocessing
+
+from czokomaster import render
+from czokomaster.czokomanager import (get_config_option, execute_command,
+                                      jail_command, describe_jail, new_engine,
+                                      JobError)
+
+def build_jobs():
+    """
+    Return how many ports may be built at the same time ("build_jobs" from
+    the config file or, if it is 0, the number of the cores of the host).
+    """
+
+    jobs = get_config_option("ports", "build_jobs")
+
+    if jobs <= 0:
+        try:
+            jobs = multiprocessing.cpu_count()
+        except NotImplementedError:
+            jobs = 1
+
+    return jobs
+
+def port_dependencies(jail, origins, jobs=None):
+    """
+    Return the dependency graph of the given ports of the system: the dict
+    origin -> list of the origins (out of the given ones) the port depends
+    on, directly or not. The ports are asked at most "jobs" at the same
+    time. JobError is raised if any of them cannot be asked - a port built
+    before a dependency that is not known of would be built against its old
+    version.
+    """
+
+    port_depends_cmd = get_config_option("ports", "port_depends_cmd")
+    jobs = jobs or build_jobs()
+    engine = new_engine(jobs, jobs)
+
+    for origin in origins:
+        engine.submit(_depends, jail, origin, port_depends_cmd, name=origin)
+
+    graph = {}
+
+    for job in engine.run():
+        origin = job.args[1]
+
+        if job.error is not None:
+            raise JobError("could not ask what %s depends on in %s" % \
+                           (origin, describe_jail(jail)))
+
+        graph[origin] = [dependency for dependency in job.result or [] \
+                         if dependency in origins and dependency != origin]
+
+    return _closed(graph)
+
+def build_order(graph, origins):
+    """
+    Return the origins sorted so that every port comes after the ports it
+    depends on. Otherwise, the given order is kept. The dependency cycles (if
+    the ports tree has any) are broken at the port that comes first.
+    """
+
+    order = []
+    placed = set()
+    visiting = set()
+
+    def place(origin):
+        if origin in placed or origin in visiting:
+            return
+
+        visiting.add(origin)
+
+        for dependency in graph.get(origin, []):
+            place(dependency)
+
+        visiting.discard(origin)
+        placed.add(origin)
+        order.append(origin)
+
+    for origin in origins:
+        place(origin)
+
+    return order
+
+def schedule_builds(graphs, build, jobs=None):
+    """
+    Build the ports of the given systems. "graphs" is the dict: jail ->
+    dependency graph of the ports to be built there (see port_dependencies()),
+    "build" is the function that builds a single port - build(jail, origin) -
+    and returns True if it went fine. At most "jobs" ports are built at the
+    same time, in all the systems together - as many of them within a single
+    system, as long as they do not depend on each other.
+
+    A port whose dependency has failed is not built at all. Return the dict:
+    (jail, origin) -> True if the port has been built.
+    """
+
+    jobs = jobs or build_jobs()
+    engine = new_engine(jobs, jobs)
+    built = {}
+
+    for jail in sorted(graphs):
+        graph = graphs[jail]
+        submitted = {}
+
+        for origin in build_order(graph, sorted(graph)):
+            dependencies = [submitted[dependency] for dependency in \
+                            graph[origin] if dependency in submitted]
+            submitted[origin] = engine.submit(_build, jail, origin, build,
+                                              dependencies,
+                                              name="%s in %s" % (origin,
+                                                   describe_jail(jail)),
+                                              jail=jail, after=dependencies)
+
+    for job in engine.run():
+        jail, origin = job.args[:2]
+        built[(jail, origin)] = bool(job.result)
+
+    return built
+
+def _closed(graph):
+    """
+    Return the graph with every port depending on the dependencies of its
+    dependencies as well - in case "port_depends_cmd" gives the direct
+    dependencies only.
+    """
+
+    closed = {}
+
+    def reach(origin, seen):
+        for dependency in graph.get(origin, []):
+            if dependency not in seen:
+                seen.add(dependency)
+                reach(dependency, seen)
+
+        return seen
+
+    for origin in graph:
+        closed[origin] = sorted(reach(origin, set()) - set([origin]))
+
+    return closed
+
+def _build(jail, origin, build, dependencies):
+    """
+    Build the port, unless any of the ports it depends on has failed.
+    """
+
+    failed = [job.args[1] for job in dependencies if not job.result]
+
+    if failed:
+        renderer = render.get()
+        renderer.item("error", "Not building", renderer.highlight(origin),
+                      "in %s, as %s has failed." % (describe_jail(jail),
+                                                    ", ".join(failed)),
+                      jail=jail, port=origin)
+        return False
+
+    return build(jail, origin)
+
+def _depends(jail, origin, port_depends_cmd):
+    """
+    Return the origins of the ports the port depends on. The ports tree
+    gives them as the paths, e.g. /usr/ports/lang/perl5.12.
+    """
+
+    stdout, stderr = execute_command([jail_command(jail,
+                                     port_depends_cmd.format(origin=origin))],
+                                     func_return=True)
+
+    if stderr.strip():
+        raise JobError(stderr.strip())
+
+    return ["/".join(path.rstrip("/").split("/")[-2:]) for path in \
+            (stdout or "").split()]
@@ -0,0 +1,177 @@
+"""
+This is the cache of "czokomaster ports diff". The outdated ports of a jail
+are found by "show_updates_cmd", which (e.g. "pkg_version -vl") might go
+through every Makefile of the ports tree - over and over again, while the
+answer changes only once the ports tree is updated or a package is
+installed/removed. Thus, the answer is kept in the cache dir (see
+"diff_cachedir"), one file per jail, and given again by the next "ports diff"
+for "diff_cache_ttl" minutes:
+
+  {
+   "jail": "www",
+   "refreshed": 1334300000.0,     - when the jail was asked (unix time);
+   "duration": 12.5,              - how long it took (in seconds);
+   "command": "pkg_version ...",  - what the jail was asked;
+   "fingerprint": "8f14e45f...",  - see fingerprint();
+   "stdout": "perl-5.12.4_3 ...",
+   "stderr": ""
+  }
+
+The answer is not given from the cache, if:
+
+  - it is older than "diff_cache_ttl" minutes or "--refresh" is given;
+  - the ports tree has been updated by "czokomaster ports update" or the
+    jail has been upgraded by "czokomaster ports upgrade" since (they remove
+    the files of the jails, see invalidate());
+  - the package database or the ports tree of the jail has changed some
+    other way (e.g. pkg_add run by hand), i.e. the fingerprint of the
+    "diff_cache_watch" paths is not the same anymore;
+  - "show_updates_cmd" is not the same anymore.
+
+An answer that came with anything on stderr is not kept, so a jail that
+could not be asked is asked again next time.
+"""
+
+__helpername__ = "ports-diff-cache"
+__author__ = "Mikolaj Romel"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2012 Mikolaj Romel"
+__license__ = "New-style BSD"
+
+import os
+import json
+import time
+
+from czokomaster import files
+from czokomaster.czokomanager import (get_config_option, execute_command,
+                                      jail_command, jail_root)
+
+def show_updates(jail, show_updates_cmd, refresh=False):
+    """
+    Return (stdout, stderr, refreshed) of "show_updates_cmd" run in the
+    jail - either out of the cache or, if the cache cannot be used (see the
+    top of the module), by running the command. "refreshed" is the time the
+    answer comes from if it comes from the cache or None if the command has
+    been run just now.
+    """
+
+    ttl = get_config_option("ports", "diff_cache_ttl") * 60
+    path = _cache_path(jail)
+
+    if not ttl:
+        stdout, stderr = execute_command([jail_command(jail,
+                                         show_updates_cmd)], func_return=True)
+        return stdout, stderr, None
+
+    current = fingerprint(jail)
+
+    if not refresh:
+        cache = _load(path)
+
+        if cache is not None and \
+           cache["command"] == show_updates_cmd and \
+           cache["fingerprint"] == current and \
+           0 <= time.time() - cache["refreshed"] < ttl:
+            return cache["stdout"], cache["stderr"], cache["refreshed"]
+
+    started = time.time()
+    stdout, stderr = execute_command([jail_command(jail, show_updates_cmd)],
+                                     func_return=True)
+
+    if not stderr.strip():
+        _save(path, {"jail": jail, "refreshed": started,
+                     "duration": round(time.time() - started, 3),
+                     "command": show_updates_cmd, "fingerprint": current,
+                     "stdout": stdout, "stderr": stderr})
+
+    return stdout, stderr, None
+
+def invalidate(jails=None, but=()):
+    """
+    Forget what is known about the given jails (all of them if "jails" is
+    None, except for the ones listed in "but").
+    """
+
+    cachedir = get_config_option("ports", "diff_cachedir")
+
+    if jails is None:
+        if not os.path.isdir(cachedir):
+            return
+        jails = [name for name in os.listdir(cachedir) \
+                 if not name.startswith(".")]
+
+    for jail in jails:
+        if jail in but:
+            continue
+
+        try:
+            os.remove(_cache_path(jail))
+        except OSError:
+            pass
+
+def fingerprint(jail):
+    """
+    Return the fingerprint of the package database and the ports tree of the
+    jail (see czokomaster.files) - made of the mtimes of the
+    "diff_cache_watch" paths (as seen from the host, see jail_root()) and of
+    whatever is right within them, e.g. the package dirs in /var/db/pkg or
+    the INDEX files in /usr/ports. The paths that cannot be reached from the
+    host count as well - as missing.
+    """
+
+    root = jail_root(jail)
+
+    # The files of the jails of the other hosts cannot be looked at, their
+    # answers are kept for "diff_cache_ttl" minutes, no matter what.
+    if root is None:
+        return files.fingerprint([])
+
+    return files.fingerprint([os.path.join(root, path.lstrip(os.sep)) for \
+                              path in get_config_option("ports",
+                                                        "diff_cache_watch")])
+
+def describe_age(refreshed):
+    """
+    Return e.g. "5 minute(s) ago" for the time the answer comes from.
+    """
+
+    minutes = int(max(0, time.time() - refreshed) // 60)
+
+    if minutes < 60:
+        return "%d minute(s) ago" % minutes
+
+    return "%d hour(s) ago" % (minutes // 60)
+
+def _cache_path(jail):
+    return os.path.join(get_config_option("ports", "diff_cachedir"), jail)
+
+def _load(path):
+    """
+    Return the cache file or None if there is none (or it is broken).
+    """
+
+    try:
+        f = open(path, "r")
+    except IOError:
+        return None
+
+    try:
+        return json.load(f)
+    except ValueError:
+        return None
+    finally:
+        f.close()
+
+def _save(path, cache):
+    """
+    Write the cache file down atomically, so "ports diff" run at the same
+    time never reads it half-written.
+    """
+
+    directory = os.path.dirname(path)
+
+    if not os.path.exists(directory):
+        os.makedirs(directory, 0700)
+
+    files.write_atomically(path, json.dumps(cache, indent=1, sort_keys=True),
+                           0600)
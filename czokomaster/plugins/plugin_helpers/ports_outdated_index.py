@@ -0,0 +1,126 @@
+"""
+This is the index of the outdated ports of many jails at once. With 20 jails
+"czokomaster ports diff all" shows the same outdated port 20 times - the
+index shows it once, together with the jails it is outdated in and the
+versions installed there. It is also what the shared upgrade (see
+"czokomaster ports upgrade --shared") decides by which packages to build and
+in what order.
+
+The jails are asked at the same time (see "max_parallel_jails") and their
+answers are put into a single index kept in memory:
+
+  port -> jail -> {"installed": "5.12.4_3", "available": "5.12.4_4", ...}
+
+where "port" is the package name (e.g. "perl") or the origin (e.g.
+lang/perl5.12), depending on what the jails have been asked.
+"""
+
+__helpername__ = "ports-outdated-index"
+__author__ = "Mikolaj Romel"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2012 Mikolaj Romel"
+__license__ = "New-style BSD"
+
+import re
+
+from czokomaster.czokomanager import run_in_jails
+
+# The lines of pkg_version, e.g.:
+# perl-5.12.4_3    <   needs updating (index has 5.12.4_4)
+# lang/perl5.12    <   needs updating (index has 5.12.4_4)
+PKG_VERSION_RE = re.compile(r"^(\S+)\s.*\((?:index|port) has ([^)]+)\)")
+
+def parse_pkg_version(output):
+    """
+    Return the list of (port, info) out of the output of pkg_version. The
+    port is the package name if pkg_version has given the package names
+    (with the installed version split off) or the origin if it has given
+    the origins (the installed version is not known then).
+    """
+
+    ports = []
+
+    for line in (output or "").splitlines():
+        match = PKG_VERSION_RE.match(line)
+
+        if not match:
+            continue
+
+        port, available = match.groups()
+        installed = None
+
+        if "/" not in port and "-" in port:
+            port, installed = port.rsplit("-", 1)
+
+        ports.append((port, {"installed": installed, "available": available}))
+
+    return ports
+
+class OutdatedIndex:
+    """
+    The outdated ports of many jails, see the top of the module.
+    """
+
+    def __init__(self):
+        self.ports = {}
+        self.jails = []
+        self.errors = {}
+
+    def gather(self, jails, query):
+        """
+        Ask all the jails at the same time and put what they say into the
+        index. query(jail) returns the list of (port, info) of the jail, see
+        parse_pkg_version(). The jails that fail are noted in "errors".
+        """
+
+        for jail, ports, error in run_in_jails(jails, query):
+            self.jails.append(jail)
+
+            if error is not None:
+                self.errors[jail] = str(error)
+                continue
+
+            for port, info in ports or []:
+                self.add(jail, port, info)
+
+        return self
+
+    def add(self, jail, port, info):
+        self.ports.setdefault(port, {})[jail] = info
+
+    def get(self, port, jail):
+        """
+        Return what is known about the port in the jail or None if the port
+        is not outdated there.
+        """
+
+        return self.ports.get(port, {}).get(jail)
+
+    def outdated_in(self, port):
+        """
+        Return the jails the port is outdated in, in the order the jails have
+        been asked.
+        """
+
+        return [jail for jail in self.jails if jail in self.ports.get(port, {})]
+
+    def sorted_ports(self):
+        """
+        Return the ports, the ones outdated in the most jails first (these
+        are the ones worth building once for all the jails), then by name.
+        """
+
+        return sorted(self.ports, key=lambda port: (-len(self.ports[port]),
+                                                    port.lower()))
+
+    def as_dict(self):
+        """
+        Return the index the way it is shown by "--json".
+        """
+
+        return {"jails": self.jails,
+                "errors": self.errors,
+                "ports": [{"port": port,
+                           "jails": dict([(jail, self.ports[port][jail]) \
+                                          for jail in self.outdated_in(port)])}
+                          for port in self.sorted_ports()]}
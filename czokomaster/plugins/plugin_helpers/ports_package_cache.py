@@ -0,0 +1,253 @@
+"""
+This is the cache of the packages built for the ports plugin. Without it,
+"czokomaster ports upgrade all" makes portmaster build the very same port
+once again in every single jail. With it, every outdated port is built once
+(on the base system or in a jail dedicated to building), the package is kept
+in the shared package directory and the rest of the jails simply install it.
+
+The packages are kept in the "All" subdirectory of the cache directory (this
+is where "make package" and "portmaster -g" put them, so the directory can be
+handed over to pkg_add/portmaster as it is). The index of the cache is kept
+next to it in the "index.json" file. Every package is known there by its key,
+which is made of the port origin, the version and the set of options the port
+was built with - a package built with different options is a different
+package.
+
+Many runs might use the cache at the same time (e.g. "ports upgrade" from
+cron and another one by hand). The index is written down under a lock and
+merged with whatever the other runs have written in the meantime - the
+packages they have built are kept, the ones this run has removed are gone.
+"""
+
+__helpername__ = "ports-package-cache"
+__author__ = "Mikolaj Romel"
+__version__ = "1.0"
+__copyright__ = "Copyright (c) 2012 Mikolaj Romel"
+__license__ = "New-style BSD"
+
+import os
+import time
+import json
+import fcntl
+import hashlib
+
+from czokomaster import files
+
+def package_key(origin, version, options):
+    """
+    Return the key under which the package is kept in the cache. "options"
+    is the list of the options the port is built with - the order does not
+    matter.
+    """
+
+    options_hash = hashlib.md5(" ".join(sorted(options))).hexdigest()[:10]
+
+    return "%s-%s-%s" % (origin.replace("/", "_"), version, options_hash)
+
+class PackageCache:
+    """
+    Keep track of the packages in the shared package directory.
+    """
+
+    def __init__(self, cachedir, max_size=0):
+        """
+        Load the index of the cache. "max_size" is the size (in megabytes)
+        the cache may grow up to before the least recently used packages are
+        evicted. 0 means there is no limit.
+        """
+
+        self.cachedir = cachedir
+        self.packagedir = os.path.join(cachedir, "All")
+        self.index_path = os.path.join(cachedir, "index.json")
+        self.max_size = max_size * 1024 * 1024
+
+        # If the directory does not exist, create one. Recursively.
+        if not os.path.exists(self.packagedir):
+            os.makedirs(self.packagedir, 0755)
+
+        # The hits and misses of the current run are counted separately from
+        # the ones kept in the index (i.e. the ones of all the runs so far).
+        self.hits = 0
+        self.misses = 0
+
+        # What this run has done to the index, so it can be merged with the
+        # index written by the other runs in the meantime (see save()): the
+        # keys of the packages built, the uses of the packages (key ->
+        # hits), the misses and the keys of the packages removed.
+        self.built = set()
+        self.used = {}
+        self.missed = 0
+        self.removed = set()
+
+        self.index = {"packages": {}, "hits": 0, "misses": 0}
+
+        if os.path.exists(self.index_path):
+            f = open(self.index_path, "r")
+            self.index.update(json.load(f))
+            f.close()
+
+    def lookup(self, key):
+        """
+        Return the path to the package known by the given key or None if
+        there is no such package in the cache. Count the hit or the miss.
+        """
+
+        entry = self.index["packages"].get(key)
+
+        # The package might have been removed by hand, so forget about it.
+        if entry and not os.path.exists(self.path(key)):
+            del self.index["packages"][key]
+            self.removed.add(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            self.missed += 1
+            self.index["misses"] += 1
+            return None
+
+        self.hit(key)
+
+        return self.path(key)
+
+    def hit(self, key):
+        """
+        Count one more use of the package known by the given key.
+        """
+
+        entry = self.index["packages"][key]
+        entry["hits"] += 1
+        entry["last_used"] = time.time()
+
+        self.used[key] = self.used.get(key, 0) + 1
+        self.hits += 1
+        self.index["hits"] += 1
+
+    def add(self, key, origin, version, options, filename):
+        """
+        Put the package that has just been built into the index. "filename"
+        is the name of the package file within the "All" directory.
+        """
+
+        # A package of the same name, yet built with different options, is
+        # overwritten by the new one, so the old entry must go.
+        for old_key, entry in self.index["packages"].items():
+            if entry["filename"] == filename and old_key != key:
+                del self.index["packages"][old_key]
+                self.removed.add(old_key)
+
+        self.index["packages"][key] = {
+            "origin": origin,
+            "version": version,
+            "options": sorted(options),
+            "filename": filename,
+            "size": os.path.getsize(os.path.join(self.packagedir, filename)),
+            "built": time.time(),
+            "last_used": time.time(),
+            "hits": 0,
+        }
+
+        self.built.add(key)
+        self.removed.discard(key)
+
+    def path(self, key):
+        """
+        Return the path to the package known by the given key.
+        """
+
+        return os.path.join(self.packagedir,
+                            self.index["packages"][key]["filename"])
+
+    def size(self):
+        """
+        Return the size (in bytes) of all the packages in the cache.
+        """
+
+        return sum([entry["size"] for entry in \
+                    self.index["packages"].values()])
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used packages until the cache fits in
+        max_size again. The packages listed in "keep" (by their keys) are
+        never removed - these are the ones the current run relies on.
+        Return the list of the keys of the removed packages.
+        """
+
+        evicted = []
+
+        if not self.max_size:
+            return evicted
+
+        entries = sorted(self.index["packages"].items(),
+                         key=lambda item: item[1]["last_used"])
+
+        for key, entry in entries:
+            if self.size() <= self.max_size:
+                break
+
+            if key in keep:
+                continue
+
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+
+            del self.index["packages"][key]
+            self.removed.add(key)
+            evicted.append(key)
+
+        return evicted
+
+    def save(self):
+        """
+        Write the index down. The temporary file is renamed over the old
+        index, so the index is never left half-written. Whatever has been
+        written in the meantime by the other runs is kept (see the top of
+        the module) - only the packages this run has built, used or removed
+        are taken from here.
+        """
+
+        lock = open(self.index_path + ".lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            index = {"packages": {}, "hits": 0, "misses": 0}
+
+            if os.path.exists(self.index_path):
+                f = open(self.index_path, "r")
+                index.update(json.load(f))
+                f.close()
+
+            packages = index["packages"]
+
+            for key in self.removed:
+                packages.pop(key, None)
+
+            for key in self.built:
+                if key in self.index["packages"]:
+                    packages[key] = self.index["packages"][key]
+
+            # The packages removed by the other runs in the meantime are
+            # gone, no matter if they have been used here.
+            for key, hits in self.used.items():
+                if key in packages and key not in self.built:
+                    packages[key]["hits"] += hits
+                    packages[key]["last_used"] = max(
+                        packages[key]["last_used"],
+                        self.index["packages"][key]["last_used"])
+
+            index["hits"] += sum(self.used.values())
+            index["misses"] += self.missed
+
+            files.write_atomically(self.index_path,
+                                   json.dumps(index, indent=1,
+                                              sort_keys=True))
+        finally:
+            lock.close()
+
+        # This run goes on from the merged index.
+        self.index = index
+        self.built = set()
+        self.used = {}
+        self.missed = 0
+        self.removed = set()
@@ -9,21 +9,37 @@ __copyright__ = "Copyright (c) 2012 Mikolaj Romel"
 __license__ = "New-style BSD"
 
 import os
+import re
 import sys
+import threading
 
-from termcolor import colored
-
+from czokomaster import inventory, fetchcache, render
+from czokomaster.backends import split_target, host_of, hosts_of
 from czokomaster.meta import __projectname__
+from czokomaster.journal import Journal
+from czokomaster.rollout import is_rolling, roll_out
+from czokomaster.planner import (Plan, PlanError, apply_plan, print_left,
+                                 default_path, option_value)
+from czokomaster.plugins.plugin_helpers.ports_diff_cache import (show_updates,
+                                                                 invalidate,
+                                                                 describe_age)
 from czokomaster.czokomanager import (get_config_option, execute_command,
-                                      normalize_params)
+                                      normalize_params, run_in_jails,
+                                      jail_command, jail_root, describe_jail,
+                                      new_engine, JobError)
+
+# The package cache is looked into by many builds at the same time (see
+# _build_package()).
+_cache_lock = threading.Lock()
 
 def version(params):
     """
     Print plugin version.
     """
 
-    print "%s plugin version %s %s\n" % (__pluginname__, __version__,
-                                         __copyright__)
+    render.get().text(
+        "%s plugin version %s %s\n" % (__pluginname__, __version__,
+                                       __copyright__))
 
 def help(params):
     """
@@ -31,33 +47,78 @@ def help(params):
     """
 
     version(params)
-    print "This plugin manages the ports tree for both - the base system", \
-          "as well as for the jail systems. Usage:\n\n", \
-          "  1) in order to see this help:\n\n", \
-          "      # %s %s help\n\n" % (__projectname__, __pluginname__), \
-          "  or simply:\n\n      # %s %s\n\n" % (__projectname__, 
-                                                 __pluginname__), \
-          "  2) in order to see a short version of this help:\n\n", \
-          "      # %s %s options\n\n" % (__projectname__, __pluginname__), \
-          "  3) in order to see plugin version:\n\n", \
-          "      # %s %s version\n\n" % (__projectname__, __pluginname__), \
-          "  4) in order to update ports for both - the base system and", \
-          "available jails:\n\n", \
-          "      # %s %s update\n\n" % (__projectname__, __pluginname__), \
-          "  5) in order to see the all the packages that need upgrading:\n\n", \
-          "      # %s %s diff all\n\n" % (__projectname__, __pluginname__), \
-          "  or, to show the packages to upgrade only in the base system", \
-          "and jail named jail1:\n\n", \
-          "      # %s %s diff base jail1\n\n" % (__projectname__,
-                                                 __pluginname__), \
-          "  where 'base' stands for the base system;\n", \
-          "  6) in order to upgrade all the systems listed in", \
-          "the config file:\n\n", \
-          "      # %s %s upgrade all\n\n" % (__projectname__, __pluginname__), \
-          "  or, to upgrade only the base system and jail named jail1\n\n", \
-          "      # %s %s upgrade base jail1\n\n" % \
-          (__projectname__, __pluginname__), \
-          "  where 'base' stands for the base system."
+    render.get().text(
+        "This plugin manages the ports tree for both - the base system",
+        "as well as for the jail systems. Usage:\n\n",
+        "  1) in order to see this help:\n\n",
+        "      # %s %s help\n\n" % (__projectname__, __pluginname__),
+        "  or simply:\n\n      # %s %s\n\n" % (__projectname__,
+                                               __pluginname__),
+        "  2) in order to see a short version of this help:\n\n",
+        "      # %s %s options\n\n" % (__projectname__, __pluginname__),
+        "  3) in order to see plugin version:\n\n",
+        "      # %s %s version\n\n" % (__projectname__, __pluginname__),
+        "  4) in order to update ports for both - the base system and",
+        "available jails:\n\n",
+        "      # %s %s update\n\n" % (__projectname__, __pluginname__),
+        "  or, to see the packages that need upgrading right after:\n\n",
+        "      # %s %s update --diff all\n\n" % (__projectname__,
+                                                __pluginname__),
+        "  5) in order to see the all the packages that need upgrading:\n\n",
+        "      # %s %s diff all\n\n" % (__projectname__, __pluginname__),
+        "  or, to show the packages to upgrade only in the base system",
+        "and jail named jail1:\n\n",
+        "      # %s %s diff base jail1\n\n" % (__projectname__,
+                                               __pluginname__),
+        "  where 'base' stands for the base system, or to show each",
+        "outdated port once with the jails it is outdated in:\n\n",
+        "      # %s %s diff all --aggregate\n\n" % (__projectname__,
+                                                   __pluginname__),
+        "  (--json gives the same as a JSON document). The answers are",
+        "kept for \"diff_cache_ttl\" minutes, add --refresh to ask the",
+        "systems anew;\n",
+        "  6) in order to upgrade all the systems listed in",
+        "the config file:\n\n",
+        "      # %s %s upgrade all\n\n" % (__projectname__, __pluginname__),
+        "  or, to upgrade only the base system and jail named jail1\n\n",
+        "      # %s %s upgrade base jail1\n\n" %
+        (__projectname__, __pluginname__),
+        "  where 'base' stands for the base system;\n",
+        "  7) in order to build every outdated port once and install the",
+        "package in the rest of the jails:\n\n",
+        "      # %s %s upgrade all --shared\n\n" % (__projectname__,
+                                                   __pluginname__),
+        "  see the package cache section of the config file first;\n",
+        "  8) in order to build the outdated ports of every jail one by",
+        "one, each after the ports it depends on (the ports that do not",
+        "depend on each other in parallel):\n\n",
+        "      # %s %s upgrade all --parallel\n\n" % (__projectname__,
+                                                     __pluginname__),
+        "  see \"build_jobs\" in the config file first;\n",
+        "  9) in order to go on with an upgrade that has died halfway",
+        "(or to see what it has left with --dry-run):\n\n",
+        "      # %s %s upgrade all --resume\n\n" % (__projectname__,
+                                                   __pluginname__),
+        "  the rest of the options must be the same as the first time;\n",
+        "  10) in order to upgrade the canary jails first and then the",
+        "rest of them batch by batch, stopping once a batch fails:\n\n",
+        "      # %s %s upgrade all --rolling\n\n" % (__projectname__,
+                                                    __pluginname__),
+        "  see the rolling upgrade section of the config file first;\n",
+        "  11) in order to plan the upgrade first (together with how long",
+        "every step is expected to take) and carry the plan out later:\n\n",
+        "      # %s %s plan all --shared --save plan.json\n" %
+        (__projectname__, __pluginname__),
+        "      # %s %s apply plan.json\n\n" % (__projectname__,
+                                               __pluginname__),
+        "  --shared and --parallel plan the upgrade just as they do it,",
+        "--json prints the plan as a JSON document;\n",
+        "  12) in order to fetch the distfiles all the jails need once,",
+        "into the fetch cache shared by the jails:\n\n",
+        "      # %s %s prefetch all\n\n" % (__projectname__,
+                                             __pluginname__),
+        "  or add --prefetch to \"upgrade\" to do it right before the",
+        "upgrade. See the fetch cache section of the config file first.")
 
     # Exit after printing help.
     sys.exit(1)
@@ -69,36 +130,122 @@ def options(params):
 
     version(params)
 
-    print "Usage: %s %s <option>\n\n" % (__projectname__, __pluginname__), \
-          "where the possible options include:\n", \
-          "- help - show a more detailed help message;\n", \
-          "- update - update ports tree;\n", \
-          "- diff [all|base|jail1...] - show ports that need upgrading;\n", \
-          "- upgrade [all|jail1|jail2...] - upgrade packages;\n", \
-          "- options - show this message;\n", \
-          "- version - show the plugin version."
+    render.get().text(
+        "Usage: %s %s <option>\n\n" % (__projectname__, __pluginname__),
+        "where the possible options include:\n",
+        "- help - show a more detailed help message;\n",
+        "- update [--diff all|base|jail1...] - update ports tree;\n",
+        "- diff [all|base|jail1...] [--aggregate|--json] [--refresh] - show",
+        "ports that need upgrading;\n",
+        "- upgrade [all|jail1|jail2...] [--shared] [--parallel]",
+        "[--rolling] [--prefetch] [--resume|--dry-run] - upgrade",
+        "packages;\n",
+        "- plan [all|jail1|jail2...] [--shared] [--parallel] [--save",
+        "FILE] [--json] - plan the upgrade;\n",
+        "- apply [FILE] [--resume|--dry-run] - carry the plan out;\n",
+        "- prefetch [all|jail1|jail2...] - fetch the distfiles of the",
+        "outdated ports once for all the jails;\n",
+        "- options - show this message;\n",
+        "- version - show the plugin version.")
 
     # Exit after printing help.
     sys.exit(0)
 
 def update(params):
     """
-    Update the port tree on the base system as well as in jails. 
+    Update the port tree on the base system as well as in jails. With
+    "--diff", show the ports that need upgrading right after, e.g.:
+
+        # czokomaster ports update --diff all
+
+    The updates of a system are shown as soon as its ports tree is updated,
+    so the base system is being looked at while the jails' ports tree is
+    still being updated. The ports trees of the other hosts the jails are
+    on (see czokomaster.backends) are updated at the same time.
+    """
+
+    engine = new_engine()
+
+    # First, update the base system. The ports tree of the jails is updated
+    # afterwards, as both portsnap runs share the same snapshot directory.
+    # Likewise on every other host.
+    trees = {}
+
+    for host in [None] + hosts_of(get_config_option(__pluginname__, "jails")):
+        base = engine.submit(_update_base, host,
+                             name="the ports tree update of %s" % \
+                             describe_jail(_base_of(host)),
+                             jail=host and _base_of(host))
+        trees[host] = (base, engine.submit(_update_jails, host,
+                                           name="the ports tree update of "
+                                           "the jails%s" % (host and " of %s" \
+                                                            % host or ""),
+                                           jail=host and _base_of(host),
+                                           after=[base]))
+
+    if "--diff" in params:
+        show_updates_cmd = get_config_option(__pluginname__,
+                                             "show_updates_cmd")
+
+        for jail in normalize_params(__pluginname__, "jails", params):
+            host, name = split_target(jail)
+            base, jails_tree = trees.get(host, trees[None])
+
+            engine.submit(_print_updates, jail, show_updates_cmd,
+                          name=describe_jail(jail), jail=jail,
+                          after=[base if name == "base" else jails_tree])
+
+    engine.run()
+
+def _base_of(host):
+    """
+    Return the base system of the host ("base" for this host).
+    """
+
+    return host and "%s:base" % host or "base"
+
+def _update_base(host=None):
+    """
+    Update the ports tree of the base system (of this host or the given
+    one).
     """
 
-    # First, update the base system. 
-    print colored("==>", "green"), \
-          colored("Updating ports on the base system", attrs=["bold"]) + \
-          colored(":\n", attrs=["bold"])
+    renderer = render.get()
+    renderer.heading("Updating ports on", describe_jail(_base_of(host)),
+                     jail=_base_of(host))
+    renderer.blank()
+
+    execute_command([jail_command(_base_of(host), "portsnap fetch update")])
+
+    # The ports that need upgrading are not the same anymore.
+    invalidate([_base_of(host)])
+    inventory.forget([_base_of(host)], "ports")
 
-    execute_command(["portsnap fetch update"])
+def _update_jails(host=None):
+    """
+    Update the ports tree of the jails (of this host or the given one).
+    """
 
-    #Update the ports tree for jails now.
-    print colored("\n==>", "green"), \
-          colored("Updating ports for the jails", attrs=["bold"]) + \
-          colored(":\n", attrs=["bold"])
+    renderer = render.get()
+    renderer.blank()
+    renderer.heading("Updating ports for the jails%s" % (host and " of %s" % \
+                                                         host or ""))
+    renderer.blank()
 
-    execute_command(["ezjail-admin update -P"])
+    execute_command([jail_command(_base_of(host), "ezjail-admin update -P")])
+
+    # Likewise, for every jail (of the host).
+    jails = [jail for jail in get_config_option(__pluginname__, "jails") \
+             if host_of(jail) == host and split_target(jail)[1] != "base"]
+
+    if host is None:
+        invalidate(but=["base"] + [jail for jail in get_config_option(
+                                   __pluginname__, "jails") \
+                                   if host_of(jail) is not None])
+    else:
+        invalidate(jails)
+
+    inventory.forget(jails, "ports")
 
 def upgrade(params):
     """
@@ -115,45 +262,135 @@ def upgrade(params):
     the config file:
     
         # czokomaster ports upgrade all
+
+    Every step done is noted in the run journal (see czokomaster.journal),
+    so an upgrade that has died halfway might be resumed with "--resume".
+    "--dry-run" shows what such an upgrade has left. With "--rolling", the
+    systems are upgraded canaries first, then batch by batch (see
+    czokomaster.rollout). With "--prefetch", the distfiles are fetched into
+    the fetch cache first (see prefetch()).
     """
 
     # Get base or/and jails that are to be upgraded.
     # normalize_params() requires config section, config variable and params.
-    jails = normalize_params(__pluginname__, "jails", params)
+    all_jails = jails = normalize_params(__pluginname__, "jails", params)
 
     # Get the upgrade command.
     ports_upgrade_cmd = get_config_option(__pluginname__, "ports_upgrade_cmd")
+    shared = "--shared" in params or \
+             get_config_option(__pluginname__, "use_package_cache")
+    scheduled = "--parallel" in params or \
+                get_config_option(__pluginname__, "use_build_scheduler")
+    rolling = is_rolling(params)
 
-    # If the base system is to be upgraded as well, do it now. In order
-    # to upgrade the base system, add "base" to the "jails" option within
-    # the config file.
-    if "base" in jails:
-        # Both "colored(...)" shall be displayed as one text line.
-        print colored("\n==>", "green"), \
-              colored("Upgrading the base system", attrs=["bold"]) + \
-              colored(":\n", attrs=["bold"])
+    # The shared packages and the build scheduler upgrade all the systems
+    # at once, which is just what the rolling upgrade should not do.
+    if rolling and (shared or scheduled):
+        render.get().item("warning", "The shared package cache and the "
+                          "build scheduler are not used by the rolling "
+                          "upgrade.")
+        shared = scheduled = False
 
-        execute_command([ports_upgrade_cmd])
+    journal = Journal(__pluginname__, "upgrade")
 
-        # Drop "base" from the list, so it does not interfere with the loop below.
-        # Print new line as well.
-        jails.remove("base")
-        print ""
+    if "--dry-run" in params:
+        # The scheduled upgrade notes every port it upgrades, so the ports
+        # still outdated in the systems not upgraded yet are left as well.
+        ports = {}
+        left = [jail for jail in jails if not journal.is_done(jail, "upgrade")]
 
-    # Upgrade specified jails.
-    for jail in jails:
-        print colored("\n==>", "green"), \
-              colored("Upgrading", attrs=["bold"]), \
-              colored(jail, "cyan") + colored(":\n", attrs=["bold"])
-        
-        execute_command(["jexec %s %s" % (jail, ports_upgrade_cmd)])
+        if scheduled:
+            for jail, origins, error in run_in_jails(left, _outdated_origins):
+                ports[jail] = [origin for origin, version in origins or []]
+
+        journal.print_left([(jail, (["install"] if shared else []) + \
+                             ports.get(jail, []) + ["upgrade"]) \
+                            for jail in jails])
+        return
+
+    # The systems that could not be asked what is outdated in them. They are
+    # upgraded the usual way below, yet the run is not one that has gone
+    # fine.
+    failed = []
+
+    # Leave the systems upgraded by the previous run alone, if resuming it.
+    journal.start("--resume" in params)
+    jails = [jail for jail in jails if not journal.is_done(jail, "upgrade")]
+
+    # Fetch the distfiles all the systems need first, every one of them
+    # once, if asked to.
+    if fetchcache.is_wanted(params) and jails:
+        _prefetch(jails)
+
+    # Build every outdated port once and install the package in the rest of
+    # the jails first, if asked to. Whatever is left (e.g. ports with options
+    # different from the ones of the builder) is upgraded the usual way below,
+    # the jails with nothing left are left alone then. The package cache is
+    # on this host, so the jails of the other hosts (see czokomaster.backends)
+    # are upgraded the usual way as a whole.
+    installs = [jail for jail in jails if not journal.is_done(jail, "install")
+                and host_of(jail) is None]
+
+    if shared and installs:
+        failed.extend(_upgrade_shared(installs, journal))
+
+        jails = [jail for jail in jails if not journal.is_done(jail,
+                                                               "upgrade")]
+
+    # Build the outdated ports one by one in dependency order (the ports of
+    # different systems at the same time), if asked to. Whatever is left
+    # (e.g. the ports that have failed) is upgraded the usual way below - the
+    # systems that have been upgraded completely are left alone then.
+    if scheduled and jails:
+        upgraded, unasked = _upgrade_scheduled(jails, journal)
+        failed.extend(unasked)
+
+        for jail in upgraded:
+            journal.complete(jail, "upgrade")
+
+        jails = [jail for jail in jails if not journal.is_done(jail,
+                                                               "upgrade")]
+
+    # Upgrade the specified systems - as many of them at the same time as
+    # "max_parallel_jails" (or "--jobs") allows or batch by batch, if rolling.
+    # In order to upgrade the base system as well, add "base" to the "jails"
+    # option within the config file.
+    if rolling:
+        roll_out(jails, lambda jail: _upgrade(jail, ports_upgrade_cmd,
+                                              journal))
+    else:
+        run_in_jails(jails, lambda jail: _upgrade(jail, ports_upgrade_cmd,
+                                                  journal))
 
     # Print new line.
-    print ""
+    render.get().blank()
+
+    # Whatever "ports diff" has said about these systems is not true anymore.
+    invalidate(all_jails)
+    inventory.forget(all_jails, "ports")
+
+    left = [jail for jail in all_jails if not journal.is_done(jail,
+                                                             "upgrade")]
+    journal.wrap_up(left)
+
+    if failed or left:
+        sys.exit(1)
 
 def diff(params):
     """
-    Show the ports that need to be updated.
+    Show the ports that need to be updated. With "--aggregate", show each
+    outdated port once, together with the jails it is outdated in. With
+    "--json", print the same as a JSON document, e.g.:
+
+        # czokomaster ports diff all --aggregate
+        # czokomaster ports diff all --json
+
+    The answer of each system is kept for "diff_cache_ttl" minutes (see
+    ports_diff_cache), unless the system changes. With "--refresh", every
+    system is asked anew. With "use_inventory = yes", the outdated ports are
+    read out of the inventory instead (see czokomaster.inventory), so no
+    system is asked anything, unless its files cannot be reached from the
+    host.
     """
 
     jails = normalize_params(__pluginname__, "jails", params)
@@ -161,37 +398,893 @@ def diff(params):
     # Get the command to show the ports that need updating.
     show_updates_cmd = get_config_option(__pluginname__, "show_updates_cmd")
 
-    # First, the base system, if it is supplied either on the command line
-    # or in the config file.
-    if "base" in jails:
-        print "Available updates for", colored("the base system", "cyan") + ":"
+    refresh = "--refresh" in params
 
-        # Pass the 'func_return=True' as a function argument, so the output is
-        # not printed but returned to stdout and stderr variables.
-        stdout, stderr = execute_command([show_updates_cmd], func_return=True)
+    if "--aggregate" in params or "--json" in params:
+        _print_aggregated(jails, show_updates_cmd, "--json" in params,
+                          refresh)
+        return
 
-        # If stdout is nil, don't print red '->'. Print green '-> None'.
-        if stdout:
-            print colored("->", "red"), stdout[:-2].replace("\n", \
-                  colored("\n-> ", "red"))
-        else:
-            print colored("->", "green"), colored("None", "white", \
-                                                  attrs=["bold"])
+    # Ask all the systems (the base system as well, if it is supplied either
+    # on the command line or in the config file) at the same time. The
+    # output is printed in the order of the jails anyway.
+    run_in_jails(jails, lambda jail: _print_updates(jail, show_updates_cmd,
+                                                    refresh))
+
+def prefetch(params):
+    """
+    Fetch the distfiles of the ports outdated in the given systems into the
+    fetch cache and mount the cache in the jails (see
+    czokomaster.fetchcache), e.g.:
+
+        # czokomaster ports prefetch all
+
+    Every distfile is fetched once, no matter how many systems need it.
+    "upgrade --prefetch" does the same before the upgrade.
+    """
+
+    _prefetch(normalize_params(__pluginname__, "jails", params))
 
-        # Remove "base", so it does not interfere with the loop below.
-        jails.remove("base")
+def plan(params):
+    """
+    Plan the upgrade of the given systems rather than do it, e.g.:
+
+        # czokomaster ports plan all --shared
+        # czokomaster ports plan base jail1 --parallel --save /root/plan.json
+
+    The plan (see czokomaster.planner) is made of the outdated ports of
+    every system, so the systems with nothing outdated are left out. With
+    "--shared", every port is built once on the builder and installed in
+    the rest of the jails from the package cache, the packages in the cache
+    already are not built at all. With "--parallel", every outdated port is
+    a step of its own, done after the ports it depends on. The plan is
+    printed together with the estimates of its steps and saved (to the
+    default plan of the plugin, unless "--save" is given) for "apply".
+    "--json" prints the plan as a JSON document instead.
+    """
+
+    path, params = option_value("--save", params)
+    jails = normalize_params(__pluginname__, "jails", params)
+    shared = "--shared" in params or \
+             get_config_option(__pluginname__, "use_package_cache")
+    scheduled = "--parallel" in params or \
+                get_config_option(__pluginname__, "use_build_scheduler")
+
+    # The builder has to tell what the packages to build depend on, or there
+    # is no telling in what order to build them.
+    try:
+        upgrade_plan = _plan(jails, shared, scheduled)
+    except JobError, error:
+        render.get().item("error", "%s." % str(error).capitalize())
+        sys.exit(1)
+
+    upgrade_plan.estimate()
+    path = upgrade_plan.save(path)
+
+    renderer = render.get()
+
+    if "--json" in params:
+        renderer.document("plan", upgrade_plan.to_dict())
+        return
+
+    renderer.blank()
+    upgrade_plan.show()
+
+    renderer.item("info", "Saved to %s. Carry it out with:" % path)
+    renderer.blank()
+    renderer.text("    # %s %s apply %s" % (__projectname__, __pluginname__,
+                                            path))
+    renderer.blank()
+
+def apply(params):
+    """
+    Carry out the plan made by "plan" (the default plan of the plugin, if no
+    path is given), e.g.:
+
+        # czokomaster ports apply /root/plan.json
+
+    An apply that has died halfway is resumed with "--resume", "--dry-run"
+    shows what it has left.
+    """
+
+    paths = [param for param in params[3:] if not param.startswith("--")]
+
+    try:
+        upgrade_plan = Plan.load(paths and paths[0] or \
+                                 default_path(__pluginname__), __pluginname__)
+    except PlanError, error:
+        render.get().item("error", "%s." % str(error).capitalize())
+        sys.exit(1)
+
+    if "--dry-run" in params:
+        print_left(upgrade_plan)
+        return
+
+    # The packages are built into (and installed from) the package cache,
+    # which is noted down once the plan is applied.
+    cache = None
+    kinds = {}
+
+    if [step for step in upgrade_plan.steps if step["kind"] == "build" or \
+        step["args"].get("keys")]:
+        from czokomaster.plugins.plugin_helpers.ports_package_cache import \
+             PackageCache
+
+        package_cachedir = get_config_option(__pluginname__,
+                                             "package_cachedir")
+        build_cmd = get_config_option(__pluginname__, "package_build_cmd")
+        builder_package_dir = get_config_option(__pluginname__,
+                                                "builder_package_dir") or \
+                              package_cachedir
+        cache = PackageCache(package_cachedir,
+                             get_config_option(__pluginname__,
+                                               "package_cache_size"))
+
+        kinds["build"] = lambda step, journal: \
+                         _build_package(step["jail"], step["args"]["origin"],
+                                        step["args"]["version"],
+                                        step["args"]["options"], build_cmd,
+                                        builder_package_dir, cache,
+                                        step["args"]["key"])
+
+    outcome = apply_plan(upgrade_plan, kinds, "--resume" in params)
+
+    if cache is not None:
+        used = []
+
+        for step in upgrade_plan.steps:
+            for key in step["args"].get("keys", []):
+                used.append(key)
+
+                if outcome[step["id"]] == "done" and \
+                   key in cache.index["packages"]:
+                    cache.hit(key)
+
+        _save_cache(cache, used)
+
+    # Whatever "ports diff" has said about these systems is not true anymore.
+    invalidate(upgrade_plan.jails())
+    inventory.forget(upgrade_plan.jails(), "ports")
+
+def _plan(jails, shared, scheduled):
+    """
+    Return the Plan (see czokomaster.planner) of the upgrade of the given
+    systems - just the way "upgrade" would do it:
+
+      1) with "shared", the packages missing from the package cache are
+         built on the builder (every package after the packages it depends
+         on) and installed in the jails of this host that may reuse them;
+      2) whatever is left outdated in a system is upgraded after that - with
+         a single "ports_upgrade_cmd" or, with "scheduled", port by port in
+         dependency order.
+    """
+
+    from czokomaster.plugins.plugin_helpers.ports_build_scheduler import \
+         port_dependencies, build_order, build_jobs
+
+    ports_upgrade_cmd = get_config_option(__pluginname__, "ports_upgrade_cmd")
+    port_upgrade_cmd = get_config_option(__pluginname__, "port_upgrade_cmd")
+    upgrade_plan = Plan(__pluginname__,
+                        jobs=scheduled and build_jobs() or None)
+
+    renderer = render.get()
+    renderer.heading("Looking for the outdated ports")
+
+    # What is outdated in every system - all of them at the same time. The
+    # systems that cannot be asked are left out of the plan.
+    outdated = {}
+
+    for jail, origins, error in run_in_jails(jails, _outdated_origins):
+        if error is None and origins:
+            outdated[jail] = origins
+
+    renderer.item("info", "%d of %d system(s) have outdated ports." % \
+                  (len(outdated), len(jails)))
+
+    # The origins of every system taken care of by the package cache and the
+    # steps the rest of the upgrade of the system waits for.
+    done = dict([(jail, []) for jail in outdated])
+    waits = dict([(jail, []) for jail in outdated])
+
+    # The package cache is on this host, so the jails of the other hosts
+    # (see czokomaster.backends) are upgraded the usual way as a whole.
+    local = [jail for jail in jails if jail in outdated and \
+             host_of(jail) is None]
+
+    if shared and local:
+        _plan_shared(upgrade_plan, local, outdated, done, waits)
+
+    left = dict([(jail, [origin for origin, version in outdated[jail] \
+                         if origin not in done[jail]]) for jail in outdated])
+    graphs = {}
+
+    if scheduled:
+        for jail, graph, error in run_in_jails([jail for jail in jails \
+                                                if left.get(jail)],
+                                               lambda jail: \
+                                               port_dependencies(jail,
+                                                                 left[jail])):
+            if error is None:
+                graphs[jail] = graph
 
     for jail in jails:
-        # Print available updates.
-        print "\nAvailable updates for", \
-              colored(jail, "cyan") + ":"
+        if not left.get(jail):
+            continue
+
+        if jail not in graphs:
+            upgrade_plan.add("upgrade:%s" % jail, "command", jail,
+                             "upgrade the ports of %s" % describe_jail(jail),
+                             ports_upgrade_cmd, packages=left[jail],
+                             after=waits[jail])
+            continue
+
+        graph = graphs[jail]
+
+        for origin in build_order(graph, sorted(graph)):
+            # A dependency cycle (if the ports tree has any) is broken at
+            # the port that comes first.
+            after = [id for id in ["upgrade:%s:%s" % (jail, dependency) \
+                                   for dependency in graph[origin]] \
+                     if upgrade_plan.has(id)]
+
+            upgrade_plan.add("upgrade:%s:%s" % (jail, origin), "command",
+                             jail, "upgrade %s in %s" % (origin,
+                                                         describe_jail(jail)),
+                             port_upgrade_cmd.format(origin=origin),
+                             packages=[origin], after=waits[jail] + after)
+
+    return upgrade_plan
+
+def _plan_shared(upgrade_plan, jails, outdated, done, waits):
+    """
+    Add the builds of the packages missing from the package cache and their
+    installs to the plan (see _plan()). The origins installed in a jail are
+    added to done[jail], the steps that install them to waits[jail].
+    """
+
+    from czokomaster.plugins.plugin_helpers.ports_package_cache import \
+         PackageCache
+    from czokomaster.plugins.plugin_helpers.ports_build_scheduler import \
+         port_dependencies, build_order
+
+    builder = get_config_option(__pluginname__, "package_builder")
+    install_cmd = get_config_option(__pluginname__, "package_install_cmd")
+    package_cachedir = get_config_option(__pluginname__, "package_cachedir")
+    jail_package_dir = get_config_option(__pluginname__,
+                                         "jail_package_dir") or \
+                       package_cachedir
+
+    # The cache is only looked into, the builds and the installs count once
+    # the plan is applied.
+    cache = PackageCache(package_cachedir)
+    packages, missing = _find_shared(jails, builder, cache, outdated)
+
+    if missing:
+        graph = port_dependencies(builder, missing.keys())
+
+        for origin in build_order(graph, sorted(graph)):
+            version, options, key = missing[origin]
+            after = [id for id in ["build:%s" % dependency for dependency \
+                                   in graph[origin]] if upgrade_plan.has(id)]
+
+            upgrade_plan.add("build:%s" % origin, "build", builder,
+                             "build the package of %s on %s" % \
+                             (origin, describe_jail(builder)),
+                             args={"origin": origin, "version": version,
+                                   "options": options, "key": key},
+                             packages=[origin], after=after)
+
+            # The builder upgrades the port while building the package.
+            if builder in done:
+                done[builder].append(origin)
+                waits[builder].append("build:%s" % origin)
+
+    installs = dict([(jail, []) for jail in jails])
+
+    for origin, key, wanted in packages:
+        for jail in wanted:
+            installs[jail].append((origin, key))
+
+    for jail in jails:
+        if not installs[jail]:
+            continue
+
+        origins = [origin for origin, key in installs[jail]]
+        id = upgrade_plan.add("install:%s" % jail, "command", jail,
+                              "install the shared packages in %s" % \
+                              describe_jail(jail),
+                              install_cmd.format(package_dir=jail_package_dir,
+                                                 origins=" ".join(origins)),
+                              args={"keys": [key for origin, key in \
+                                             installs[jail]]},
+                              packages=origins,
+                              after=[build for build in ["build:%s" % origin \
+                                                         for origin in origins]
+                                     if upgrade_plan.has(build)] + \
+                                    waits[jail])
+
+        done[jail] += origins
+        waits[jail].append(id)
+
+def _prefetch(jails):
+    """
+    Fetch the distfiles of the ports outdated in the given systems of this
+    host into the fetch cache - every port once, at the version the first
+    system it is outdated in is going to upgrade it to. The host fetches
+    them out of the ports tree of that system (so "distfile_fetch_cmd" is
+    run on the host with DISTDIR pointing at the cache), then the cache is
+    mounted in the jails.
+    """
+
+    distfiles_cmd = get_config_option(__pluginname__, "distfiles_cmd")
+    fetch_cmd = get_config_option(__pluginname__, "distfile_fetch_cmd")
+    jails = fetchcache.local_jails(jails)
+    cache = fetchcache.from_config()
+
+    renderer = render.get()
+    renderer.blank()
+    renderer.heading("Prefetching the distfiles of the outdated ports")
+
+    # The union of the outdated ports of all the systems.
+    artifacts = []
+    seen = set()
+
+    for jail, origins, error in run_in_jails(jails, _outdated_origins):
+        ports_dir = os.path.join(jail_root(jail),
+                                 inventory.PORTS_DIR.lstrip(os.sep))
+
+        for origin, version in origins or []:
+            if (origin, version) not in seen:
+                seen.add((origin, version))
+                artifacts.append(("%s %s" % (origin, version),
+                                  (origin, ports_dir)))
+
+    # "make -V DIST_SUBDIR -V ALLFILES" gives e.g. an empty line (no
+    # subdirectory) and "perl-5.12.4.tar.bz2".
+    def files_of(artifact):
+        origin, ports_dir = artifact
+        stdout, stderr = execute_command([distfiles_cmd.format(
+                                         ports_dir=ports_dir, origin=origin)],
+                                         func_return=True)
+        lines = (stdout or "").split("\n")
+
+        if len(lines) < 2:
+            return None
+
+        return [os.path.join("distfiles", lines[0].strip(), filename) \
+                for filename in lines[1].split()]
+
+    def fetch(artifact, files):
+        origin, ports_dir = artifact
+
+        return execute_command([fetch_cmd.format(
+                               ports_dir=ports_dir, origin=origin,
+                               distdir=cache.path("distfiles"))]) == [0]
+
+    fetchcache.prefetch(cache, artifacts, files_of, fetch)
+    fetchcache.expose(jails)
+
+def _upgrade(jail, ports_upgrade_cmd, journal):
+    """
+    Upgrade the ports of a single system - the base system or a jail. Note
+    it in the journal and return True if it goes fine.
+    """
 
-        stdout, stderr = execute_command(["jexec %s %s" % (jail,
-                         show_updates_cmd)], func_return=True)
+    renderer = render.get()
+    renderer.blank()
+    renderer.heading("Upgrading", describe_jail(jail), jail=jail)
+    renderer.blank()
 
-        # If stdout is nil, don't print red '->'. Print green '-> None'.
-        if stdout:
-            print colored("->", "red"), stdout[:-2].replace("\n", \
-                  colored("\n-> ", "red"))
+    if execute_command([jail_command(jail, ports_upgrade_cmd)]) == [0]:
+        journal.complete(jail, "upgrade")
+        return True
+
+    return False
+
+def _upgrade_shared(jails, journal):
+    """
+    Build every port that is outdated in any of the jails once, keep the
+    package in the shared package cache and install it in the jails that
+    need it. The package is reused only by the jails in which the port is
+    outdated to the very same version and is built with the very same
+    options as on the builder. The systems the packages have been installed
+    in are noted in the journal - the ones with no outdated port left (the
+    builder included) as upgraded already. Return the list of the jails that
+    could not be asked what is outdated in them - they are left alone here
+    and not noted in the journal.
+    """
+
+    from czokomaster.plugins.plugin_helpers.ports_package_cache import \
+         PackageCache
+
+    builder = get_config_option(__pluginname__, "package_builder")
+    build_cmd = get_config_option(__pluginname__, "package_build_cmd")
+    install_cmd = get_config_option(__pluginname__, "package_install_cmd")
+    package_cachedir = get_config_option(__pluginname__, "package_cachedir")
+    cache = PackageCache(package_cachedir,
+                         get_config_option(__pluginname__,
+                                           "package_cache_size"))
+
+    # The shared package directory is usually mounted (e.g. with nullfs) in
+    # the builder and the jails under different paths. If not given, it is
+    # the same path as on the host.
+    builder_package_dir = get_config_option(__pluginname__,
+                                            "builder_package_dir") or \
+                          package_cachedir
+    jail_package_dir = get_config_option(__pluginname__,
+                                         "jail_package_dir") or \
+                       package_cachedir
+
+    # What is outdated in every jail - the jails that have got all of it
+    # from the cache need not be upgraded any further. A jail that could not
+    # be asked is not one with nothing outdated, it is left to the usual
+    # upgrade (the error has been printed by run_in_jails() already).
+    outdated = {}
+    unasked = []
+
+    for jail, origins, error in run_in_jails(jails, _outdated_origins):
+        if error is None:
+            outdated[jail] = origins
         else:
-            print colored("->", "green"), colored("None", attrs=["bold"])
\ No newline at end of file
+            unasked.append(jail)
+
+    jails = [jail for jail in jails if jail in outdated]
+
+    if not jails:
+        return unasked
+
+    packages, missing = _find_shared(jails, builder, cache, outdated)
+
+    # Build the missing packages on the builder - the ones that do not
+    # depend on each other at the same time, every package after the
+    # packages it depends on.
+    built = {}
+
+    if missing:
+        from czokomaster.plugins.plugin_helpers.ports_build_scheduler import \
+             port_dependencies, schedule_builds
+
+        def build(jail, origin):
+            version, options, key = missing[origin]
+
+            return _build_package(builder, origin, version, options,
+                                  build_cmd, builder_package_dir, cache, key)
+
+        # Nothing is built if the builder cannot tell what the packages
+        # depend on - the jails get whatever the cache has got already.
+        try:
+            built = schedule_builds({builder: port_dependencies(builder,
+                                     missing.keys())}, build)
+        except JobError, error:
+            renderer = render.get()
+            renderer.item("error", renderer.bold("Not building the shared "
+                                                 "packages:"),
+                          "%s." % error, jail=builder)
+
+    # Which origins each jail is going to install from the cache.
+    installs = dict([(jail, []) for jail in jails])
+    used = []
+
+    for origin, key, wanted in packages:
+        if origin in missing and not built.get((builder, origin)):
+            continue
+
+        # The first jail is the one the package has been looked up for,
+        # the rest of them are hits as well.
+        for jail in wanted[1:]:
+            cache.hit(key)
+
+        used.append(key)
+
+        for jail in wanted:
+            installs[jail].append(origin)
+
+    def upgraded(jail):
+        if jail not in outdated:
+            return False
+
+        origins = installs.get(jail, [])
+
+        return not [origin for origin, version in outdated[jail] \
+                    if origin not in origins and \
+                    not (jail == builder and built.get((builder, origin)))]
+
+    # Install the packages in the jails.
+    def install(jail):
+        if not installs[jail]:
+            journal.complete(jail, "install")
+
+            if upgraded(jail):
+                journal.complete(jail, "upgrade")
+            return
+
+        renderer = render.get()
+        renderer.blank()
+        renderer.heading("Installing shared packages in", describe_jail(jail),
+                         jail=jail)
+        renderer.blank()
+
+        if execute_command([jail_command(jail, install_cmd.format(
+                           package_dir=jail_package_dir,
+                           origins=" ".join(installs[jail])))]) == [0]:
+            journal.complete(jail, "install")
+
+            if upgraded(jail):
+                journal.complete(jail, "upgrade")
+
+    run_in_jails(jails, install)
+
+    _save_cache(cache, used)
+
+    return unasked
+
+def _find_shared(jails, builder, cache, outdated=None):
+    """
+    Find out which packages the given jails might share ("outdated" is the
+    dict: jail -> the list of (origin, version) of its outdated ports, if
+    they are known already). Return (the list
+    of (origin, key, the jails that may install the package), the dict:
+    origin -> (version, options, key) of the packages that are not in the
+    cache yet, i.e. the ones to be built on the builder). The packages
+    found in the cache count as hits.
+    """
+
+    from czokomaster.plugins.plugin_helpers.ports_package_cache import \
+         package_key
+    from czokomaster.plugins.plugin_helpers.ports_outdated_index import \
+         OutdatedIndex
+
+    renderer = render.get()
+    renderer.blank()
+    renderer.heading("Looking for the ports to build once for all the jails")
+
+    # Find out what is outdated in every jail and with what options the
+    # outdated ports are built there - all the jails at the same time, into
+    # a single index.
+    index = OutdatedIndex().gather(jails, lambda jail: \
+                                   [(origin, {"available": version,
+                                              "options": options}) \
+                                    for origin, version, options in \
+                                    _outdated_ports(jail, outdated and \
+                                                    outdated.get(jail))])
+
+    # Go through the ports outdated in the most jails first. The ports they
+    # depend on are built before them anyway (see ports_build_scheduler).
+    origins = []
+
+    for origin in index.sorted_ports():
+        for jail in index.outdated_in(origin):
+            version = index.get(origin, jail)["available"]
+
+            if (origin, version) not in origins:
+                origins.append((origin, version))
+
+    # Find out which packages are wanted and which of them are not in the
+    # cache yet.
+    packages = []
+    missing = {}
+
+    for origin, version in origins:
+        builder_options = _port_options(builder, origin)
+        key = package_key(origin, version, builder_options)
+
+        # The jails that may reuse the package built on the builder. The
+        # builder itself upgrades the port while building the package.
+        wanted = [jail for jail in index.outdated_in(origin) if \
+                  jail != builder and \
+                  index.get(origin, jail) == {"available": version,
+                                              "options": builder_options}]
+
+        if not wanted:
+            continue
+
+        packages.append((origin, key, wanted))
+
+        if cache.lookup(key) is None:
+            missing[origin] = (version, builder_options, key)
+
+    return packages, missing
+
+def _save_cache(cache, used):
+    """
+    Keep the package cache within its size limit (the packages on the
+    "used" list are kept anyway) and write its index down.
+    """
+
+    evicted = cache.evict(keep=used)
+    cache.save()
+
+    renderer = render.get()
+    renderer.blank()
+    renderer.item("info", renderer.bold("Package cache:"),
+                  "%d hit(s), %d miss(es), %d package(s) evicted, %.1f MB in "
+                  "use" % (cache.hits, cache.misses, len(evicted),
+                           cache.size() / 1024.0 / 1024.0))
+
+def _upgrade_scheduled(jails, journal):
+    """
+    Upgrade the outdated ports of the given systems one by one rather than
+    with a single "portmaster -ad" per system. The ports that do not depend
+    on each other are built at the same time ("build_jobs" of them in all
+    the systems together), every port only after the outdated ports it
+    depends on. Every port upgraded is noted in the journal, the ports noted
+    there already are not upgraded again. Return (the list of the
+    systems that have been upgraded completely, the list of the systems that
+    could not be asked what to upgrade).
+    """
+
+    from czokomaster.plugins.plugin_helpers.ports_build_scheduler import \
+         port_dependencies, schedule_builds, build_jobs
+
+    port_upgrade_cmd = get_config_option(__pluginname__, "port_upgrade_cmd")
+    jobs = build_jobs()
+
+    renderer = render.get()
+    renderer.blank()
+    renderer.heading("Upgrading the outdated ports in dependency order, %d at "
+                     "a time" % jobs)
+
+    # Find out what is outdated in every system and what depends on what.
+    graphs = {}
+    upgraded = []
+    failed = []
+
+    for jail, graph, error in run_in_jails(jails, lambda jail: \
+                                           port_dependencies(jail,
+                                           [origin for origin, version in \
+                                            _outdated_origins(jail)], jobs)):
+        if error is not None:
+            failed.append(jail)
+        elif graph:
+            graphs[jail] = graph
+        else:
+            upgraded.append(jail)
+
+    def upgrade(jail, origin):
+        if journal.is_done(jail, origin):
+            return True
+
+        if execute_command([jail_command(jail, port_upgrade_cmd.format(
+                           origin=origin))]) != [0]:
+            return False
+
+        journal.complete(jail, origin)
+
+        return True
+
+    built = schedule_builds(graphs, upgrade, jobs)
+
+    renderer.blank()
+    renderer.item("info", renderer.bold("Scheduled upgrade:"),
+                  "%d port(s) upgraded, %d failed" % \
+                  (len([origin for origin in built.values() if origin]),
+                   len([origin for origin in built.values() if not origin])))
+
+    for jail in graphs:
+        if not [origin for origin in graphs[jail] if \
+                not built[(jail, origin)]]:
+            upgraded.append(jail)
+
+    return upgraded, failed
+
+def _outdated_origins(jail):
+    """
+    Return the list of (origin, version) of the ports that are outdated in
+    the given system. "version" is the version the port is to be upgraded
+    to. JobError is raised if the system cannot be asked.
+    """
+
+    # The inventory knows the origins of the outdated ports without asking
+    # the system (if the system can be read from the host, that is).
+    if inventory.is_used():
+        ports, snapshot = inventory.outdated(jail, "ports")
+
+        if ports is not None:
+            return [(port["origin"], port["available"]) for port in ports \
+                    if port["origin"]]
+
+    shared_updates_cmd = get_config_option(__pluginname__,
+                                           "shared_updates_cmd")
+    stdout, stderr = execute_command([jail_command(jail, shared_updates_cmd)],
+                                     func_return=True)
+
+    # A system that could not be asked is not one with nothing outdated.
+    if stderr.strip():
+        raise JobError("could not ask %s: %s" % (describe_jail(jail),
+                                                 stderr.strip()))
+
+    ports = []
+
+    for line in (stdout or "").splitlines():
+        # pkg_version -o gives e.g.:
+        # lang/perl5.12  <  needs updating (index has 5.12.4_4)
+        match = re.match(r"(\S+)\s.*\((?:index|port) has ([^)]+)\)", line)
+
+        if match:
+            ports.append(match.groups())
+
+    return ports
+
+def _outdated_ports(jail, origins=None):
+    """
+    Return the list of (origin, version, options) of the ports that are
+    outdated in the given system. "version" is the version the port is to be
+    upgraded to. "origins" are the (origin, version) of the outdated ports,
+    if they are known already (the system is asked otherwise).
+    """
+
+    if origins is None:
+        origins = _outdated_origins(jail)
+
+    return [(origin, version, _port_options(jail, origin)) for \
+            origin, version in origins]
+
+def _port_options(jail, origin):
+    """
+    Return the sorted list of the options the port is built with in the
+    given system.
+    """
+
+    port_options_cmd = get_config_option(__pluginname__, "port_options_cmd")
+    stdout, stderr = execute_command([jail_command(jail,
+                                     port_options_cmd.format(origin=origin))],
+                                     func_return=True)
+
+    return sorted((stdout or "").split())
+
+def _build_package(builder, origin, version, options, build_cmd, package_dir,
+                   cache, key):
+    """
+    Build the package of the port on the builder and put it into the cache.
+    Return True if the package has been built. Many packages might be built
+    at the same time (see ports_build_scheduler).
+    """
+
+    renderer = render.get()
+    renderer.blank()
+    renderer.heading("Building %s on" % origin, describe_jail(builder),
+                     jail=builder, port=origin)
+    renderer.blank()
+
+    execute_command([jail_command(builder, build_cmd.format(
+                    origin=origin, package_dir=package_dir))])
+
+    # The package is named after the port, e.g. perl-5.12.4_4.tbz.
+    port_pkgname_cmd = get_config_option(__pluginname__, "port_pkgname_cmd")
+    stdout, stderr = execute_command([jail_command(builder,
+                                     port_pkgname_cmd.format(origin=origin))],
+                                     func_return=True)
+    pkgname = (stdout or "").strip()
+
+    # The ports tree of the builder might differ from the one of the jails.
+    # Such a package is of no use for the jails.
+    if not pkgname.endswith("-" + version):
+        renderer.item("error", "%s has been built as %s, not as version %s. "
+                      "It will not be shared." % (origin, pkgname or "nothing",
+                                                  version),
+                      jail=builder, port=origin)
+        return False
+
+    with _cache_lock:
+        for filename in os.listdir(cache.packagedir):
+            if os.path.splitext(filename)[0] == pkgname:
+                cache.add(key, origin, version, options, filename)
+                return True
+
+    renderer.item("error", "No package of %s found in %s. It will not be "
+                  "shared." % (pkgname, cache.packagedir), jail=builder,
+                  port=origin)
+
+    return False
+
+def _print_aggregated(jails, show_updates_cmd, as_json=False, refresh=False):
+    """
+    Ask all the systems at the same time (or take their answers out of the
+    cache) and show each outdated port once, the ports outdated in the most
+    systems first. Exit with 1 if any of the systems could not be asked.
+    """
+
+    from czokomaster.plugins.plugin_helpers.ports_outdated_index import \
+         OutdatedIndex, parse_pkg_version
+
+    index = OutdatedIndex()
+
+    # A system that could not be asked is noted among the errors of the
+    # index rather than raised, so nothing but the JSON document is printed
+    # with "--json".
+    def query(jail):
+        stdout, stderr, refreshed = _show_updates(jail, show_updates_cmd,
+                                                  refresh)
+
+        if stderr.strip():
+            index.errors[jail] = stderr.strip()
+            return []
+
+        return parse_pkg_version(stdout)
+
+    index.gather(jails, query)
+    renderer = render.get()
+
+    if as_json:
+        renderer.document("outdated", index.as_dict())
+
+        if index.errors:
+            sys.exit(1)
+        return
+
+    renderer.blank()
+    renderer.text("Available updates for",
+                  renderer.highlight("%d system(s)" % len(jails)) + ":")
+
+    if not index.ports and len(index.errors) < len(jails):
+        renderer.item("ok", renderer.bold("None"))
+
+    for port in index.sorted_ports():
+        renderer.item("outdated", renderer.bold(port),
+                      "(%d):" % len(index.outdated_in(port)),
+                      ", ".join(["%s %s" % (describe_jail(jail), "%s -> %s" % (
+                                 index.get(port, jail)["installed"],
+                                 index.get(port, jail)["available"])) \
+                                 for jail in index.outdated_in(port)]),
+                      port=port)
+
+    for jail in jails:
+        if jail in index.errors:
+            renderer.item("error", "Could not ask",
+                          renderer.highlight(describe_jail(jail)) + ":",
+                          index.errors[jail], jail=jail)
+
+    if index.errors:
+        sys.exit(1)
+
+def _print_updates(jail, show_updates_cmd, refresh=False):
+    """
+    Print the ports that need to be updated in a single system.
+    """
+
+    # The output is not printed but returned to stdout and stderr variables -
+    # either by running the command right now or out of the cache, if the
+    # system has been asked not long ago (see ports_diff_cache), or out of
+    # the inventory.
+    stdout, stderr, refreshed = _show_updates(jail, show_updates_cmd, refresh)
+    renderer = render.get()
+
+    renderer.blank()
+    renderer.text("Available updates for",
+                  renderer.highlight(describe_jail(jail)) + \
+                  (refreshed is not None and " (as of %s)" % \
+                   describe_age(refreshed) or "") + ":", jail=jail)
+
+    # Every outdated port is a line of its own, passed on to the renderer
+    # one by one. If there is none, print green '-> None'.
+    outdated = False
+
+    for line in (stdout or "").splitlines():
+        if line.strip():
+            renderer.item("outdated", line.rstrip(), jail=jail)
+            outdated = True
+
+    if not outdated:
+        renderer.item("ok", renderer.bold("None"), jail=jail)
+
+    # Show what went wrong, if anything.
+    for line in (stderr or "").rstrip().splitlines():
+        renderer.item("error", renderer.paint(line, "red"), jail=jail)
+
+def _show_updates(jail, show_updates_cmd, refresh=False):
+    """
+    Return (stdout, stderr, refreshed) just like show_updates() does. With
+    "use_inventory = yes", the outdated ports are taken out of the inventory
+    and given the way "pkg_version -vIl" would give them - unless the files
+    of the system cannot be reached from the host.
+    """
+
+    if inventory.is_used():
+        ports, snapshot = inventory.outdated(jail, "ports", refresh)
+
+        if ports is not None:
+            return "".join(["%-34s <   needs updating (index has %s)\n" % \
+                            ("%s-%s" % (port["name"], port["installed"]),
+                             port["available"]) for port in ports]), "", None
+
+    return show_updates(jail, show_updates_cmd, refresh)
@@ -0,0 +1,186 @@
+"""
+This is the plugin registry of czokomaster. Rather than listing the plugins
+dir and importing the plugins every time czokomaster is started, the plugins
+are described once in the manifest file (see CZOKOMASTER_CACHE_DIR) and the
+manifest is used from then on. It is rebuilt only if the plugins dir changes,
+i.e. a plugin is added, removed or edited.
+
+The manifest is made without importing the plugins - the source of each
+plugin is parsed instead. Every plugin is described by:
+
+  - name - the name the plugin is invoked by (the name of its file);
+  - version - the __version__ of the plugin, if it has one;
+  - commands - the names of the functions that might be invoked from the
+               command line, i.e. the functions of the plugin not starting
+               with "_";
+  - module - the module to be imported in order to run any of these.
+
+Thus, "czokomaster plugins" and "czokomaster help" do not import any plugin
+at all, while "czokomaster <plugin> <command>" imports only the plugin asked
+for (and only once its command is known to exist).
+"""
+
+import os
+import ast
+import json
+
+import files
+
+from meta import CZOKOMASTER_CACHE_DIR
+
+## Bump it whenever the format of the manifest changes, so the manifests
+## written by the older versions are rebuilt.
+MANIFEST_VERSION = 1
+
+## The manifest loaded (or built) so far within this process.
+_manifest = {"manifest": None}
+
+def plugins_dir():
+    """
+    Return the path to the plugins dir.
+    """
+
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "plugins")
+
+def get_plugins():
+    """
+    Return the dict: plugin name -> description of the plugin (see the top
+    of the module).
+    """
+
+    if _manifest["manifest"] is None or not _is_fresh(_manifest["manifest"]):
+        _manifest["manifest"] = _load_manifest()
+
+    return _manifest["manifest"]["plugins"]
+
+def get_command(plugin, command):
+    """
+    Import the plugin and return its function that implements the command.
+    None is returned if the plugin has no such command.
+    """
+
+    plugins = get_plugins()
+
+    if plugin not in plugins or command not in plugins[plugin]["commands"]:
+        return None
+
+    module = __import__(plugins[plugin]["module"], globals(), locals(),
+                        [command], -1)
+
+    return getattr(module, command, None)
+
+def _load_manifest():
+    """
+    Return the manifest kept in the cache dir, provided it still describes
+    the plugins dir. Otherwise, build a new one and keep it for the next
+    runs.
+    """
+
+    path = os.path.join(CZOKOMASTER_CACHE_DIR, "plugins.json")
+
+    try:
+        f = open(path, "r")
+        manifest = json.load(f)
+        f.close()
+
+        if manifest.get("version") == MANIFEST_VERSION and \
+           _is_fresh(manifest):
+            return manifest
+    except (IOError, ValueError):
+        pass
+
+    manifest = _build_manifest()
+
+    ## The cache dir might not be writable (e.g. czokomaster is run by
+    ## someone else than root). The manifest is simply built every time
+    ## then.
+    try:
+        if not os.path.exists(CZOKOMASTER_CACHE_DIR):
+            os.makedirs(CZOKOMASTER_CACHE_DIR, 0755)
+
+        files.write_atomically(path, json.dumps(manifest, indent=1,
+                                                sort_keys=True))
+    except (IOError, OSError):
+        pass
+
+    return manifest
+
+def _is_fresh(manifest):
+    """
+    Whether the manifest still describes the plugins dir. The dir itself
+    changes whenever a plugin is added or removed (or saved by an editor that
+    replaces the file), the plugins themselves are checked for the edits
+    made in place.
+    """
+
+    try:
+        if os.stat(plugins_dir()).st_mtime != manifest["mtime"]:
+            return False
+
+        for plugin in manifest["plugins"].values():
+            if os.stat(plugin["path"]).st_mtime != plugin["mtime"]:
+                return False
+    except OSError:
+        return False
+
+    return True
+
+def _build_manifest():
+    """
+    Describe every plugin found in the plugins dir. Leave out __init__.py
+    and the files that are not python sources.
+    """
+
+    directory = plugins_dir()
+    plugins = {}
+
+    for filename in sorted(os.listdir(directory)):
+        if filename == "__init__.py" or not filename.endswith(".py"):
+            continue
+
+        plugin = _describe_plugin(os.path.join(directory, filename))
+
+        if plugin is not None:
+            plugins[plugin["name"]] = plugin
+
+    return {"version": MANIFEST_VERSION,
+            "mtime": os.stat(directory).st_mtime,
+            "plugins": plugins}
+
+def _describe_plugin(path):
+    """
+    Parse the source of the plugin and return its description (see the top
+    of the module) or None if the plugin cannot be parsed.
+    """
+
+    name = os.path.basename(path)[:-3]
+
+    f = open(path, "r")
+    source = f.read()
+    f.close()
+
+    try:
+        tree = ast.parse(source, path)
+    except SyntaxError:
+        return None
+
+    version = None
+    commands = []
+
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and \
+           not node.name.startswith("_"):
+            commands.append(node.name)
+        elif isinstance(node, ast.Assign) and \
+             isinstance(node.value, ast.Str):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id == "__version__":
+                    version = node.value.s
+
+    return {"name": name,
+            "version": version,
+            "commands": commands,
+            "module": "czokomaster.plugins.%s" % name,
+            "path": path,
+            "mtime": os.stat(path).st_mtime}
@@ -0,0 +1,351 @@
+"""
+These are the renderers of czokomaster - whatever czokomaster itself (and
+its plugins) has to say goes through the renderer of the run rather than
+straight to print. The run is made of:
+
+  - headings - "==> Upgrading www:", the start of a part of the run;
+  - items - "-> Done.", a single line saying how something went, with the
+    status of the line ("ok", "info", "warning", "error" or "outdated");
+  - text - the lines that are neither (e.g. "Available updates for www:");
+  - output - the lines printed by the commands czokomaster runs (portmaster,
+    easy_install, ...);
+  - documents - whatever is asked for as JSON (e.g. "ports plan --json").
+
+The renderer is set by "output" in the [czokomaster] section of the config
+file or by "--output" on the command line:
+
+  - tty - the colors, just like czokomaster always looked;
+  - plain - the same lines with no colors. Nothing is painted at all, so it
+    is the fast one, meant for cron and for the logs;
+  - json - one JSON document per line (per heading, item, line of output,
+    ...), tagged with the plugin and the action of the run and, if known,
+    the jail - for the log shippers and for the scripts;
+  - summary - the errors as they come and a single line at the end, saying
+    how many of the items have gone which way (the output of the commands
+    is left out);
+  - auto - tty if stdout is a terminal, plain otherwise.
+
+Everything is written down line by line as it comes, nothing is gathered
+first. The jobs run in parallel still print to their own buffers (see
+engine.py), as the renderer writes to sys.stdout of the moment.
+"""
+
+import sys
+import json
+import time
+import threading
+
+from termcolor import colored
+
+## The color of the "->" of the items, by their status.
+STATUS_COLORS = {"ok": "green", "info": "blue", "warning": "yellow",
+                 "error": "red", "outdated": "red"}
+
+## The renderer of the current run and what it is to be made of (see
+## select()). "tty" is what the client of the daemon has told about its
+## stdout, None if there is no client (see daemon.py).
+_state = {"renderer": None, "name": None, "context": {}, "tty": None}
+_state_lock = threading.Lock()
+
+class Renderer(object):
+    """
+    The plain renderer - the lines just like the tty one prints them, with
+    no colors. The other renderers override paint() (the tty one) or emit()
+    (the rest of them).
+    """
+
+    ## Whether the commands might just as well write to the terminal
+    ## themselves, as output() would not change a thing anyway.
+    passes_output = True
+
+    def __init__(self, context=None):
+        """
+        "context" is what every JSON document of the run is tagged with (the
+        plugin and the action).
+        """
+
+        self.context = context or {}
+
+    def paint(self, text, color=None, attrs=None):
+        """
+        Return the text painted (termcolor.colored() style) - or, here, just
+        the text.
+        """
+
+        return text
+
+    def bold(self, text):
+        return self.paint(text, attrs=["bold"])
+
+    def highlight(self, text):
+        """
+        Return the name of a system, a port or a package, painted.
+        """
+
+        return self.paint(text, "cyan")
+
+    def heading(self, title, subject=None, note=None, **fields):
+        """
+        Print "==> title subject: note", e.g. heading("Upgrading", "www").
+        """
+
+        self.emit("heading", None, self.paint("==>", "green"),
+                  self.bold(title) + (subject is not None and " " + \
+                                      self.highlight(subject) or "") + \
+                  self.bold(":") + (note and " " + note or ""), fields)
+
+    def item(self, status, *parts, **fields):
+        """
+        Print "-> parts", the arrow painted after the status, e.g.
+        item("error", "Could not ask", renderer.highlight("www") + ":",
+        error, jail="www").
+        """
+
+        self.emit("item", status, self.paint("->", STATUS_COLORS[status]),
+                  " ".join(parts), fields)
+
+    def text(self, *parts, **fields):
+        """
+        Print the parts joined just like print joins them (no space after a
+        part that ends a line), line by line - e.g. the help of a plugin.
+        """
+
+        joined = ""
+
+        for part in parts:
+            if joined and not joined.endswith("\n"):
+                joined += " "
+
+            joined += part
+
+        for line in joined.split("\n"):
+            self.emit(line and "text" or "blank", None, None, line, fields)
+
+    def blank(self, **fields):
+        self.emit("blank", None, None, "", fields)
+
+    def output(self, line, stream="stdout", **fields):
+        """
+        Print a line of the output of a command as it is.
+        """
+
+        (fields.pop("to", None) or sys.stdout).write(line)
+
+    def document(self, name, value, **fields):
+        """
+        Print what is asked for as JSON, e.g. document("plan", plan.to_dict()).
+        """
+
+        (fields.pop("to", None) or sys.stdout).write(
+            json.dumps(value, indent=1, sort_keys=True) + "\n")
+
+    def finish(self):
+        """
+        The run is over.
+        """
+
+    def emit(self, kind, status, marker, text, fields):
+        """
+        Write the line down. "to" among the fields is the stream to write
+        to, sys.stdout of the moment by default.
+        """
+
+        (fields.get("to") or sys.stdout).write(
+            (marker and marker + " " or "") + text + "\n")
+
+class TTYRenderer(Renderer):
+    """
+    The plain renderer painting the lines.
+    """
+
+    def paint(self, text, color=None, attrs=None):
+        return colored(text, color, attrs=attrs)
+
+class JSONRenderer(Renderer):
+    """
+    One JSON document per line, e.g.:
+
+        {"type": "item", "status": "outdated", "text": "perl-5.12.4_3 ...",
+         "jail": "www", "plugin": "ports", "action": "diff", "time": ...}
+    """
+
+    passes_output = False
+
+    def output(self, line, stream="stdout", **fields):
+        fields["stream"] = stream
+        self.emit("output", None, None, line.rstrip("\n"), fields)
+
+    def document(self, name, value, **fields):
+        fields["name"] = name
+        fields["document"] = value
+        self.emit("document", None, None, "", fields)
+
+    def emit(self, kind, status, marker, text, fields):
+        if kind == "blank":
+            return
+
+        record = dict(self.context)
+        record.update([(key, value) for key, value in fields.items() \
+                       if key != "to" and value is not None])
+        record.update({"type": kind, "time": round(time.time(), 3)})
+
+        if status is not None:
+            record["status"] = status
+
+        if kind != "document":
+            record["text"] = text
+
+        (fields.get("to") or sys.stdout).write(json.dumps(record,
+                                                          sort_keys=True) + \
+                                               "\n")
+
+class SummaryRenderer(Renderer):
+    """
+    The errors as they come, then a single line once the run is over, e.g.:
+
+        -> Could not ask db: jexec: jail "db" not found
+        ports diff: 3 heading(s), 12 item(s) - 1 error, 8 ok, 3 outdated -
+        in 2.4 second(s).
+    """
+
+    passes_output = False
+
+    def __init__(self, context=None):
+        Renderer.__init__(self, context)
+
+        self.started = time.time()
+        self.headings = 0
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def output(self, line, stream="stdout", **fields):
+        pass
+
+    def document(self, name, value, **fields):
+        (fields.pop("to", None) or sys.stdout).write(
+            json.dumps(value, sort_keys=True) + "\n")
+
+    def emit(self, kind, status, marker, text, fields):
+        with self.lock:
+            if kind == "heading":
+                self.headings += 1
+            elif kind == "item":
+                self.counts[status] = self.counts.get(status, 0) + 1
+
+        if status == "error":
+            Renderer.emit(self, kind, status, marker, text, fields)
+
+    def finish(self):
+        with self.lock:
+            counts = ", ".join(["%d %s" % (self.counts[status], status) \
+                                for status in sorted(self.counts)])
+
+            sys.stdout.write("%s: %d heading(s), %d item(s)%s in %.1f "
+                             "second(s).\n" % \
+                             (" ".join([self.context[key] for key in \
+                                        ("plugin", "action") \
+                                        if self.context.get(key)]) or \
+                              "czokomaster", self.headings,
+                              sum(self.counts.values()),
+                              counts and " - %s -" % counts or "",
+                              time.time() - self.started))
+
+## The renderers "output" might be set to ("auto" is either "tty" or
+## "plain").
+RENDERERS = {"tty": TTYRenderer, "plain": Renderer, "json": JSONRenderer,
+             "summary": SummaryRenderer}
+
+def select(name=None, **context):
+    """
+    Have the current run rendered by the given renderer ("output" of the
+    config file if None) and tag it with the context (see JSONRenderer).
+    """
+
+    with _state_lock:
+        _state["renderer"] = None
+        _state["name"] = name
+        _state["context"] = dict([(key, value) for key, value in \
+                                  context.items() if value is not None])
+
+def assume_tty(tty):
+    """
+    Let "auto" know whether the one who reads the output has a terminal,
+    when it is not stdout of this process (see daemon.py).
+    """
+
+    _state["tty"] = tty
+
+def get():
+    """
+    Return the renderer of the current run, made the first time it is asked
+    for.
+    """
+
+    with _state_lock:
+        if _state["renderer"] is None:
+            _state["renderer"] = new(_state["name"], _state["tty"],
+                                     **_state["context"])
+
+        return _state["renderer"]
+
+def new(name=None, tty=None, **context):
+    """
+    Return a renderer of its own rather than the one of the current run, e.g.
+    for the daemon to tell a client something while another client's run is
+    going on. "name" and "context" are just like in select(), "tty" just like
+    in assume_tty().
+    """
+
+    name = name or _configured()
+
+    if name not in RENDERERS:
+        if tty is None:
+            tty = hasattr(sys.stdout, "isatty") and sys.stdout.isatty()
+
+        name = tty and "tty" or "plain"
+
+    return RENDERERS[name](context)
+
+def finish():
+    """
+    The run is over - let the renderer say what it has to say at the end, if
+    there has been a renderer at all.
+    """
+
+    renderer = _state["renderer"]
+
+    if renderer is not None:
+        renderer.finish()
+
+def reset():
+    """
+    Forget the renderer of the run, see czokomanager.end_run().
+    """
+
+    with _state_lock:
+        _state.update({"renderer": None, "name": None, "context": {},
+                       "tty": None})
+
+def format_time(timestamp):
+    """
+    Return the time (seconds since the epoch) the way czokomaster shows it,
+    e.g. "2012-04-13 10:24:01", or "never" if there is no time.
+    """
+
+    if timestamp is None:
+        return "never"
+
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+def _configured():
+    """
+    Return "output" of the config file or "auto" if the config file cannot
+    be read (e.g. the config error itself is to be printed).
+    """
+
+    from czokomanager import get_config_option, ConfigError
+
+    try:
+        return get_config_option("czokomaster", "output")
+    except ConfigError:
+        return "auto"
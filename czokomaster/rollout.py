@@ -0,0 +1,122 @@
+"""
+This is the rolling upgrade of czokomaster. An ordinary "upgrade all" goes
+through every jail (as many at the same time as "max_parallel_jails" allows)
+no matter how the jails upgraded so far have done - if the new version of a
+package breaks the site, it breaks it in every jail. The rolling upgrade
+goes step by step instead:
+
+  1) the canary jails (see "rolling_canaries") are upgraded first - if any of
+     them fails, nothing else is touched;
+  2) the rest of the jails are upgraded in batches of "rolling_batch_size"
+     jails, the jails of a batch at the same time;
+  3) once a batch is over, its failures are counted - if there are more of
+     them than "rolling_failure_budget", the upgrade stops there and the
+     jails of the batches to come are left alone.
+
+The upgrade of a single jail may take at most "rolling_jail_timeout" seconds
+- once it is up, the commands run for the jail are killed and the jail counts
+as failed. Thus, at most one batch of jails is being upgraded (and loaded
+with the builds) at any time, while the production jails of the other
+batches keep serving.
+
+It is used by "czokomaster ports upgrade --rolling" and "czokomaster pippy
+upgrade --rolling" (or by every upgrade, with "rolling_upgrade = yes"). The
+jails failed or left alone are left unfinished in the run journal (see
+journal.py), so "--resume" goes on with them once the cause is fixed.
+"""
+
+import render
+
+from czokomanager import (get_config_option, get_max_parallel_jails,
+                          describe_jail, new_engine)
+
+def is_rolling(params):
+    """
+    Whether the upgrade should be rolled out, i.e. "--rolling" is given or
+    "rolling_upgrade" is set in the config file.
+    """
+
+    return "--rolling" in params or \
+           get_config_option("czokomaster", "rolling_upgrade")
+
+def roll_out(jails, function):
+    """
+    Call function(jail) for every jail on the list as the top of the module
+    says. The function returns True if the jail has been upgraded fine.
+    Return the dict: jail -> "done", "failed", "timed out" or "skipped" (the
+    latter if the upgrade has stopped before the jail was reached).
+    """
+
+    canaries = [jail for jail in jails if jail in \
+                get_config_option("czokomaster", "rolling_canaries")]
+    rest = [jail for jail in jails if jail not in canaries]
+
+    batch_size = get_config_option("czokomaster", "rolling_batch_size") or \
+                 get_max_parallel_jails()
+    budget = max(0, get_config_option("czokomaster", "rolling_failure_budget"))
+    time_limit = get_config_option("czokomaster", "rolling_jail_timeout")
+
+    batches = [("the canaries", canaries, 0)] if canaries else []
+
+    for start in range(0, len(rest), batch_size):
+        batches.append(("batch %d/%d" % (start // batch_size + 1,
+                                         (len(rest) + batch_size - 1) // \
+                                         batch_size),
+                        rest[start:start + batch_size], budget))
+
+    renderer = render.get()
+    renderer.heading("Rolling upgrade of %d system(s)" % len(jails),
+                     note="%s%d batch(es) of up to %d, at most %d failure(s) "
+                          "per batch%s." % \
+                          (canaries and "the canaries (%s), then " % \
+                           ", ".join(canaries) or "",
+                           len(batches) - (canaries and 1 or 0), batch_size,
+                           budget, time_limit and ", %d second(s) per "
+                           "system" % time_limit or ""))
+
+    outcome = dict([(jail, "skipped") for jail in jails])
+
+    for name, batch, allowed in batches:
+        renderer.blank()
+        renderer.heading("Upgrading %s" % name,
+                         note=", ".join([describe_jail(jail) \
+                                         for jail in batch]))
+
+        engine = new_engine(min(batch_size, len(batch)))
+
+        for jail in batch:
+            engine.submit(function, jail, name=describe_jail(jail), jail=jail,
+                          time_limit=time_limit or None)
+
+        for job in engine.run():
+            if job.state == "done" and job.result:
+                outcome[job.jail] = "done"
+            elif job.timed_out:
+                outcome[job.jail] = "timed out"
+            else:
+                outcome[job.jail] = "failed"
+
+        failed = [jail for jail in batch if outcome[jail] != "done"]
+
+        renderer.item(failed and "warning" or "ok",
+                      renderer.bold("%s:" % name.capitalize()),
+                      "%d done, %d failed%s." % (len(batch) - len(failed),
+                                                 len(failed), failed and \
+                                                 " (%s)" % ", ".join(
+                                                 ["%s - %s" % \
+                                                  (describe_jail(jail),
+                                                   outcome[jail]) \
+                                                  for jail in failed]) or ""))
+
+        if len(failed) > allowed:
+            left = [describe_jail(jail) for jail in jails \
+                    if outcome[jail] == "skipped"]
+
+            renderer.item("error",
+                          renderer.bold("Stopping the rolling upgrade:"),
+                          "%d failure(s) in %s, %d allowed.%s" % \
+                  (len(failed), name, allowed,
+                   left and " Not touched: %s." % ", ".join(left) or ""))
+            break
+
+    return outcome
@@ -0,0 +1,226 @@
+"""
+This is the run log of czokomaster. Every command run through the manager
+(see czokomanager.run_command()) leaves a record here: how long it took, how
+it ended, how much CPU time it used and how much memory it needed at most -
+the latter taken from the resource usage of the very process, as reported by
+wait4(2). Each record is tagged with the plugin, the action and the jail the
+command was run for, so it is known where e.g. "ports upgrade all" spends its
+time.
+
+Once the run is over, the records are appended to the run log (one JSON
+document per line, see "run_log" in the config file) and, if "run_summary"
+is set, summed up on the terminal: the slowest jails and the slowest
+packages. czokomanager.handle_event() does it once the plugin is done, before
+the renderer says its last word. Whatever else runs the commands (e.g. the
+pippy cron helper) is covered at exit without doing anything about it. The
+daemon (see daemon.py) goes through many runs before it exits, so it
+finishes each of them by itself.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import threading
+
+import render
+
+## How many of the slowest jails/packages the summary shows.
+SUMMARY_LENGTH = 5
+
+## The records of the current run, in the order the commands have finished.
+_records = []
+_records_lock = threading.Lock()
+
+## What the run is known by in the log, e.g. "1334300000-1234".
+_run = {"id": "%d-%d" % (time.time(), os.getpid()), "finish": None}
+
+## The arguments of a command that name a package: a port origin (e.g.
+## www/nginx) or a python package (e.g. Django or django-tagging).
+PACKAGE_RE = re.compile(r"^(?:[a-z0-9][\w.+-]*/[\w.+-]+|"
+                        r"[A-Za-z][\w.]*(?:-[A-Za-z][\w.]*)*)$")
+
+def record(command, returncode, wall, usage, tags, timed_out=False,
+           cancelled=False):
+    """
+    Note a single command that has just finished. "usage" is the resource
+    usage of the command (as returned by os.wait4()) or None if it is not
+    known, "tags" is the dict of the plugin, the action, the jail and the
+    job the command was run for.
+    """
+
+    entry = {
+        "run": _run["id"],
+        "started": time.time() - wall,
+        "command": command,
+        "package": guess_package(command),
+        "returncode": returncode,
+        "wall": round(wall, 3),
+        "user": round(usage.ru_utime, 3) if usage else None,
+        "sys": round(usage.ru_stime, 3) if usage else None,
+        "maxrss": usage.ru_maxrss if usage else None,
+        "timed_out": timed_out,
+        "cancelled": cancelled,
+    }
+    entry.update(tags)
+
+    with _records_lock:
+        _records.append(entry)
+
+        ## The log is written (and the summary printed) once the run is
+        ## over.
+        if _run["finish"] is None:
+            _run["finish"] = atexit.register(finish)
+
+def get_records():
+    """
+    Return the records of the current run so far.
+    """
+
+    with _records_lock:
+        return list(_records)
+
+def guess_package(command):
+    """
+    Return the package(s) the command works on (e.g. "www/nginx" for "jexec
+    db portmaster -d -g www/nginx" or "Django South" for "easy_install -U
+    Django South") or None. It is only a guess: the arguments at the end of
+    the command that look like package names are taken, provided they come
+    right after an option (so e.g. "portsnap fetch update" does not count).
+    """
+
+    words = command.split()
+    packages = []
+
+    while words and PACKAGE_RE.match(words[-1]) and not words[-1].isupper():
+        packages.insert(0, words.pop())
+
+    if not packages or not words or not words[-1].startswith("-"):
+        return None
+
+    return " ".join(packages)
+
+def summarize(records, stream=None):
+    """
+    Print the summary of the given records: the total time, the slowest
+    jails and the slowest packages.
+    """
+
+    renderer = render.get()
+
+    if not records:
+        return
+
+    jails = {}
+    packages = {}
+
+    for entry in records:
+        jail = entry.get("jail") or "-"
+        jails[jail] = jails.get(jail, 0) + entry["wall"]
+
+        if entry.get("package"):
+            key = (entry["package"], jail)
+            packages[key] = packages.get(key, 0) + entry["wall"]
+
+    failed = len([entry for entry in records if entry["returncode"]])
+
+    renderer.item("info", renderer.bold("Run summary:"),
+                  "%d command(s), %.1f second(s) in total, %d failed." % \
+                  (len(records), sum([entry["wall"] for entry in records]),
+                   failed), to=stream)
+
+    renderer.text("   The slowest jails:", to=stream)
+
+    for jail, wall in sorted(jails.items(), key=lambda item: -item[1]) \
+                      [:SUMMARY_LENGTH]:
+        renderer.text("     %8.1fs  %s" % (wall, jail), jail=jail, to=stream)
+
+    if packages:
+        renderer.text("   The slowest packages:", to=stream)
+
+        for (package, jail), wall in sorted(packages.items(),
+                                            key=lambda item: -item[1]) \
+                                     [:SUMMARY_LENGTH]:
+            renderer.text("     %8.1fs  %s (%s)" % (wall, package, jail),
+                          jail=jail, to=stream)
+
+def write_log(path, records):
+    """
+    Append the records to the run log, one JSON document per line.
+    """
+
+    directory = os.path.dirname(path)
+
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, 0755)
+
+    f = open(path, "a")
+    f.write("".join([json.dumps(entry, sort_keys=True) + "\n" \
+                     for entry in records]))
+    f.close()
+
+def read_log(path, limit=None):
+    """
+    Return the records of the run log, the oldest first - only the last
+    "limit" of them, if given. The lines that cannot be read (e.g. the one
+    cut short by a crash) are left out.
+    """
+
+    try:
+        f = open(path, "r")
+    except IOError:
+        return []
+
+    try:
+        lines = f.readlines()
+    finally:
+        f.close()
+
+    if limit is not None:
+        lines = lines[-limit:]
+
+    records = []
+
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+
+    return records
+
+def finish():
+    """
+    Write the records of the run down, sum them up and start a new run.
+    Called by czokomanager.handle_event() and czokomanager.end_run() (or at
+    exit, if neither has been).
+    """
+
+    ## Imported here, as the manager imports this module.
+    from czokomanager import get_config_option, ConfigError
+
+    with _records_lock:
+        records = list(_records)
+        del _records[:]
+        _run["id"] = "%d-%d" % (time.time(), os.getpid())
+
+    if not records:
+        return
+
+    try:
+        path = get_config_option("czokomaster", "run_log")
+        summary = get_config_option("czokomaster", "run_summary")
+    except ConfigError:
+        return
+
+    if path:
+        try:
+            write_log(path, records)
+        except (IOError, OSError), error:
+            print >> sys.stderr, "Cannot write the run log %s: %s" % \
+                  (path, error)
+
+    if summary:
+        summarize(records)
@@ -0,0 +1,287 @@
+"""
+This is the throttle of czokomaster. The jails share the host - a dozen of
+portmaster builds or easy_install runs started at the same time eat up its
+CPU, memory and disk, and the services of the very jails being upgraded
+slow down to a crawl. Thus, before the job engine (see engine.py) starts
+yet another job of a jail, it asks the throttle whether the host can take
+it:
+
+  - the load average (1 minute) must be below "throttle_max_load";
+  - the free memory (in megabytes) must be above "throttle_min_free_memory";
+  - the busiest disk must be busy less than "throttle_max_io_busy" percent
+    of the time.
+
+0 means the given reading does not matter. If the host cannot take the job,
+the job waits until it can - yet a single job is always let run, so the run
+goes on however loaded the host is.
+
+The readings are taken from the host itself: os.getloadavg(), sysctl/iostat
+on FreeBSD and /proc on Linux. iostat takes a second to tell how busy the
+disks are, so it is run by a thread of its own every READINGS_TTL seconds
+and the throttle goes with the latest report it has got - the engine never
+waits for it. With CZOKOMASTER_HOST_READINGS set, they are
+read from the JSON file it points to instead (e.g. when trying the
+thresholds out), once per reading, so the file might be changed while
+czokomaster runs:
+
+  {"load": 8.5, "free_memory": 512, "io_busy": 95}
+
+The readings left out of the file are not known, so they do not matter.
+"""
+
+import os
+import re
+import json
+import time
+import threading
+import subprocess
+
+import render
+
+## For how many seconds the readings of the host are used before they are
+## taken again.
+READINGS_TTL = 5
+
+## The throttles made so far, one per set of thresholds - so the readings
+## taken for one engine are used by the rest of them as well.
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+## The latest %b of the busiest disk reported by iostat and the thread that
+## runs iostat (see _io_busy()).
+_iostat = {"busy": None, "thread": None}
+_iostat_lock = threading.Lock()
+
+class Throttle(object):
+    """
+    Tell whether the host can take yet another job, see the top of the
+    module.
+    """
+
+    def __init__(self, max_load=0, min_free_memory=0, max_io_busy=0):
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory
+        self.max_io_busy = max_io_busy
+        self.lock = threading.Lock()
+        self.readings = None
+        self.taken = 0
+        self.holding = None
+
+    def admit(self):
+        """
+        Return None if the host can take another job or the reason why it
+        cannot (e.g. "load 8.50 >= 6.00").
+        """
+
+        readings = self.read()
+        reasons = []
+
+        if self.max_load and readings.get("load") is not None and \
+           readings["load"] >= self.max_load:
+            reasons.append("load %.2f >= %.2f" % (readings["load"],
+                                                  self.max_load))
+
+        if self.min_free_memory and readings.get("free_memory") is not None \
+           and readings["free_memory"] <= self.min_free_memory:
+            reasons.append("free memory %dM <= %dM" % \
+                           (readings["free_memory"], self.min_free_memory))
+
+        if self.max_io_busy and readings.get("io_busy") is not None and \
+           readings["io_busy"] >= self.max_io_busy:
+            reasons.append("disk busy %d%% >= %d%%" % (readings["io_busy"],
+                                                       self.max_io_busy))
+
+        return ", ".join(reasons) or None
+
+    def hold(self, job, stream=None):
+        """
+        Return True if the job should wait (and say so once, when it starts
+        waiting). Called by the engine for every job it is about to start
+        while other jobs are running.
+        """
+
+        reason = self.admit()
+
+        if reason is None:
+            self.holding = None
+            return False
+
+        if self.holding is not job:
+            self.holding = job
+            render.get().item("warning", "Holding back %s, the host is "
+                              "busy: %s." % (job.name, reason), jail=job.jail,
+                              to=stream)
+
+        return True
+
+    def read(self):
+        """
+        Return the readings of the host (see the top of the module). They
+        are taken again only every READINGS_TTL seconds.
+        """
+
+        path = os.environ.get("CZOKOMASTER_HOST_READINGS")
+
+        if path:
+            return _simulated_readings(path)
+
+        with self.lock:
+            if self.readings is None or \
+               time.time() - self.taken >= READINGS_TTL:
+                self.readings = {"load": _load(),
+                                 "free_memory": _free_memory(),
+                                 "io_busy": _io_busy()}
+                self.taken = time.time()
+
+            return self.readings
+
+def from_config():
+    """
+    Return the Throttle set up as the config file says or None if none of
+    the thresholds is set.
+    """
+
+    from czokomanager import get_config_option
+
+    thresholds = (get_config_option("czokomaster", "throttle_max_load"),
+                  get_config_option("czokomaster", "throttle_min_free_memory"),
+                  get_config_option("czokomaster", "throttle_max_io_busy"))
+
+    if not [threshold for threshold in thresholds if threshold]:
+        return None
+
+    with _throttles_lock:
+        if thresholds not in _throttles:
+            _throttles[thresholds] = Throttle(*thresholds)
+
+        return _throttles[thresholds]
+
+def _simulated_readings(path):
+    try:
+        f = open(path, "r")
+    except IOError:
+        return {}
+
+    try:
+        return json.load(f)
+    except ValueError:
+        return {}
+    finally:
+        f.close()
+
+def _load():
+    try:
+        return os.getloadavg()[0]
+    except OSError:
+        return None
+
+def _free_memory():
+    """
+    Return the free memory of the host in megabytes or None if it is not
+    known. On FreeBSD, the inactive and the cached pages count as free, as
+    they are given back as soon as they are needed.
+    """
+
+    if os.path.exists("/proc/meminfo"):
+        f = open("/proc/meminfo", "r")
+        meminfo = f.read()
+        f.close()
+
+        match = re.search(r"^MemAvailable:\s+(\d+)", meminfo, re.M)
+
+        return int(match.group(1)) // 1024 if match else None
+
+    output = _output(["sysctl", "-n", "hw.pagesize",
+                      "vm.stats.vm.v_free_count",
+                      "vm.stats.vm.v_inactive_count",
+                      "vm.stats.vm.v_cache_count"])
+
+    try:
+        values = [int(value) for value in (output or "").split()]
+    except ValueError:
+        return None
+
+    if len(values) < 3:
+        return None
+
+    return values[0] * sum(values[1:]) // (1024 * 1024)
+
+def _io_busy():
+    """
+    Return how busy (in percent of the time) the busiest disk of the host
+    is or None if it is not known. On Linux, it is the share of the time
+    some tasks have been waiting for I/O (/proc/pressure/io). On FreeBSD,
+    it is the latest %b of the disks iostat has reported - nothing is known
+    until the first report is there (see _sample_iostat()).
+    """
+
+    if os.path.exists("/proc/pressure/io"):
+        f = open("/proc/pressure/io", "r")
+        pressure = f.read()
+        f.close()
+
+        match = re.search(r"^some avg10=([\d.]+)", pressure, re.M)
+
+        return float(match.group(1)) if match else None
+
+    with _iostat_lock:
+        if _iostat["thread"] is None:
+            _iostat["thread"] = threading.Thread(target=_sample_iostat)
+            _iostat["thread"].daemon = True
+            _iostat["thread"].start()
+
+    return _iostat["busy"]
+
+def _sample_iostat():
+    """
+    Ask iostat for the %b of the disks over a second every READINGS_TTL
+    seconds, for as long as czokomaster runs. If iostat cannot be run at
+    all, give up.
+    """
+
+    while True:
+        output = _output(["iostat", "-x", "-w", "1", "-c", "2"])
+
+        if output is None:
+            _iostat["busy"] = None
+            return
+
+        _iostat["busy"] = _parse_iostat(output)
+        time.sleep(READINGS_TTL)
+
+def _parse_iostat(output):
+    """
+    Return the highest %b out of the output of "iostat -x -w 1 -c 2" or
+    None if there are no disks in it.
+    """
+
+    ## The second report is the one over the last second. "%b" is the last
+    ## column of the lines of the disks.
+    reports = output.split("extended device statistics")
+
+    busy = []
+
+    for line in reports[-1].splitlines():
+        words = line.split()
+
+        if len(words) > 2 and words[-1].isdigit() and \
+           not words[0].startswith("device"):
+            busy.append(int(words[-1]))
+
+    return max(busy) if busy else None
+
+def _output(command):
+    """
+    Return the stdout of the command or None if it cannot be run. These are
+    not the commands of the jobs, so they are not run by run_command().
+    """
+
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, close_fds=True)
+    except OSError:
+        return None
+
+    stdout, stderr = process.communicate()
+
+    return stdout if process.returncode == 0 else None